@@ -1,26 +1,58 @@
+import os
+from .utils import startup
 from flask import Flask
 from dotenv import load_dotenv
 load_dotenv()
 from .config import Config
 from .extensions import init_extensions, socketio
 from . import extensions
+startup.mark("import")
 
 def create_app():
+    """
+    Build the Flask app. No threads, no network: background services start
+    per process via app.services.lifecycle.start_background_services().
+    """
     app = Flask(__name__)
     app.config.from_object(Config)
 
     init_extensions(app)
 
+    # Settings only; each worker opens the shared store after fork (lifecycle)
+    from .services.shared_state import configure_shared_state
+    configure_shared_state(app.config)
+
     # Blueprints
-    from .routes.agent import agent_bp
-    from .routes.devices import devices_bp
-    from .routes.stats import stats_bp
-    from .routes.realtime import realtime_bp
+    with startup.timed("create_app", "routes.agent"):
+        from .routes.agent import agent_bp
+    with startup.timed("create_app", "routes.devices"):
+        from .routes.devices import devices_bp
+    with startup.timed("create_app", "routes.stats"):
+        from .routes.stats import stats_bp
+    with startup.timed("create_app", "routes.realtime"):
+        from .routes.realtime import realtime_bp
+    with startup.timed("create_app", "routes.metrics"):
+        from .routes.metrics import metrics_bp, init_metrics
+    with startup.timed("create_app", "routes.admin"):
+        from .routes.admin import admin_bp
 
     app.register_blueprint(agent_bp, url_prefix="/api")
     app.register_blueprint(devices_bp, url_prefix="/api")
     app.register_blueprint(stats_bp, url_prefix="/api")
     app.register_blueprint(realtime_bp, url_prefix="/api")
+    app.register_blueprint(admin_bp, url_prefix="/api")
+    app.register_blueprint(metrics_bp)
+    init_metrics(app)
+
+    from .utils.tracing import init_tracing
+    init_tracing(app)
+
+    from .services import lifecycle
+
+    @app.before_request
+    def _ensure_background_services():
+        # Fallback for servers without the gunicorn hook (flask run, tests)
+        lifecycle.start_background_services(app)
 
     # Professional Landing Page
     @app.route("/")
@@ -57,21 +89,19 @@ def create_app():
         </html>
         """
 
-    # Health check
+    # Liveness: the process is up and serving. No I/O, so probing it is free.
     @app.route("/health")
     def health():
-        try:
-            res = extensions.supabase.table("devices").select("system_id", count="exact").execute()
-            return {
-                "status": "ok",
-                "database": "connected",
-                "device_count": res.count if res.count is not None else 0
-            }
-        except Exception as e:
-            return {
-                "status": "error",
-                "database": "failed",
-                "message": str(e)
-            }, 500
+        return {"status": "ok", "pid": os.getpid(), "uptime_seconds": round(startup.since_start_ms() / 1000, 1)}
+
+    # Readiness from background-sampled state (app/services/health.py):
+    # 503 until warm, "degraded" (still 200) while the backend is unreachable
+    @app.route("/ready")
+    def ready():
+        from .services import health
+        body, status = health.readiness()
+        body["startup"] = startup.report()
+        return body, status
 
+    startup.mark("create_app")
     return app
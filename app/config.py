@@ -6,3 +6,137 @@ class Config:
     SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
 
     CORS_ORIGINS = os.getenv("CORS_ORIGINS", "*")
+
+    # Optional bearer token required to scrape /metrics
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+    # Bearer token for /api/admin/* (admin endpoints are disabled when unset)
+    ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+    # On-demand sampling profiler (/api/admin/profile) hard limits
+    PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "30"))
+    PROFILE_MAX_HZ = int(os.getenv("PROFILE_MAX_HZ", "100"))
+    PROFILE_MAX_OVERHEAD = float(os.getenv("PROFILE_MAX_OVERHEAD", "0.05"))
+
+    # Per-request DB tracing: slow-request log budget and optional Server-Timing header
+    SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "500"))
+    SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() in ("1", "true", "yes")
+
+    # Supabase HTTP pool (shared by every greenlet + background thread)
+    DB_MAX_CONNECTIONS = int(os.getenv("DB_MAX_CONNECTIONS", "20"))
+    DB_MAX_KEEPALIVE = int(os.getenv("DB_MAX_KEEPALIVE", "10"))
+    DB_KEEPALIVE_EXPIRY = float(os.getenv("DB_KEEPALIVE_EXPIRY", "30"))
+    DB_HTTP2 = os.getenv("DB_HTTP2", "true").lower() in ("1", "true", "yes")
+    DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "5"))
+    DB_READ_TIMEOUT = float(os.getenv("DB_READ_TIMEOUT", "15"))
+    DB_WRITE_TIMEOUT = float(os.getenv("DB_WRITE_TIMEOUT", "15"))
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+
+    # Local write spool (WAL) used while Supabase is down or over budget
+    SPOOL_DIR = os.getenv("SPOOL_DIR", "spool")
+    SPOOL_MAX_BYTES = int(os.getenv("SPOOL_MAX_BYTES", str(64 * 1024 * 1024)))
+    SPOOL_FSYNC_INTERVAL = float(os.getenv("SPOOL_FSYNC_INTERVAL", "1"))
+    SPOOL_LATENCY_BUDGET = float(os.getenv("SPOOL_LATENCY_BUDGET", "2"))
+    SPOOL_DEGRADED_SECONDS = float(os.getenv("SPOOL_DEGRADED_SECONDS", "30"))
+    SPOOL_REPLAY_INTERVAL = float(os.getenv("SPOOL_REPLAY_INTERVAL", "5"))
+    SPOOL_REPLAY_BATCH = int(os.getenv("SPOOL_REPLAY_BATCH", "500"))
+
+    # Background jobs (app/services/jobs.py)
+    OFFLINE_SWEEP_INTERVAL = float(os.getenv("OFFLINE_SWEEP_INTERVAL", "60"))
+    OFFLINE_SWEEP_JITTER = float(os.getenv("OFFLINE_SWEEP_JITTER", "5"))
+    RETENTION_JITTER = float(os.getenv("RETENTION_JITTER", "60"))
+    REGISTRY_REFRESH_INTERVAL = float(os.getenv("REGISTRY_REFRESH_INTERVAL", "300"))
+    REGISTRY_REFRESH_JITTER = float(os.getenv("REGISTRY_REFRESH_JITTER", "15"))
+
+    # SSE stream (/api/stream): coalescing window, resume buffer and client cap
+    STREAM_COALESCE_SECONDS = float(os.getenv("STREAM_COALESCE_SECONDS", "1"))
+    STREAM_BUFFER_FRAMES = int(os.getenv("STREAM_BUFFER_FRAMES", "600"))
+    STREAM_KEEPALIVE_SECONDS = float(os.getenv("STREAM_KEEPALIVE_SECONDS", "15"))
+    STREAM_MAX_CLIENTS = int(os.getenv("STREAM_MAX_CLIENTS", "5000"))
+
+    # State shared between gunicorn workers: "memory" (one worker) or "sqlite"
+    # (one database file per host, default <SPOOL_DIR>/shared_state.db)
+    SHARED_STATE_BACKEND = os.getenv("SHARED_STATE_BACKEND", "memory")
+    SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH")
+    SHARED_BUS_POLL = float(os.getenv("SHARED_BUS_POLL", "0.25"))
+    SHARED_BUS_RETENTION = float(os.getenv("SHARED_BUS_RETENTION", "60"))
+    # Longest cooperative back-off on another worker's SQLite write lock
+    SHARED_STATE_BUSY_TIMEOUT = float(os.getenv("SHARED_STATE_BUSY_TIMEOUT", "5"))
+
+    # Only the worker holding this file lock runs the fleet-wide jobs (offline
+    # sweep, retention, shared action expiry); default <SPOOL_DIR>/leader.lock
+    LEADER_LOCK_PATH = os.getenv("LEADER_LOCK_PATH")
+    LEADER_RENEW_INTERVAL = float(os.getenv("LEADER_RENEW_INTERVAL", "5"))
+    LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", "30"))
+
+    # Discovery cache of unregistered heartbeats (expire after TTL, hard size cap)
+    DISCOVERY_TTL_SECONDS = float(os.getenv("DISCOVERY_TTL_SECONDS", "180"))
+    DISCOVERY_MAX_ENTRIES = int(os.getenv("DISCOVERY_MAX_ENTRIES", "10000"))
+
+    # Admission control on /api/heartbeat and /api/auth: per-hardware_id token
+    # buckets, then global shedding above these load thresholds
+    HEARTBEAT_RATE_PER_SECOND = float(os.getenv("HEARTBEAT_RATE_PER_SECOND", "0.2"))
+    HEARTBEAT_BURST = float(os.getenv("HEARTBEAT_BURST", "6"))
+    AUTH_RATE_PER_SECOND = float(os.getenv("AUTH_RATE_PER_SECOND", "0.1"))
+    AUTH_BURST = float(os.getenv("AUTH_BURST", "5"))
+    ADMISSION_MAX_TRACKED = int(os.getenv("ADMISSION_MAX_TRACKED", "100000"))
+    SHED_BACKEND_LATENCY = float(os.getenv("SHED_BACKEND_LATENCY", "1.0"))
+    SHED_POOL_QUEUE = float(os.getenv("SHED_POOL_QUEUE", "1.5"))
+    SHED_SPOOL_FILL = float(os.getenv("SHED_SPOOL_FILL", "0.9"))
+    SHED_RETRY_AFTER = float(os.getenv("SHED_RETRY_AFTER", "20"))
+
+    # Heartbeat cadence suggested to agents (next_interval_seconds)
+    HEARTBEAT_ACTIVE_INTERVAL = float(os.getenv("HEARTBEAT_ACTIVE_INTERVAL", "10"))
+    HEARTBEAT_IDLE_INTERVAL = float(os.getenv("HEARTBEAT_IDLE_INTERVAL", "25"))
+    HEARTBEAT_INTERVAL_JITTER = float(os.getenv("HEARTBEAT_INTERVAL_JITTER", "0.1"))
+
+    # Signed device tokens (/auth, /bind -> heartbeat); disabled without a secret
+    DEVICE_TOKEN_SECRET = os.getenv("DEVICE_TOKEN_SECRET")
+    DEVICE_TOKEN_TTL = float(os.getenv("DEVICE_TOKEN_TTL", "900"))
+    DEVICE_TOKEN_EPOCH = int(os.getenv("DEVICE_TOKEN_EPOCH", "0"))
+    DEVICE_STATE_TTL = float(os.getenv("DEVICE_STATE_TTL", "600"))
+    DEVICE_STATE_MAX_ENTRIES = int(os.getenv("DEVICE_STATE_MAX_ENTRIES", "100000"))
+
+    # Unchanged heartbeats only touch last_seen (batched); the full row is written
+    # on meaningful change or at least every HEARTBEAT_FULL_WRITE_INTERVAL
+    HEARTBEAT_FULL_WRITE_INTERVAL = float(os.getenv("HEARTBEAT_FULL_WRITE_INTERVAL", "300"))
+    HEARTBEAT_USAGE_MIN_DELTA = int(os.getenv("HEARTBEAT_USAGE_MIN_DELTA", "120"))
+    HEARTBEAT_TOUCH_FLUSH_INTERVAL = float(os.getenv("HEARTBEAT_TOUCH_FLUSH_INTERVAL", "5"))
+
+    # App catalogue (dictionary-encoded app names). APP_USAGE_LOG_IDS needs the
+    # `apps` table and app_usage_logs.app_id (see app/services/app_catalogue.py)
+    APP_CATALOGUE_MAX_ENTRIES = int(os.getenv("APP_CATALOGUE_MAX_ENTRIES", "50000"))
+    APP_USAGE_LOG_IDS = os.getenv("APP_USAGE_LOG_IDS", "false").lower() in ("1", "true", "yes")
+
+    # Remote action queue (/api/trigger, /api/actions/*). Queueing actions and
+    # reading their status need ADMIN_TOKEN; the agent poll / ack routes do not
+    ACTION_TTL = float(os.getenv("ACTION_TTL", "3600"))
+    ACTION_REDELIVER_SECONDS = float(os.getenv("ACTION_REDELIVER_SECONDS", "60"))
+    ACTION_MAX_ATTEMPTS = int(os.getenv("ACTION_MAX_ATTEMPTS", "3"))
+    ACTION_POLL_MAX_WAIT = float(os.getenv("ACTION_POLL_MAX_WAIT", "30"))
+    ACTION_EXPIRY_INTERVAL = float(os.getenv("ACTION_EXPIRY_INTERVAL", "60"))
+
+    # Streaming history export (/api/export/history): rows per keyset page, max range
+    EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+    EXPORT_MAX_DAYS = int(os.getenv("EXPORT_MAX_DAYS", "400"))
+
+    # Background report jobs (/api/reports): worker threads, result lifetime, queue bound,
+    # and how long another process's unfinished job counts before it is taken as lost (< TTL)
+    REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "1"))
+    REPORT_RESULT_TTL = float(os.getenv("REPORT_RESULT_TTL", "900"))
+    REPORT_MAX_PENDING = int(os.getenv("REPORT_MAX_PENDING", "20"))
+    REPORT_MAX_JOBS = int(os.getenv("REPORT_MAX_JOBS", "500"))
+    REPORT_STALE_SECONDS = float(os.getenv("REPORT_STALE_SECONDS", "300"))
+
+    # Readiness state is sampled in the background; health endpoints only read it
+    HEALTH_SAMPLE_INTERVAL = float(os.getenv("HEALTH_SAMPLE_INTERVAL", "10"))
+    HEALTH_SPOOL_HIGH_WATER = float(os.getenv("HEALTH_SPOOL_HIGH_WATER", "0.8"))
+
+    # Retention pruning of transient tables (chunked + throttled)
+    RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+    RETENTION_CHUNK = int(os.getenv("RETENTION_CHUNK", "500"))
+    RETENTION_PAUSE = float(os.getenv("RETENTION_PAUSE", "0.5"))
+    RETENTION_MAX_RUN_SECONDS = float(os.getenv("RETENTION_MAX_RUN_SECONDS", "300"))
+    RETENTION_LATENCY_THRESHOLD = float(os.getenv("RETENTION_LATENCY_THRESHOLD", "0.5"))
+    RETENTION_SESSIONS_HOURS = int(os.getenv("RETENTION_SESSIONS_HOURS", "24"))
+    RETENTION_USAGE_DAYS = int(os.getenv("RETENTION_USAGE_DAYS", "1"))
@@ -1,13 +1,55 @@
 from flask_cors import CORS
-from supabase import create_client
 from flask_socketio import SocketIO
+import threading
 
-supabase = None
+class LazySupabase:
+    """
+    The Supabase client, built on first use instead of at startup.
+
+    With preload_app the app is created in the gunicorn master; building the
+    client (and its connection pool) there would share sockets across forked
+    workers and put client setup on the cold-start path. Each process builds
+    its own on the first `.table()`/`.rpc()` call instead.
+    """
+
+    def __init__(self):
+        self._config = None
+        self._client = None
+        self._lock = threading.Lock()
+
+    def configure(self, config):
+        self._config = config
+        self._client = None
+
+    @property
+    def ready(self):
+        return self._client is not None
+
+    def get(self):
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    if self._config is None:
+                        raise RuntimeError("Supabase client used before init_extensions()")
+                    from supabase import create_client, ClientOptions
+                    from app.utils.db_client import build_http_client
+                    # One explicit, instrumented connection pool for all DB traffic
+                    self._client = create_client(
+                        self._config["SUPABASE_URL"],
+                        self._config["SUPABASE_SERVICE_KEY"],
+                        options=ClientOptions(httpx_client=build_http_client(self._config))
+                    )
+                client = self._client
+        return client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+supabase = LazySupabase()
 socketio = SocketIO()
 
 def init_extensions(app):
-    global supabase
-
     CORS(
         app,
         resources={r"/*": {
@@ -16,13 +58,10 @@ def init_extensions(app):
         supports_credentials=True
     )
 
-    supabase = create_client(
-        app.config["SUPABASE_URL"],
-        app.config["SUPABASE_SERVICE_KEY"]
-    )
+    supabase.configure(app.config)
 
     socketio.init_app(
-        app, 
+        app,
         cors_allowed_origins="*",
         async_mode='gevent',
         ping_timeout=60,
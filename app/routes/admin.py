@@ -0,0 +1,56 @@
+from flask import Blueprint, Response, request, current_app, jsonify
+from functools import wraps
+import hmac
+from app.utils.logger import logger
+from app.utils import profiler
+
+admin_bp = Blueprint("admin", __name__)
+
+def admin_required(view):
+    """Bearer ADMIN_TOKEN auth. Without a configured token the route doesn't exist."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = current_app.config.get("ADMIN_TOKEN")
+        if not token:
+            return jsonify({"error": "Not found"}), 404
+        supplied = request.headers.get("Authorization", "")
+        if not hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode()):
+            return jsonify({"error": "Unauthorized"}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+@admin_bp.route("/admin/profile", methods=["GET"])
+@admin_required
+def sample_profile():
+    """
+    Sample every thread and greenlet for ?seconds= (default 10) at ?hz= (default 50).
+    ?mode=wall (default) includes parked greenlets, ?mode=cpu only running frames.
+    ?lines=1 keeps line numbers. Returns collapsed stacks, or JSON with ?format=json.
+    Duration, rate and sampling overhead are capped by PROFILE_MAX_* settings.
+    """
+    cfg = current_app.config
+    try:
+        seconds = float(request.args.get("seconds", 10))
+        hz = int(request.args.get("hz", 50))
+    except ValueError:
+        return jsonify({"error": "seconds and hz must be numbers"}), 400
+    seconds = min(max(seconds, 0.1), cfg["PROFILE_MAX_SECONDS"])
+    hz = min(max(hz, 1), cfg["PROFILE_MAX_HZ"])
+    mode = request.args.get("mode", "wall")
+    if mode not in ("wall", "cpu"):
+        return jsonify({"error": "mode must be 'wall' or 'cpu'"}), 400
+    lines = request.args.get("lines", "0").lower() in ("1", "true", "yes")
+
+    logger.info(f"🔬 Profiling {seconds}s at {hz}Hz ({mode}) for {request.remote_addr}")
+    try:
+        result = profiler.profile(seconds, hz, cfg["PROFILE_MAX_OVERHEAD"], mode, lines)
+    except profiler.ProfilerBusy as e:
+        return jsonify({"error": str(e)}), 409
+
+    if request.args.get("format") == "json":
+        return jsonify(result)
+    resp = Response(profiler.to_collapsed(result["stacks"]), mimetype="text/plain")
+    resp.headers["X-Profile-Samples"] = str(result["samples"])
+    resp.headers["X-Profile-Effective-Hz"] = str(result["effective_hz"])
+    resp.headers["X-Profile-Overhead"] = str(result["overhead"])
+    return resp
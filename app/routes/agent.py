@@ -2,70 +2,164 @@ from flask import Blueprint, request, jsonify
 from datetime import datetime
 import app.extensions as extensions
 from app.utils.logger import logger
+from app.services import spool, events, admission, cadence, device_state, device_tokens, app_catalogue
+from app.services.actions import queue as actions
+from app.services.registry import registry
+from app.routes.admin import admin_required
+from app.utils import metrics
+from app.services.shared_state import SharedTTLMap
 import threading
 import time
-from datetime import timedelta
 import os
 import subprocess
 import sys
 
 agent_bp = Blueprint("agent", __name__)
 
-# Global caches for Zero-Touch Deployment
-discovery_cache = {} # {hwid: {pc_name, last_seen}}
-trigger_cache = {}   # {hwid: action}
+# Global caches for Zero-Touch Deployment: unregistered machines seen recently (any worker)
+discovery_cache = SharedTTLMap("discovery", ttl=180, max_size=10000) # {hwid: {pc_name, last_seen}}
+
+HEARTBEATS = metrics.counter("lab_heartbeats_total", "Heartbeats received, by outcome.", ("result",))
+BACKGROUND_TASKS = metrics.gauge("lab_background_tasks_in_flight", "Background worker threads currently running.", ("task",))
+
+@agent_bp.record_once
+def _configure_caches(state):
+    cfg = state.app.config
+    discovery_cache.configure(ttl=cfg["DISCOVERY_TTL_SECONDS"], max_size=cfg["DISCOVERY_MAX_ENTRIES"])
+    admission.configure_admission(cfg)
+    cadence.configure_cadence(cfg)
+    device_tokens.configure_tokens(cfg)
+    device_state.configure_device_state(cfg)
+    app_catalogue.configure_app_catalogue(cfg)
+
+def _presented_token(data):
+    auth = request.headers.get("Authorization", "")
+    if auth.startswith("Bearer "):
+        return auth[7:]
+    return data.get("device_token")
 
 @agent_bp.route("/discovery/pending", methods=["GET"])
 def get_pending_discovery():
     """Lists unregistered devices that have beat their heart recently"""
-    now = datetime.utcnow()
-    # Cleanup items older than 3 minutes
-    for hid in list(discovery_cache.keys()):
-        ls = datetime.fromisoformat(discovery_cache[hid]["last_seen"].replace('Z', '+00:00'))
-        if (now - ls.replace(tzinfo=None)).total_seconds() > 180:
-            del discovery_cache[hid]
-    return jsonify(discovery_cache)
+    return jsonify(dict(discovery_cache.items()))
 
 @agent_bp.route("/trigger", methods=["POST"])
+@admin_required
 def trigger_action():
-    """Admin endpoint to queue actions for specific hardware"""
+    """
+    Admin endpoint to queue actions: one device (hardware_id) or a whole
+    city / tehsil / lab. Actions queue up per device; nothing is overwritten.
+    Bearer ADMIN_TOKEN, like the other admin routes.
+    """
     data = request.get_json(force=True)
     hid = data.get("hardware_id")
     action = data.get("action")
-    if not hid or not action:
-        return jsonify({"error": "Missing hardware_id or action"}), 400
-    
-    trigger_cache[hid] = action
-    return jsonify({"status": "queued", "action": action, "target": hid})
+    params = data.get("params") or {}
+    scope = {k: data.get(k) for k in ("city", "tehsil", "lab")}
+    if not action or not (hid or any(scope.values())):
+        return jsonify({"error": "Missing action or target (hardware_id, city, tehsil or lab)"}), 400
+
+    if hid:
+        item = actions.enqueue(hid, action, params)
+        return jsonify({"status": "queued", "action": action, "target": hid, "action_id": item.id})
+    batch_id, count = actions.enqueue_bulk(action, params, **scope)
+    return jsonify({"status": "queued", "action": action, "scope": scope, "batch_id": batch_id, "targets": count})
+
+@agent_bp.route("/actions/poll", methods=["GET"])
+def poll_actions():
+    """Agent long-poll: returns queued actions as soon as there are any, or [] after `wait` seconds."""
+    hid = request.args.get("hardware_id")
+    if not hid:
+        return jsonify({"error": "Missing hardware_id"}), 400
+    try:
+        wait = float(request.args.get("wait", 25))
+    except ValueError:
+        return jsonify({"error": "Invalid wait"}), 400
+    items = actions.poll(hid, wait)
+    return jsonify({"actions": [item.to_agent() for item in items]})
+
+@agent_bp.route("/actions/<action_id>/ack", methods=["POST"])
+def ack_action(action_id):
+    """Agent acknowledgement: {hardware_id, ok: true|false, result}."""
+    data = request.get_json(force=True)
+    item = actions.ack(data.get("hardware_id"), action_id, bool(data.get("ok", True)), data.get("result"))
+    if item is None:
+        return jsonify({"error": "Unknown action"}), 404
+    return jsonify({"status": item.state, "action_id": action_id})
+
+@agent_bp.route("/actions/<action_id>", methods=["GET"])
+@admin_required
+def get_action(action_id):
+    item = actions.get(action_id)
+    if item is None:
+        return jsonify({"error": "Unknown action"}), 404
+    return jsonify(item)
+
+@agent_bp.route("/actions/batch/<batch_id>", methods=["GET"])
+@admin_required
+def get_action_batch(batch_id):
+    """Delivery/ack counts for a bulk trigger."""
+    summary = actions.batch(batch_id)
+    if summary is None:
+        return jsonify({"error": "Unknown batch"}), 404
+    return jsonify(summary)
 
 def process_app_logs_background(sys_id, date_str, usage_map):
     """Professional Batch Upsert for Granular Logs (Runs Offline/Async)"""
+    process_app_logs_batch_background(sys_id, {date_str: usage_map})
+
+def process_app_logs_batch_background(sys_id, usage_by_date):
+    """Same as above for several days at once: ONE upsert for the whole batch."""
+    BACKGROUND_TASKS.inc("usage_log_flush")
     try:
-        if not usage_map: return
-        
-        log_entries = []
-        for app, sec in usage_map.items():
+        # Dictionary-encoded app names (APP_USAGE_LOG_IDS): one shared id per app
+        app_ids = None
+        if app_catalogue.settings["log_ids"]:
             try:
-                # Force cast to integer to prevent "invalid input syntax for type integer"
-                clean_sec = int(float(sec))
-            except:
-                clean_sec = 0
-
-            log_entries.append({
-                "device_id": sys_id,
-                "date": date_str,
-                "app_name": app,
-                "seconds_added": clean_sec
-            })
+                app_ids = app_catalogue.catalogue.db_ids({app for m in usage_by_date.values() for app in (m or {})})
+            except Exception as e:
+                # Backend unavailable: name-keyed rows still reach the spool like every other write
+                logger.warning(f"⚠️ App id lookup failed, logging usage by name: {e}")
+        use_ids = app_ids is not None
+
+        # One row per (date, app): names that differ only in case or spacing share
+        # an app id, and one upsert may not touch the same key twice
+        log_rows = {}
+        for date_str, usage_map in usage_by_date.items():
+            for app, sec in (usage_map or {}).items():
+                try:
+                    # Force cast to integer to prevent "invalid input syntax for type integer"
+                    clean_sec = int(float(sec))
+                except:
+                    clean_sec = 0
+
+                if use_ids:
+                    if app_ids.get(app) is None:
+                        continue
+                    key, column = app_ids[app], "app_id"
+                else:
+                    key, column = app, "app_name"
+                entry = log_rows.get((date_str, key))
+                if entry is None:
+                    log_rows[(date_str, key)] = {
+                        "device_id": sys_id,
+                        "date": date_str,
+                        "seconds_added": clean_sec,
+                        column: key
+                    }
+                else:
+                    entry["seconds_added"] += clean_sec
+        log_entries = list(log_rows.values())
         
         if log_entries:
             # PROFESSIONAL: Batch upsert is 100x faster than serial loops
-            extensions.supabase.table("app_usage_logs").upsert(
-                log_entries, 
-                on_conflict="device_id,date,app_name"
-            ).execute()
+            # Spooled locally (and replayed later) if the backend is unavailable
+            spool.write("app_usage_logs", "upsert", log_entries,
+                        on_conflict="device_id,date,app_id" if use_ids else "device_id,date,app_name")
     except Exception as e:
         logger.error(f"⚠️ Async Log Flush Failed: {e}")
+    finally:
+        BACKGROUND_TASKS.dec("usage_log_flush")
 
 @agent_bp.route("/auth", methods=["POST"])
 def authenticate_hardware():
@@ -75,6 +169,12 @@ def authenticate_hardware():
     
     if not hid:
         return jsonify({"error": "Missing Hardware ID"}), 400
+
+    decision, retry_after = admission.admit("auth", hid)
+    if decision != "ok":
+        status = 503 if decision == "shed" else 429
+        return jsonify({"error": "Try again later", "reason": decision, "retry_after": retry_after}), \
+            status, {"Retry-After": str(retry_after)}
         
     try:
         # Hierarchy and identity should be managed via Dashboard, 
@@ -91,7 +191,10 @@ def authenticate_hardware():
             if tehsil: update_payload["tehsil"] = tehsil
             if pc_name: update_payload["pc_name"] = pc_name
             
-            extensions.supabase.table("devices").update(update_payload).eq("hardware_id", hid).execute()
+            updated = extensions.supabase.table("devices").update(update_payload).eq("hardware_id", hid).execute()
+            registry.apply(updated.data)
+            # Tokens carry the old hierarchy
+            device_tokens.revoke(hardware_id=hid)
 
         res = extensions.supabase.table("devices").select("*").eq("hardware_id", hid).execute()
         if res.data:
@@ -102,7 +205,8 @@ def authenticate_hardware():
                 "city": device.get("city"),
                 "tehsil": device.get("tehsil"),
                 "lab_name": device.get("lab_name"),
-                "pc_name": device.get("pc_name")
+                "pc_name": device.get("pc_name"),
+                "device_token": device_tokens.issue(device)
             })
         else:
             return jsonify({
@@ -121,38 +225,93 @@ def heartbeat():
     # Note: pc_name, city, lab_name, cpu_score will be updated ONLY if bound
     
     if not hid:
+        HEARTBEATS.inc("invalid")
         return jsonify({"error": "Missing Hardware ID"}), 400
 
     now_dt = datetime.utcnow()
     now_iso = now_dt.isoformat() + "Z"
 
+    # 0. Admission: over-eager agents get a cheap ack, overload gets a retry hint (no DB work either way)
+    decision, retry_after = admission.admit("heartbeat", hid)
+    if decision == "limited":
+        HEARTBEATS.inc("limited")
+        return jsonify({
+            "status": "throttled",
+            "hardware_id": hid,
+            "server_time": now_iso,
+            "retry_after": retry_after,
+            "next_interval_seconds": max(retry_after, cadence.next_interval(idle=False)),
+            "remote_action": actions.next_for_heartbeat(hid)
+        }), 200, {"Retry-After": str(retry_after)}
+    if decision == "shed":
+        HEARTBEATS.inc("shed")
+        return jsonify({"status": "shed", "hardware_id": hid, "retry_after": retry_after}), \
+            503, {"Retry-After": str(retry_after)}
+
     try:
-        # 1. Check if this machine is bound to any System ID
-        res = extensions.supabase.table("devices").select("*").eq("hardware_id", hid).execute()
+        # 1. Identity: a valid device token names the System ID and the last
+        # written row is usually cached, so no lookup at all. Otherwise check
+        # whether this machine is bound to any System ID
+        # (skipped while the backend is degraded, the lookup would only stall)
+        claims = device_tokens.verify(_presented_token(data), hid)
+        device = device_state.get(claims["sid"]) if claims else None
+        from_cache = device is not None
+        res = None
+        if device is None and not spool.is_degraded():
+            try:
+                if claims:
+                    res = extensions.supabase.table("devices").select("*")\
+                        .eq("system_id", claims["sid"]).eq("hardware_id", hid).execute()
+                else:
+                    res = extensions.supabase.table("devices").select("*").eq("hardware_id", hid).execute()
+            except Exception as e:
+                logger.error(f"Heartbeat Lookup Failed for {hid}: {e}")
+                spool.mark_degraded(f"devices lookup: {e}")
+
+        if device is None and res is None:
+            # Backend unavailable: keep presence in the local spool, keyed by hardware_id
+            spool.spool("devices", "update", {
+                "last_seen": now_iso,
+                "today_last_active": data.get("last_active") or now_iso,
+                "status": data.get("status", "online")
+            }, match={"hardware_id": hid})
+            HEARTBEATS.inc("spooled")
+            return jsonify({
+                "status": "spooled",
+                "hardware_id": hid,
+                "server_time": now_iso,
+                "next_interval_seconds": cadence.next_interval(idle=False),
+                "remote_action": actions.next_for_heartbeat(hid)
+            })
         
-        if not res.data:
+        if device is None and not res.data:
             # --- DISCOVERY LOGIC ---
             logger.warning(f"🕵️ DISCOVERY: Unregistered Heartbeat from {hid} (PC: {data.get('pc_name')})")
             
             # Save this unknown device to cache so Dashboard can find it
-            discovery_cache[hid] = {
+            discovery_cache.set(hid, {
                 "pc_name": data.get("pc_name") or f"Unknown-{hid[:8]}",
                 "last_seen": now_iso
-            }
+            })
             
             # Machine is NOT bound. Agent must call /bind first.
+            HEARTBEATS.inc("unregistered")
             return jsonify({
                 "status": "unregistered",
                 "message": "Discovery broadcast active. Link your PC in the Dashboard.",
                 "hardware_id": hid,
+                # Nothing to report until bound; discovery only needs an occasional beat
+                "next_interval_seconds": cadence.next_interval(idle=True),
                 # Include local trigger check even for unregistered
-                "remote_action": trigger_cache.pop(hid, None)
+                "remote_action": actions.next_for_heartbeat(hid)
             })
 
         # Machine is bound, remove from discovery
         discovery_cache.pop(hid, None)
 
-        device = res.data[0]
+        if device is None:
+            device = res.data[0]
+            device_state.loaded(device)
         sys_id = device["system_id"]
         
         # Agent provided times
@@ -189,7 +348,7 @@ def heartbeat():
         # Filter out background noise and cast to int, but PRESERVE special telemetry keys
         filtered_usage = {}
         for app, val in incoming_usage.items():
-            if any(noise in app.lower() for noise in ["python", "antigravity", "lab_systems_agent"]):
+            if app_catalogue.catalogue.flags_of(app) & app_catalogue.AGENT_NOISE:
                 continue
             
             try:
@@ -225,7 +384,7 @@ def heartbeat():
                         "app_usage": device.get("app_usage", {})
                     }
                     # FIX: Use on_conflict to prevent 409 errors
-                    extensions.supabase.table("device_daily_history").upsert(history_data, on_conflict="device_id,history_date").execute()
+                    spool.write("device_daily_history", "upsert", history_data, on_conflict="device_id,history_date")
                     
                     # New day starts now
                     update_data["today_start_time"] = agent_start or now_iso
@@ -241,17 +400,21 @@ def heartbeat():
         
         # --- SESSION TRACKING ---
         previous_status = device.get("status")
+        if from_cache and last_seen_str and \
+                (now_dt - datetime.fromisoformat(last_seen_str.replace('Z', '+00:00')).replace(tzinfo=None)).total_seconds() > 60:
+            # The offline sweep (jobs.mark_offline_devices) has flipped it since our write
+            previous_status = "offline"
         is_now_online = update_data["status"] == "online"
         
         # 1. Check if we need to start a session (Transition OR First of the day)
+        today_utc = now_dt.date().isoformat()
         should_start_session = False
         if is_now_online:
             if previous_status == "offline":
                 should_start_session = True
-            else:
+            elif not device_state.session_known(sys_id, today_utc):
                 # Even if already online, check if any session exists for TODAY (UTC)
                 try:
-                    today_utc = now_dt.date().isoformat()
                     check_session = extensions.supabase.table("device_sessions")\
                         .select("id", count='exact')\
                         .eq("device_id", sys_id)\
@@ -259,27 +422,48 @@ def heartbeat():
                         .execute()
                     if check_session.count == 0:
                         should_start_session = True
+                    else:
+                        device_state.mark_session(sys_id, today_utc)
                 except: pass
 
         if should_start_session:
             try:
-                extensions.supabase.table("device_sessions").insert({
+                spool.write("device_sessions", "insert", {
                     "device_id": sys_id,
                     "city": city,
                     "tehsil": tehsil,
                     "lab_name": lab_name,
                     "avg_score": cpu_score,
                     "start_time": now_iso
-                }).execute()
+                }, dedupe_on="device_id,start_time")
+                device_state.mark_session(sys_id, today_utc)
             except Exception as e:
                 logger.error(f"Session Start Error: {e}")
 
-        logger.info(f"DEBUG: Heartbeat Update Payload for {sys_id}: {update_data}")
-        extensions.supabase.table("devices").update(update_data).eq("system_id", sys_id).execute()
+        # 2. Persist: the whole row only when something meaningful changed (or it
+        # is due), otherwise just last_seen through the batched touch flush
+        full_write = should_start_session or device_state.needs_full_write(sys_id, device, update_data, previous_status)
+        if full_write:
+            logger.debug("Heartbeat update payload for %s: %s", sys_id, update_data)
+            spool.write("devices", "update", update_data, match={"system_id": sys_id})
+            device_state.written(sys_id, {**device, **update_data})
+            # No-op unless the agent moved itself to another city / tehsil / lab
+            registry.apply([{**device, **update_data}])
+        else:
+            device_state.touch(sys_id, now_iso)
         
+        # Live viewers: coalesced SSE deltas (/api/stream)
+        events.publish_device(sys_id, {**device, **update_data}, {
+            "status": update_data["status"],
+            "last_seen": now_iso,
+            "cpu_score": update_data["cpu_score"],
+            "runtime_minutes": update_data["runtime_minutes"],
+            "app_usage": filtered_usage,
+        })
+
         # Broadcast real-time update to dashboard
         try:
-            extensions.socketio.emit('device_update', {
+            events.broadcast('device_update', {
                 'system_id': sys_id,
                 'status': update_data['status'],
                 'cpu_score': update_data['cpu_score'],
@@ -290,13 +474,15 @@ def heartbeat():
 
 
         # ASYNC LOGGING: Move heavy db work to background thread
-        if incoming_usage:
+        # (usage is cumulative per day, so it rides along with full writes)
+        if incoming_usage and full_write:
             threading.Thread(
                 target=process_app_logs_background, 
                 args=(sys_id, now_dt.date().isoformat(), incoming_usage), 
                 daemon=True
             ).start()
 
+        HEARTBEATS.inc("ok")
         return jsonify({
             "status": "ok", 
             "system_id": sys_id, 
@@ -304,12 +490,16 @@ def heartbeat():
             "tehsil": device.get("tehsil"),
             "lab_name": device.get("lab_name"),
             "server_time": now_iso,
-            "remote_action": trigger_cache.pop(hid, None) # "start", "stop", "install", etc.
+            "next_interval_seconds": cadence.next_interval(
+                idle=cadence.usage_unchanged(device.get("app_usage"), filtered_usage)),
+            "remote_action": actions.next_for_heartbeat(hid), # "start", "stop", "install", etc.
+            "device_token": device_tokens.issue(device) if not claims or device_tokens.needs_refresh(claims) else None
         })
 
 
     except Exception as e:
         logger.error(f"Fatal in Heartbeat: {e}")
+        HEARTBEATS.inc("error")
         return jsonify({"error": str(e)}), 500
 
 @agent_bp.route("/available-systems", methods=["GET"])
@@ -321,85 +511,118 @@ def get_available_systems():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Upper bound on days accepted in one catch-up call (a year + slack)
+MAX_SYNC_DAYS = 400
+
+def _merge_history_record(sys_id, day, existing):
+    """Build the device_daily_history row for one offline day, merged with what is stored."""
+    # ENSURE TYPES: runtime_minutes must be an integer for DB integrity
+    try:
+        runtime_raw = day.get("runtime_minutes", 0)
+        runtime_mins = int(float(runtime_raw)) # Handle string "38.0" or float 38.0
+    except:
+        runtime_mins = 0
+
+    incoming_usage = day.get("app_usage") or {}
+    history_record = {
+        "device_id": sys_id,
+        "history_date": day.get("date"),
+        "avg_score": day.get("cpu_score", 0),
+        "runtime_minutes": runtime_mins,
+        "start_time": day.get("start_time"),
+        "end_time": day.get("end_time"),
+        "city": day.get("city"),
+        "tehsil": day.get("tehsil"),
+        "lab_name": day.get("lab_name"),
+        "app_usage": incoming_usage
+    }
+
+    if existing:
+        existing_usage = dict(existing.get("app_usage") or {})
+        
+        # Merge usage maps
+        for app, sec in incoming_usage.items():
+            existing_usage[app] = existing_usage.get(app, 0) + sec
+        
+        history_record["app_usage"] = existing_usage
+        # AUTHORITATIVE: Use the higher value, don't SUM (prevents geometric growth)
+        history_record["runtime_minutes"] = max(int(existing.get("runtime_minutes") or 0), runtime_mins)
+        # Simple average for score
+        history_record["avg_score"] = (float(existing.get("avg_score") or 0) + float(day.get("cpu_score", 0))) / 2
+        
+        # Merge Times: Keep earliest start and latest end
+        if existing.get("start_time") and history_record.get("start_time"):
+            history_record["start_time"] = min(existing["start_time"], history_record["start_time"])
+        elif existing.get("start_time"):
+            history_record["start_time"] = existing["start_time"]
+
+        if existing.get("end_time") and history_record.get("end_time"):
+            history_record["end_time"] = max(existing["end_time"], history_record["end_time"])
+        elif existing.get("end_time"):
+            history_record["end_time"] = existing["end_time"]
+
+    return history_record
+
 @agent_bp.route("/sync-offline-data", methods=["POST"])
 def sync_offline_data():
     """
     Professional Offline Sync:
     Accepts historical data from agents that were offline.
     Upserts into device_daily_history for the specific date.
+
+    Batch mode: {"system_id": ..., "records": [{"date": ..., ...}, ...]}
+    merges a whole catch-up window in 1 read + 1 upsert + 1 usage-log write.
     """
     data = request.get_json(force=True)
     sys_id = data.get("system_id")
-    date_str = data.get("date") # YYYY-MM-DD
+    is_batch = isinstance(data.get("records"), list)
+    days = data["records"] if is_batch else [data]
     
-    if not sys_id or not date_str:
+    if not sys_id or not days or any(not isinstance(d, dict) or not d.get("date") for d in days):
         return jsonify({"error": "Missing system_id or date"}), 400
+    if len(days) > MAX_SYNC_DAYS:
+        return jsonify({"error": f"Too many records (max {MAX_SYNC_DAYS} per call)"}), 400
         
     try:
-        # Prepare historical record
-        # ENSURE TYPES: runtime_minutes must be an integer for DB integrity
-        try:
-            runtime_raw = data.get("runtime_minutes", 0)
-            runtime_mins = int(float(runtime_raw)) # Handle string "38.0" or float 38.0
-        except:
-            runtime_mins = 0
-
-        history_record = {
-            "device_id": sys_id,
-            "history_date": date_str,
-            "avg_score": data.get("cpu_score", 0),
-            "runtime_minutes": runtime_mins,
-            "start_time": data.get("start_time"),
-            "end_time": data.get("end_time"),
-            "city": data.get("city"),
-            "tehsil": data.get("tehsil"),
-            "lab_name": data.get("lab_name"),
-            "app_usage": data.get("app_usage", {})
-        }
-        
-        incoming_usage = data.get("app_usage", {})
+        dates = sorted({d["date"] for d in days}) # YYYY-MM-DD
         
-        # Merging Logic: Check if row already exists and merge app_usage
+        # Merging Logic: ONE read for every day in the batch
         check_res = extensions.supabase.table("device_daily_history") \
-            .select("app_usage, runtime_minutes, avg_score") \
+            .select("history_date, app_usage, runtime_minutes, avg_score, start_time, end_time") \
             .eq("device_id", sys_id) \
-            .eq("history_date", date_str) \
+            .in_("history_date", dates) \
             .execute()
+        merged = {row["history_date"]: row for row in (check_res.data or [])}
         
-        if check_res.data:
-            existing = check_res.data[0]
-            existing_usage = existing.get("app_usage") or {}
+        usage_by_date = {}
+        for day in days:
+            date_str = day["date"]
+            # Same date twice in one batch merges onto the previous entry
+            merged[date_str] = _merge_history_record(sys_id, day, merged.get(date_str))
             
-            # Merge usage maps
-            for app, sec in incoming_usage.items():
-                existing_usage[app] = existing_usage.get(app, 0) + sec
-            
-            history_record["app_usage"] = existing_usage
-            # AUTHORITATIVE: Use the higher value, don't SUM (prevents geometric growth)
-            history_record["runtime_minutes"] = max(int(existing.get("runtime_minutes", 0)), runtime_mins)
-            # Simple average for score
-            history_record["avg_score"] = (float(existing.get("avg_score", 0)) + float(data.get("cpu_score", 0))) / 2
-            
-            # Merge Times: Keep earliest start and latest end
-            if existing.get("start_time") and history_record.get("start_time"):
-                history_record["start_time"] = min(existing["start_time"], history_record["start_time"])
-            elif existing.get("start_time"):
-                history_record["start_time"] = existing["start_time"]
-
-            if existing.get("end_time") and history_record.get("end_time"):
-                history_record["end_time"] = max(existing["end_time"], history_record["end_time"])
-            elif existing.get("end_time"):
-                history_record["end_time"] = existing["end_time"]
-
-        # Upsert: If data for this day already exists, we update it
-        extensions.supabase.table("device_daily_history").upsert(history_record, on_conflict="device_id,history_date").execute()
+            incoming_usage = day.get("app_usage") or {}
+            if incoming_usage:
+                day_usage = usage_by_date.setdefault(date_str, {})
+                for app, sec in incoming_usage.items():
+                    day_usage[app] = day_usage.get(app, 0) + sec
+
+        history_records = [merged[d] for d in dates]
+
+        # Upsert: If data for these days already exists, we update it (single bulk request)
+        spool.write("device_daily_history", "upsert", history_records, on_conflict="device_id,history_date")
         
         # Background Log Sync (Batch)
-        if incoming_usage:
-            threading.Thread(target=process_app_logs_background, args=(sys_id, date_str, incoming_usage), daemon=True).start()
-
-        logger.info(f"💾 Offline Sync Successful (Merged) for {sys_id} on {date_str}")
-        return jsonify({"status": "synced", "merged": True, "date": date_str})
+        if usage_by_date:
+            threading.Thread(target=process_app_logs_batch_background, args=(sys_id, usage_by_date), daemon=True).start()
+
+        logger.info(f"💾 Offline Sync Successful (Merged) for {sys_id}: {len(dates)} day(s) {dates[0]}..{dates[-1]}")
+        if not is_batch:
+            return jsonify({"status": "synced", "merged": True, "date": dates[0]})
+        return jsonify({"status": "synced", "merged": True, "dates": dates, "count": len(dates)})
+    except spool.WriteRejected as e:
+        # Bad date, unknown system_id, ...: the agent has to fix the payload, not retry it
+        logger.warning(f"Offline Sync Rejected for {sys_id}: {e}")
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         logger.error(f"Offline Sync Error: {e}")
         return jsonify({"error": str(e)}), 500
@@ -522,65 +745,17 @@ def bind_system():
         device_info = res.data[0] if res.data else {}
         
         # 3. Bind it
-        extensions.supabase.table("devices").update({"hardware_id": hid}).eq("system_id", sys_id).execute()
+        bound = extensions.supabase.table("devices").update({"hardware_id": hid}).eq("system_id", sys_id).execute()
+        registry.apply(bound.data)
+        device_tokens.revoke(system_id=sys_id, hardware_id=hid)
         logger.info(f"🔗 Bound Machine {hid} to {sys_id}")
         return jsonify({
             "status": "success", 
             "system_id": sys_id, 
             "city": device_info.get("city"), 
             "tehsil": device_info.get("tehsil"), 
-            "lab_name": device_info.get("lab_name")
+            "lab_name": device_info.get("lab_name"),
+            "device_token": device_tokens.issue({**device_info, "system_id": sys_id, "hardware_id": hid})
         })
     except Exception as e:
         return jsonify({"error": str(e)}), 500
-
-def monitor_tasks():
-    logger.info("📡 Background Monitor Thread Started.")
-    while True:
-        try:
-            now = datetime.utcnow()
-            
-            # 1. Mark offline if not seen for > 60 seconds
-            threshold = now - timedelta(seconds=60)
-            threshold_iso = threshold.isoformat() + "Z"
-            
-            # Update devices where last_seen < threshold and status is online
-            extensions.supabase.table("devices")\
-                .update({"status": "offline"})\
-                .eq("status", "online")\
-                .lt("last_seen", threshold_iso)\
-                .execute()
-
-            # 2. Daily Cleanup: Delete heartbeats/sessions older than 24h
-            # This keeps DB light while preserving Summaries in History
-            cleanup_limit = now - timedelta(days=1)
-            cleanup_iso = cleanup_limit.isoformat() + "Z"
-            cleanup_date = cleanup_limit.date().isoformat()
-
-            # A. Delete transient sessions (24h)
-            extensions.supabase.table("device_sessions")\
-                .delete()\
-                .lt("start_time", cleanup_iso)\
-                .execute()
-            
-            # B. Delete granular app usage (24h - already archived to history at midnight)
-            extensions.supabase.table("app_usage_logs")\
-                .delete()\
-                .lt("date", cleanup_date)\
-                .execute()
-
-            # 3. History Cleanup: Removed as per USER request (Keep data permanently)
-            # history_keep_limit = (now - timedelta(days=6)).date().isoformat()
-            # extensions.supabase.table("device_daily_history")\
-            #     .delete()\
-            #     .lt("history_date", history_keep_limit)\
-            #     .execute()
-
-        except Exception as e:
-            logger.error(f"Error in Background Tasks: {e}")
-        
-        time.sleep(60) # Run check every 60 seconds
-
-# Start the background tasks thread
-monitor_thread = threading.Thread(target=monitor_tasks, daemon=True)
-monitor_thread.start()
@@ -1,10 +1,18 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request, stream_with_context
 from datetime import datetime, timedelta, timezone
+from itertools import chain
+import time
 import app.extensions as extensions
+from app.services import device_tokens, history_export
+from app.services.registry import registry, fetch_rows, scope_name
 from app.utils.logger import logger
 
 devices_bp = Blueprint("devices", __name__)
 
+@devices_bp.record_once
+def _configure_export(state):
+    history_export.configure_export(state.app.config)
+
 @devices_bp.route("/devices", methods=["GET", "POST"])
 def manage_devices():
     if request.method == "POST":
@@ -46,6 +54,7 @@ def manage_devices():
                 if sid and sid != target_sid:
                     logger.info(f"🔄 RE-ASSIGNING System ID for {hid} from {target_sid} to {sid}")
                     res = extensions.supabase.table("devices").update({**payload, "system_id": sid, "hardware_id": hid}).eq("system_id", target_sid).execute()
+                    registry.discard([target_sid])
                 else:
                     res = extensions.supabase.table("devices").update(payload).eq("system_id", target_sid).execute()
             else:
@@ -60,6 +69,11 @@ def manage_devices():
                     logger.info(f"Registering brand new Machine: {pc_name} (ID: {sid})")
                     res = extensions.supabase.table("devices").insert({**payload, "system_id": sid, "hardware_id": hid}).execute()
 
+            registry.apply(res.data)
+            # Whatever was bound to this slot or this machine before is no longer valid
+            device_tokens.revoke(system_id=sid, hardware_id=hid)
+            if hwid_check.data:
+                device_tokens.revoke(system_id=hwid_check.data[0]["system_id"])
             return jsonify({"status": "success", "device": res.data[0] if res.data else None})
         except Exception as e:
             logger.error(f"Registration Error: {e}")
@@ -79,17 +93,18 @@ def manage_devices():
             extensions.supabase.table("devices").update({"status": "offline"}).eq("status", "online").lt("last_seen", stale_threshold_db.isoformat()).execute()
         except: pass
 
-        query = extensions.supabase.table("devices").select("*")
-        if city_filter:
-            query = query.ilike("city", city_filter)
+        if (city_filter or lab_filter) and registry.is_warm():
+            # Straight from the hierarchy index to the rows in scope
+            raw_rows = fetch_rows(registry.scope_ids(city=city_filter, lab=lab_filter, exact=False))
+        else:
+            query = extensions.supabase.table("devices").select("*")
+            if city_filter:
+                query = query.ilike("city", city_filter)
+            res = query.limit(5000).execute()
+            raw_rows = res.data if res.data else []
         
-        res = query.limit(5000).execute()
-        raw_rows = res.data if res.data else []
-        
-        import re
-        def normalize(name):
-            if not name: return ""
-            return re.sub(r'[^a-z0-9]', '', str(name).lower())
+        # Same loose match the hierarchy index is keyed by ("Lab-1" == "lab 1")
+        normalize = scope_name
 
         target_city = normalize(city_filter) if city_filter else None
         target_lab = normalize(lab_filter) if lab_filter else None
@@ -195,6 +210,8 @@ def update_device(hid):
             "lab_name": data.get("lab_name"),
             "tehsil": data.get("tehsil")
         }).eq("system_id", hid).execute()
+        registry.apply(res.data)
+        device_tokens.revoke(system_id=hid)
         
         return jsonify({"status": "updated", "device": res.data[0]})
     except Exception as e:
@@ -202,3 +219,45 @@ def update_device(hid):
         return jsonify({"error": str(e)}), 500
 
 
+
+@devices_bp.route("/export/history", methods=["GET"])
+def export_history():
+    """
+    Stream device_daily_history for a date range (monthly/yearly reporting).
+    ?from=YYYY-MM-DD&to=YYYY-MM-DD&scope=CITY[/TEHSIL[/LAB]]&format=csv|ndjson
+    """
+    fmt = (request.args.get("format") or "csv").lower()
+    if fmt not in history_export.FORMATS:
+        return jsonify({"error": f"format must be one of {sorted(history_export.FORMATS)}"}), 400
+    try:
+        start, end = history_export.parse_range(request.args.get("from"), request.args.get("to"))
+        scope = history_export.parse_scope(request.args.get("scope"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    pages = history_export.iter_pages(start, end, scope)
+    try:
+        # Fetch the first page up front: a backend failure is still a clean 500
+        first = next(pages, [])
+    except Exception as e:
+        logger.error(f"Export Error: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    mimetype, encode = history_export.FORMATS[fmt]
+    label = f"{start.isoformat()} .. {end.isoformat()} scope={scope or 'all'}"
+
+    def generate():
+        started = time.monotonic()
+        try:
+            yield from encode(chain([first] if first else [], pages))
+        except Exception as e:
+            # Headers are gone: abort so the client sees a truncated transfer, not a short file
+            logger.error(f"Export of {label} aborted: {e}")
+            raise
+        logger.info(f"📤 Exported history {label} as {fmt} in {time.monotonic() - started:.1f}s")
+
+    filename = f"history_{start.isoformat()}_{end.isoformat()}.{fmt}"
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers={
+        "Content-Disposition": f"attachment; filename={filename}",
+        "X-Accel-Buffering": "no",
+    })
@@ -0,0 +1,54 @@
+from flask import Blueprint, Response, request, g, current_app, jsonify
+import hmac
+import threading
+import time
+from app.utils import metrics
+from app.utils.load_signals import heartbeat_latency
+
+# Prometheus scrape endpoint, served at the root (/metrics), not under /api
+metrics_bp = Blueprint("metrics", __name__)
+
+HTTP_REQUESTS = metrics.counter(
+    "lab_http_requests_total", "HTTP requests by blueprint, route, method and status.",
+    ("blueprint", "route", "method", "status"))
+HTTP_LATENCY = metrics.histogram(
+    "lab_http_request_duration_seconds", "HTTP request latency by blueprint and route.",
+    ("blueprint", "route", "method"))
+
+@metrics.register_collector
+def _collect_threads():
+    return [
+        "# HELP lab_threads_active Live threads (greenlets under gevent) incl. background work.",
+        "# TYPE lab_threads_active gauge",
+        f"lab_threads_active {threading.active_count()}",
+    ]
+
+def _start_timer():
+    g.metrics_started = time.perf_counter()
+
+def _observe_request(response):
+    started = g.pop("metrics_started", None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    blueprint = request.blueprint or "app"
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    HTTP_REQUESTS.inc(blueprint, route, request.method, response.status_code)
+    HTTP_LATENCY.observe(elapsed, blueprint, route, request.method)
+    # Feeds the load signal background jobs use to back off
+    if request.endpoint == "agent.heartbeat":
+        heartbeat_latency.observe(elapsed)
+    return response
+
+def init_metrics(app):
+    """Time every request (all blueprints) for /metrics."""
+    app.before_request(_start_timer)
+    app.after_request(_observe_request)
+
+@metrics_bp.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    token = current_app.config.get("METRICS_TOKEN")
+    supplied = request.headers.get("Authorization", "")
+    if token and not hmac.compare_digest(supplied.encode(), f"Bearer {token}".encode()):
+        return jsonify({"error": "Unauthorized"}), 401
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
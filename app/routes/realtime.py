@@ -1,8 +1,99 @@
-from flask import Blueprint
+from flask import Blueprint, Response, request, current_app, jsonify, stream_with_context
+import json
+import threading
+from app.extensions import socketio
+from app.services.events import bus, Scope
+from app.utils import metrics
 from app.utils.logger import logger
 
 # WebSocket presence is disabled as per user request (switched to heartbeat polling)
 realtime_bp = Blueprint("realtime", __name__)
 
-# This file is kept to maintain the Blueprint import in __init__.py
-# but no longer contains Socket.IO logic for device status.
+# Dashboards still connect to receive 'device_update' broadcasts; count them.
+SOCKET_CLIENTS = metrics.gauge("lab_socketio_clients", "Connected Socket.IO clients.")
+STREAM_CLIENTS = metrics.gauge("lab_stream_clients", "Connected SSE (/api/stream) clients.")
+_clients_lock = threading.Lock()  # the STREAM_MAX_CLIENTS check and the increment are one step
+
+@socketio.on("connect")
+def _on_connect(*args):
+    SOCKET_CLIENTS.inc()
+
+@socketio.on("disconnect")
+def _on_disconnect(*args):
+    SOCKET_CLIENTS.dec()
+
+def _arg_list(name):
+    return [v.strip() for raw in request.args.getlist(name) for v in raw.split(",") if v.strip()]
+
+def _event(event, data, event_id=None):
+    head = f"id: {event_id}\n" if event_id else ""
+    return f"{head}event: {event}\ndata: {data}\n\n"
+
+@realtime_bp.route("/stream", methods=["GET"])
+def stream():
+    """
+    Read-only live device updates as Server-Sent Events.
+
+    Scope with ?city=, ?tehsil=, ?lab=, ?device= (system_id), comma lists allowed.
+    Each `devices` event is a JSON array of per-device deltas (only fields that
+    changed since the previous frame). Reconnects resume from Last-Event-ID;
+    a `reset` event means the gap can't be replayed and the client should
+    refetch a snapshot over REST (also sent when a slow client falls behind
+    the resume buffer).
+    """
+    cfg = current_app.config
+    with _clients_lock:
+        if STREAM_CLIENTS.get() >= cfg["STREAM_MAX_CLIENTS"]:
+            return jsonify({"error": "Too many stream clients"}), 503, {"Retry-After": "30"}
+        STREAM_CLIENTS.inc()
+
+    scope = Scope(_arg_list("city"), _arg_list("tehsil"), _arg_list("lab"), _arg_list("device"))
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    keepalive = cfg["STREAM_KEEPALIVE_SECONDS"]
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            cursor = bus.seq
+            missed = bus.since(last_event_id) if last_event_id else None
+            if last_event_id and missed is None:
+                yield _event("reset", "{}", bus.last_id)
+            elif missed:
+                for frame in missed:
+                    cursor = frame.seq
+                    payload = frame.render(scope)
+                    if payload:
+                        yield _event("devices", payload, frame.id)
+            elif not last_event_id:
+                yield _event("hello", json.dumps({"scope": {
+                    "city": sorted(scope.cities), "tehsil": sorted(scope.tehsils),
+                    "lab": sorted(scope.labs), "device": sorted(scope.devices)}}), bus.last_id)
+
+            while True:
+                frames = bus.wait(cursor, keepalive)
+                if frames is None:
+                    # Frames we never sent are gone: start over from a snapshot
+                    cursor = bus.seq
+                    yield _event("reset", "{}", f"{bus.epoch}-{cursor}")
+                    continue
+                if not frames:
+                    # Comment line: keeps proxies from idling us out, detects dead clients
+                    yield ": ping\n\n"
+                    continue
+                for frame in frames:
+                    cursor = frame.seq
+                    payload = frame.render(scope)
+                    if payload:
+                        yield _event("devices", payload, frame.id)
+        except GeneratorExit:
+            pass
+        except Exception as e:
+            logger.error(f"📡 Stream error: {e}")
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+    # Runs even if the client leaves before the first chunk (the generator never starts)
+    response.call_on_close(STREAM_CLIENTS.dec)
+    return response
@@ -1,13 +1,40 @@
 from flask import Blueprint, jsonify, request
 import app.extensions as extensions
 from app.utils.logger import logger
+from app.utils.db_client import get_transport_stats
+from app.services.spool import get_spool_stats
+from app.services.retention import get_retention_stats
+from app.services.scheduler import get_job_stats
+from app.services import aggregation, health, device_tokens, reports
+from app.services.registry import registry, fetch_rows
 from datetime import datetime
 
 stats_bp = Blueprint("stats", __name__)
 
 @stats_bp.route("/health", methods=["GET"])
 def health_check():
-    return jsonify({"status": "ok", "database": "connected"})
+    """Liveness plus the last sampled database state; never queries the database."""
+    return jsonify({"status": "ok", "database": health.database_state()})
+
+@stats_bp.route("/stats/transport", methods=["GET"])
+def transport_stats():
+    """Supabase pool usage: round trips, latency histograms, reuse and saturation."""
+    return jsonify(get_transport_stats())
+
+@stats_bp.route("/stats/spool", methods=["GET"])
+def spool_stats():
+    """Local write spool: pending bytes, drops and replay rate."""
+    return jsonify(get_spool_stats())
+
+@stats_bp.route("/stats/retention", methods=["GET"])
+def retention_stats():
+    """Retention pruning: rows pruned, time spent and throttling per run."""
+    return jsonify(get_retention_stats())
+
+@stats_bp.route("/stats/jobs", methods=["GET"])
+def job_stats():
+    """Background jobs: last run, duration, failures and skipped overlaps."""
+    return jsonify(get_job_stats())
 
 @stats_bp.route("/stats/locations", methods=["GET"])
 def get_location_stats():
@@ -36,76 +63,10 @@ def get_location_stats():
             logger.error(f"DB Fetch Error in Stats: {e}")
             return jsonify({"error": str(e), "locations": []}), 500
         
-        threshold = now - timedelta(seconds=60)
-        
-        city_map = {}
-        registered_count = 0
+        result = aggregation.location_stats(raw_devices, now)
         
-        for d in raw_devices:
-            # PROFESSIONAL: Count ALL inventory slots (both registered and placeholders)
-            registered_count += 1
-            city = (d.get("city") or "Unknown").strip()
-            # If user has renamed city to something else as well, we just use whatever is in 'city' column
-            lab = (d.get("lab_name") or "Main Lab").strip()
-            cpu = float(d.get("cpu_score") or 0)
-            
-            if city not in city_map:
-                city_map[city] = {
-                    "city": city, 
-                    "total_pcs": 0, 
-                    "online": 0, 
-                    "offline": 0,
-                    "labs": set(),
-                    "tehsils": set(),
-                    "online_labs_set": set(),
-                    "total_cpu": 0,
-                    "online_count_for_cpu": 0
-                }
-            
-            target = city_map[city]
-            target["total_pcs"] += 1
-            target["labs"].add(lab)
-            teh = (d.get("tehsil") or "Unknown").strip()
-            if teh:
-                target["tehsils"].add(teh)
-            
-            is_online = False
-            if d.get("status") == "online" and d.get("last_seen"):
-                try:
-                    ls_dt = datetime.fromisoformat(d["last_seen"].replace('Z', '+00:00'))
-                    if ls_dt > threshold:
-                        is_online = True
-                except: pass
-            
-            if is_online:
-                target["online"] += 1
-                target["online_labs_set"].add(lab)
-                target["total_cpu"] += cpu
-                target["online_count_for_cpu"] += 1
-            else:
-                target["offline"] += 1
-        
-        logger.info(f"Location Stats: Processed {registered_count} nodes into {len(city_map)} cities.")
+        logger.info(f"Location Stats: Processed {len(raw_devices)} nodes into {len(result)} cities.")
 
-        # Format for frontend
-        result = []
-        for city, data in city_map.items():
-            avg_perf = 0
-            if data["total_pcs"] > 0:
-                avg_perf = data["total_cpu"] / data["total_pcs"]
-            
-            result.append({
-                "city": city,
-                "total_pcs": data["total_pcs"],
-                "online": data["online"],
-                "offline": data["offline"],
-                "total_labs": len(data["labs"]),
-                "total_tehsils": len(data["tehsils"]),
-                "online_labs": len(data["online_labs_set"]),
-                "offline_labs": len(data["labs"]) - len(data["online_labs_set"]),
-                "avg_performance": round(avg_perf, 2)
-            })
-        
         return jsonify({
             "locations": result,
             "server_time": now.replace(tzinfo=None).isoformat() + "Z"
@@ -123,12 +84,15 @@ def get_tehsil_stats(city):
         now = datetime.now(timezone.utc)
         threshold = now - timedelta(seconds=60)
 
-        res = extensions.supabase.table("devices")\
-            .select("city, status, last_seen, lab_name, tehsil")\
-            .ilike("city", city)\
-            .limit(5000)\
-            .execute()
-        devices = res.data if res.data else []
+        if registry.is_warm():
+            devices = fetch_rows(registry.scope_ids(city=city), "city, status, last_seen, lab_name, tehsil")
+        else:
+            res = extensions.supabase.table("devices")\
+                .select("city, status, last_seen, lab_name, tehsil")\
+                .ilike("city", city)\
+                .limit(5000)\
+                .execute()
+            devices = res.data if res.data else []
         
         tehsil_map = {}
         for d in devices:
@@ -186,85 +150,21 @@ def get_lab_stats(city):
     """HIERARCHY STEP 3: Return labs, with optional tehsil filter."""
     tehsil_filter = request.args.get("tehsil")
     try:
-        # ROBUST: Filter by city first and increase limit
-        res = extensions.supabase.table("devices")\
-            .select("city, status, last_seen, lab_name, cpu_score, tehsil")\
-            .ilike("city", city)\
-            .limit(5000)\
-            .execute()
-        raw_rows = res.data if res.data else []
+        if registry.is_warm():
+            # Only the city's (or tehsil's) devices, by primary key
+            raw_rows = fetch_rows(registry.scope_ids(city=city, tehsil=tehsil_filter),
+                                  "city, status, last_seen, lab_name, cpu_score, tehsil")
+        else:
+            res = extensions.supabase.table("devices")\
+                .select("city, status, last_seen, lab_name, cpu_score, tehsil")\
+                .ilike("city", city)\
+                .limit(5000)\
+                .execute()
+            raw_rows = res.data if res.data else []
         
-        from datetime import datetime, timedelta, timezone
+        from datetime import datetime, timezone
         now = datetime.now(timezone.utc)
-        threshold = now - timedelta(seconds=60)
-        
-        # LOGICAL FILTERING & AGGREGATION
-        def normalize_name(name):
-            if not name: return "UNKNOWN"
-            return str(name).strip().upper()
-
-        lab_map = {}
-        target_city = city.strip().upper()
-        target_tehsil = tehsil_filter.strip().upper() if tehsil_filter else None
-
-        for d in raw_rows:
-            # 1. City Check
-            curr_city = normalize_name(d.get("city"))
-            if curr_city != target_city:
-                continue
-
-            # 2. Tehsil Check
-            curr_tehsil = normalize_name(d.get("tehsil"))
-            if target_tehsil and curr_tehsil != target_tehsil:
-                continue
-
-            lab = normalize_name(d.get("lab_name") or "Main Lab")
-            cpu = float(d.get("cpu_score") or 0)
-            
-            if lab not in lab_map:
-                lab_map[lab] = {
-                    "lab_name": lab, 
-                    "total_pcs": 0, 
-                    "online": 0, 
-                    "offline": 0,
-                    "total_cpu": 0,
-                    "online_count": 0,
-                    "tehsil": curr_tehsil # Store normalized tehsil
-                }
-            
-            target = lab_map[lab]
-            target["total_pcs"] += 1
-            
-            is_online = False
-            if d.get("status") == "online" and d.get("last_seen"):
-                try:
-                    ls_dt = datetime.fromisoformat(d["last_seen"].replace('Z', '+00:00'))
-                    if ls_dt > threshold:
-                        is_online = True
-                except: pass
-            
-            if is_online:
-                target["online"] += 1
-                target["total_cpu"] += cpu
-                target["online_count"] += 1
-            else:
-                target["offline"] += 1
-        
-        # Calculate averages based on TOTAL PCs in lab
-        result = []
-        for lab, data in lab_map.items():
-            avg_perf = 0
-            if data["total_pcs"] > 0:
-                avg_perf = data["total_cpu"] / data["total_pcs"]
-            
-            result.append({
-                "lab_name": lab,
-                "total_pcs": data["total_pcs"],
-                "online": data["online"],
-                "offline": data["offline"],
-                "avg_performance": round(avg_perf, 2),
-                "tehsil": data.get("tehsil", "UNKNOWN")
-            })
+        result = aggregation.city_lab_stats(raw_rows, city, tehsil_filter, now)
             
         return jsonify({
             "labs": result,
@@ -403,7 +303,9 @@ def rename_city():
     old_name = data.get("old_name")
     new_name = data.get("new_name")
     try:
-        extensions.supabase.table("devices").update({"city": new_name}).eq("city", old_name).execute()
+        res = extensions.supabase.table("devices").update({"city": new_name}).eq("city", old_name).execute()
+        registry.apply(res.data)
+        device_tokens.revoke(city=old_name)
         return jsonify({"status": "success"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -415,7 +317,7 @@ def delete_city():
         # Instead of deleting rows, we just reset the city and hardware bindings if you prefer, 
         # or actually delete if it's the intent. The frontend prompt says "Delete city and all PCs".
         # We will reset them to 'Unknown' and unbind them to preserve the slots.
-        extensions.supabase.table("devices").update({
+        res = extensions.supabase.table("devices").update({
             "hardware_id": None,
             "status": "offline",
             "last_seen": None,
@@ -424,6 +326,8 @@ def delete_city():
             "tehsil": "Unknown",
             "lab_name": "Unknown"
         }).eq("city", city).execute()
+        registry.apply(res.data)
+        device_tokens.revoke(city=city)
         return jsonify({"status": "success"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -435,8 +339,11 @@ def rename_tehsil():
     old_name = data.get("old_name")
     new_name = data.get("new_name")
     try:
-        extensions.supabase.table("devices").update({"tehsil": new_name})\
+        res = extensions.supabase.table("devices").update({"tehsil": new_name})\
             .eq("city", city).eq("tehsil", old_name).execute()
+        registry.apply(res.data)
+        # Tokens aren't keyed by tehsil; the city covers it
+        device_tokens.revoke(city=city)
         return jsonify({"status": "success"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -448,8 +355,10 @@ def rename_lab():
     old_name = data.get("old_name")
     new_name = data.get("new_name")
     try:
-        extensions.supabase.table("devices").update({"lab_name": new_name})\
+        res = extensions.supabase.table("devices").update({"lab_name": new_name})\
             .eq("city", city).eq("lab_name", old_name).execute()
+        registry.apply(res.data)
+        device_tokens.revoke(city=city, lab=old_name)
         return jsonify({"status": "success"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -459,7 +368,7 @@ def delete_lab():
     city = request.args.get("city")
     lab = request.args.get("lab")
     try:
-        extensions.supabase.table("devices").update({
+        res = extensions.supabase.table("devices").update({
             "hardware_id": None,
             "status": "offline",
             "last_seen": None,
@@ -468,6 +377,8 @@ def delete_lab():
             "tehsil": "Unknown",
             "lab_name": "Unknown"
         }).eq("city", city).eq("lab_name", lab).execute()
+        registry.apply(res.data)
+        device_tokens.revoke(city=city, lab=lab)
         return jsonify({"status": "success"})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -478,12 +389,14 @@ def delete_device():
     if not hid: return jsonify({"error": "No HID"}), 400
     try:
         # Instead of deleting, we clear the hardware binding
-        extensions.supabase.table("devices").update({
+        res = extensions.supabase.table("devices").update({
             "hardware_id": None,
             "status": "offline",
             "last_seen": None,
             "pc_name": None
         }).eq("system_id", hid).execute()
+        registry.apply(res.data)
+        device_tokens.revoke(system_id=hid)
         return jsonify({"status": "cleared"})
     except Exception as e:
         logger.error(f"Error deleting device: {e}")
@@ -491,9 +404,8 @@ def delete_device():
 @stats_bp.route("/stats/labs/all", methods=["GET"])
 def get_all_labs_global():
     try:
-        from datetime import datetime, timezone, timedelta
+        from datetime import datetime, timezone
         now = datetime.now(timezone.utc)
-        threshold = now - timedelta(seconds=60)
 
         # Fetch registered or pre-populated slots
         res = extensions.supabase.table("devices")\
@@ -502,55 +414,7 @@ def get_all_labs_global():
             .execute()
         raw_devices = res.data if res.data else []
         
-        def normalize_name(name):
-            if not name: return "UNKNOWN"
-            return str(name).strip().upper()
-
-        lab_map = {}
-        for d in raw_devices:
-            # Get raw values
-            r_city = d.get("city") or "Unknown"
-            r_tehsil = d.get("tehsil") or "Unknown"
-            r_lab = (d.get("lab_name") or d.get("lab") or "Main Lab").strip()
-            
-            # Normalize for grouping
-            n_city = normalize_name(r_city)
-            n_tehsil = normalize_name(r_tehsil)
-            n_lab = normalize_name(r_lab)
-
-            # THE ABSOLUTE KEY: Must be unique for ONE card in the UI
-            key = f"{n_city}::{n_tehsil}::{n_lab}"
-            
-            if key not in lab_map:
-                lab_map[key] = {
-                    "lab_name": r_lab,
-                    "city": r_city,
-                    "tehsil": r_tehsil,
-                    "norm_lab": n_lab,
-                    "norm_city": n_city,
-                    "norm_tehsil": n_tehsil,
-                    "total_pcs": 0,
-                    "online": 0,
-                    "offline": 0,
-                    "system_ids": []
-                }
-            
-            target = lab_map[key]
-            target["total_pcs"] += 1
-            target["system_ids"].append(str(d.get("system_id")))
-            
-            is_online = False
-            if d.get("status") == "online" and d.get("last_seen"):
-                try:
-                    ls_dt = datetime.fromisoformat(d["last_seen"].replace('Z', '+00:00'))
-                    if ls_dt > threshold:
-                        is_online = True
-                except: pass
-            
-            if is_online:
-                target["online"] += 1
-            else:
-                target["offline"] += 1
+        lab_map = aggregation.all_labs(raw_devices, now)
         
         # LOG FOR DEBUGGING (Visible in server logs)
         for k, v in lab_map.items():
@@ -566,6 +430,34 @@ def get_all_labs_global():
         logger.error(f"Error in all labs stats: {e}")
         return jsonify({"labs": [], "error": str(e)}), 500
 
+@stats_bp.route("/reports", methods=["GET", "POST"])
+def report_jobs():
+    """
+    POST {"kind": "unused_labs", "params": {"days": 30, "scope": "CITY[/TEHSIL]"}}
+    queues a report (202 + job id); GET lists recent jobs and the known kinds.
+    """
+    if request.method == "GET":
+        return jsonify({"kinds": sorted(reports.REPORTS), "jobs": reports.recent()})
+
+    data = request.get_json(silent=True) or {}
+    kind = data.get("kind")
+    if kind not in reports.REPORTS:
+        return jsonify({"error": f"kind must be one of {sorted(reports.REPORTS)}"}), 400
+    try:
+        job, reused = reports.submit(kind, data.get("params"), refresh=bool(data.get("refresh")))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": f"invalid params: {e}"}), 400
+    except reports.QueueFull as e:
+        return jsonify({"error": str(e)}), 503, {"Retry-After": "30"}
+    return jsonify({"job_id": job["id"], "state": job["state"], "reused": reused}), 202
+
+@stats_bp.route("/reports/<job_id>", methods=["GET"])
+def report_job(job_id):
+    job = reports.get(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown or expired report job"}), 404
+    return jsonify(job)
+
 @stats_bp.route("/stats/utilization", methods=["GET"])
 def get_utilization_stats():
     """
@@ -573,8 +465,7 @@ def get_utilization_stats():
     Enhanced for extreme resilience against data inconsistencies and crashes.
     """
     try:
-        from datetime import datetime, timezone, timedelta
-        import json
+        from datetime import datetime, timezone
         now = datetime.now(timezone.utc)
         
         # 1. Fetch current device states (minimal columns for speed/safety)
@@ -585,115 +476,10 @@ def get_utilization_stats():
             logger.error(f"Utilization DB Fetch Error: {db_err}")
             return jsonify({"error": "Database connectivity issue", "today": {}, "lab_details": []}), 200 # Return 200 with empty to avoid UI crash
 
-        # Logic for "Actually Used"
-        def is_actually_used(runtime_mins, app_usage_raw):
-            try:
-                # Ensure runtime is a number
-                try: 
-                    rt = float(runtime_mins or 0)
-                except: rt = 0
-                
-                if rt < 3: return False
-                
-                # Robust app_usage parsing
-                app_usage = app_usage_raw
-                if isinstance(app_usage, str):
-                    try: app_usage = json.loads(app_usage)
-                    except: return False
-                
-                if not app_usage or not isinstance(app_usage, dict):
-                    return False
-
-                work_apps = [
-                    'chrome', 'firefox', 'msedge', 'brave', 'browser',
-                    'code', 'visual studio', 'pycharm', 'intellij', 'sublime', 'notepad++', 'anaconda', 'jupyter',
-                    'word', 'excel', 'powerpoint', 'winword', 'outlook', 'access',
-                    'vlc', 'potplayer', 'mpc', 'wmplayer',
-                    'zoom', 'teams', 'discord', 'anydesk', 'teamviewer',
-                    'photoshop', 'illustrator', 'corel', 'autocad', 'matlab',
-                    'python', 'java', 'node', 'cmd', 'powershell'
-                ]
-                blacklist = ['explorer.exe', 'taskmgr.exe', 'shellexperiencehost.exe', 'searchhost.exe', 'lockapp.exe']
-
-                total_real_usage_seconds = 0
-                for app, seconds in app_usage.items():
-                    try:
-                        app_lower = str(app).lower()
-                        if any(b in app_lower for b in blacklist): continue
-                        if any(work in app_lower for work in work_apps):
-                            total_real_usage_seconds += float(seconds or 0)
-                    except: continue
-
-                return total_real_usage_seconds > 45
-            except: 
-                return False
-
-        lab_activity = {}
-        lab_last_seen = {}
-
-        for d in devices:
-            try:
-                raw_city = (d.get('city') or 'Unknown').strip()
-                raw_tehsil = (d.get('tehsil') or 'Unknown').strip()
-                raw_lab = (d.get('lab_name') or 'Main Lab').strip()
-                key = f"{raw_city}|{raw_tehsil}|{raw_lab}"
-                
-                if key not in lab_activity:
-                    lab_activity[key] = {
-                        "city": raw_city, "lab": raw_lab, 
-                        "used": False, "idle": False, "online": 0, "total": 0,
-                        "is_stale": False, "is_ghost": False, "last_used": "Never"
-                    }
-                
-                target = lab_activity[key]
-                target["total"] += 1
-                
-                is_online = d.get("status") == "online"
-                if is_online:
-                    target["online"] += 1
-                    if is_actually_used(d.get("runtime_minutes", 0), d.get("app_usage", {})):
-                        target["used"] = True
-                    else:
-                        target["idle"] = True 
-
-                # Process last seen duration for this device
-                ls_str = d.get("last_seen")
-                if ls_str:
-                    try:
-                        ls_dt = datetime.fromisoformat(ls_str.replace('Z', '+00:00'))
-                        if key not in lab_last_seen or ls_dt > lab_last_seen[key]:
-                            lab_last_seen[key] = ls_dt
-                    except: pass
-            except: continue
-
-        # Final pass for stale/ghost logic and aggregation
-        today_stats = {"used_labs": 0, "idle_labs": 0, "offline_labs": 0}
-        one_week_unused = []
-        one_month_unused = []
-
-        for key, target in lab_activity.items():
-            # Update Today Metrics
-            if target["used"]: today_stats["used_labs"] += 1
-            elif target["online"] > 0: today_stats["idle_labs"] += 1
-            else: today_stats["offline_labs"] += 1
-
-            # Update Stale/Ghost Metrics
-            last_seen_dt = lab_last_seen.get(key)
-            if last_seen_dt:
-                target["last_used"] = last_seen_dt.date().isoformat()
-                if last_seen_dt < now - timedelta(days=30):
-                    target["is_ghost"] = True
-                    target["is_stale"] = True
-                    one_month_unused.append({"city": target["city"], "lab": target["lab"], "last_used": target["last_used"]})
-                elif last_seen_dt < now - timedelta(days=7):
-                    target["is_stale"] = True
-                    one_week_unused.append({"city": target["city"], "lab": target["lab"], "last_used": target["last_used"]})
+        summary = aggregation.utilization(devices, now)
 
         return jsonify({
-            "today": today_stats,
-            "one_week_unused": one_week_unused,
-            "one_month_unused": one_month_unused,
-            "lab_details": list(lab_activity.values()),
+            **summary,
             "server_time": now.replace(tzinfo=None).isoformat() + "Z"
         })
 
@@ -0,0 +1,527 @@
+"""
+Remote action queue (replaces the overwrite-prone trigger_cache).
+
+Every device has a FIFO of actions. Agents pick them up two ways:
+  * long-poll `GET /api/actions/poll` wakes the moment something is queued
+    for that hardware_id; delivery is at-least-once: an action handed out
+    this way stays "delivered" until the agent acks it and is handed out
+    again after ACTION_REDELIVER_SECONDS (up to ACTION_MAX_ATTEMPTS)
+  * the heartbeat's `remote_action` field, for agents that don't long-poll;
+    they can't ack, so that delivery is final
+Bulk targets (city / tehsil / lab) are resolved against the device registry
+once and fanned out as one batch sharing the same action payload.
+
+With the shared_state "sqlite" backend the queue lives in the shared
+database instead (SharedActionQueue, same interface), so a trigger queued
+through one worker reaches an agent polling another; enqueues wake the
+peers' long-polls over the shared bus.
+"""
+import json
+import threading
+import time
+import uuid
+
+from app.services import shared_state
+from app.services.registry import registry
+from app.utils import metrics
+
+ACTIONS = metrics.counter("lab_actions_total", "Remote action lifecycle events.", ("event",))
+
+settings = {
+    "ttl": 3600.0,
+    "redeliver_seconds": 60.0,
+    "max_attempts": 3,
+    "keep_finished": 3600.0,
+    "poll_max_wait": 30.0,
+}
+
+FINAL_STATES = ("acked", "failed", "expired")
+
+
+def configure_actions(config):
+    settings.update({
+        "ttl": float(config.get("ACTION_TTL", settings["ttl"])),
+        "redeliver_seconds": float(config.get("ACTION_REDELIVER_SECONDS", settings["redeliver_seconds"])),
+        "max_attempts": int(config.get("ACTION_MAX_ATTEMPTS", settings["max_attempts"])),
+        "poll_max_wait": float(config.get("ACTION_POLL_MAX_WAIT", settings["poll_max_wait"])),
+    })
+    # In-process queue, or the shared database when workers share state
+    queue.select()
+
+
+def _targets(city, tehsil, lab):
+    """hardware_ids of the bound devices in a city / tehsil / lab scope (from the hierarchy index)."""
+    rows = (registry.by_system_id(sid) for sid in registry.scope_ids(city=city, tehsil=tehsil, lab=lab))
+    return [row["hardware_id"] for row in rows if row and row.get("hardware_id")]
+
+
+class Action:
+    __slots__ = ("id", "batch_id", "hardware_id", "action", "params", "state", "created_at", "expires_at",
+                 "delivered_at", "finished_at", "attempts", "channel", "result")
+
+    def __init__(self, hardware_id, action, params, batch_id=None):
+        self.id = uuid.uuid4().hex[:16]
+        self.batch_id = batch_id
+        self.hardware_id = hardware_id
+        self.action = action
+        self.params = params
+        self.state = "queued"
+        self.created_at = time.time()
+        self.expires_at = self.created_at + settings["ttl"]
+        self.delivered_at = None
+        self.finished_at = None
+        self.attempts = 0
+        self.channel = None
+        self.result = None
+
+    @classmethod
+    def from_row(cls, row):
+        item = cls.__new__(cls)
+        for slot in cls.__slots__:
+            setattr(item, slot, row[slot])
+        item.params = json.loads(item.params) if item.params else {}
+        item.result = json.loads(item.result) if item.result else None
+        return item
+
+    def to_agent(self):
+        return {"id": self.id, "action": self.action, "params": self.params}
+
+    def as_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class ActionQueue:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._queues = {}   # {hardware_id: [action_id, ...]} in FIFO order, unfinished only
+        self._actions = {}  # {action_id: Action}
+        self._batches = {}  # {batch_id: {"action", "scope", "created_at", "ids": [...]}}
+        self._waiters = {}  # {hardware_id: [threading.Event, active polls]}
+
+    # --- producers -------------------------------------------------------
+
+    def _add(self, action):
+        self._actions[action.id] = action
+        self._queues.setdefault(action.hardware_id, []).append(action.id)
+
+    def _wake(self, hardware_ids):
+        for hid in hardware_ids:
+            waiter = self._waiters.get(hid)
+            if waiter is not None:
+                waiter[0].set()
+
+    def enqueue(self, hardware_id, action, params=None):
+        item = Action(hardware_id, action, params or {})
+        with self._lock:
+            self._add(item)
+        ACTIONS.inc("queued")
+        self._wake((hardware_id,))
+        return item
+
+    def enqueue_bulk(self, action, params=None, city=None, tehsil=None, lab=None):
+        """Queue `action` for every bound device in the scope; returns (batch_id, count)."""
+        targets = _targets(city, tehsil, lab)
+        batch_id = uuid.uuid4().hex[:16]
+        params = params or {}
+        with self._lock:
+            ids = []
+            for hid in targets:
+                item = Action(hid, action, params, batch_id)
+                self._add(item)
+                ids.append(item.id)
+            self._batches[batch_id] = {
+                "action": action,
+                "scope": {"city": city, "tehsil": tehsil, "lab": lab},
+                "created_at": time.time(),
+                "ids": ids,
+            }
+        ACTIONS.inc("queued", amount=len(targets))
+        self._wake(targets)
+        return batch_id, len(targets)
+
+    # --- consumers -------------------------------------------------------
+
+    def _due(self, hardware_id, now, channel):
+        """Actions deliverable right now to hardware_id, marked delivered."""
+        out = []
+        for action_id in self._queues.get(hardware_id, ()):
+            item = self._actions[action_id]
+            if item.state == "queued" or (
+                item.state == "delivered" and item.channel == "poll"
+                and now - item.delivered_at >= settings["redeliver_seconds"]
+                and item.attempts < settings["max_attempts"]
+            ):
+                item.state = "delivered"
+                item.delivered_at = now
+                item.attempts += 1
+                item.channel = channel
+                out.append(item)
+        return out
+
+    def take(self, hardware_id):
+        with self._lock:
+            items = self._due(hardware_id, time.time(), "poll")
+        if items:
+            ACTIONS.inc("delivered", amount=len(items))
+        return items
+
+    def poll(self, hardware_id, wait):
+        """Long-poll: return due actions, waiting up to `wait` seconds for one to arrive."""
+        wait = max(0.0, min(wait, settings["poll_max_wait"]))
+        with self._lock:
+            waiter = self._waiters.setdefault(hardware_id, [threading.Event(), 0])
+            waiter[1] += 1
+            waiter[0].clear()
+        try:
+            items = self.take(hardware_id)
+            if items or not wait:
+                return items
+            waiter[0].wait(wait)
+            return self.take(hardware_id)
+        finally:
+            with self._lock:
+                waiter[1] -= 1
+                if not waiter[1]:
+                    self._waiters.pop(hardware_id, None)
+
+    def next_for_heartbeat(self, hardware_id):
+        """Legacy single-action delivery through the heartbeat response (no ack possible)."""
+        now = time.time()
+        with self._lock:
+            if hardware_id in self._waiters:
+                # A long-poll is open for this device; it gets the action with ack tracking
+                return None
+            for action_id in self._queues.get(hardware_id, ()):
+                item = self._actions[action_id]
+                if item.state == "queued":
+                    item.state = "delivered"
+                    item.delivered_at = item.finished_at = now
+                    item.attempts += 1
+                    item.channel = "heartbeat"
+                    self._finish(item, "delivered")
+                    ACTIONS.inc("delivered")
+                    return item.action
+        return None
+
+    def ack(self, hardware_id, action_id, ok=True, result=None):
+        with self._lock:
+            item = self._actions.get(action_id)
+            if item is None or item.hardware_id != hardware_id:
+                return None
+            if item.state not in FINAL_STATES:
+                item.result = result
+                item.finished_at = time.time()
+                self._finish(item, "acked" if ok else "failed")
+                ACTIONS.inc("acked" if ok else "failed")
+            return item
+
+    def _finish(self, item, state):
+        item.state = state
+        queue = self._queues.get(item.hardware_id)
+        if queue and item.id in queue:
+            queue.remove(item.id)
+            if not queue:
+                del self._queues[item.hardware_id]
+
+    # --- housekeeping / reporting -----------------------------------------
+
+    def expire(self):
+        """Expire stale actions and forget finished ones; runs as a scheduler job."""
+        now = time.time()
+        expired = 0
+        with self._lock:
+            for item in list(self._actions.values()):
+                if item.state not in FINAL_STATES and item.channel != "heartbeat" and (
+                    now >= item.expires_at
+                    or (item.state == "delivered" and item.attempts >= settings["max_attempts"]
+                        and now - item.delivered_at >= settings["redeliver_seconds"])
+                ):
+                    item.finished_at = now
+                    self._finish(item, "expired")
+                    expired += 1
+                if item.finished_at and now - item.finished_at > settings["keep_finished"]:
+                    del self._actions[item.id]
+            for batch_id, batch in list(self._batches.items()):
+                if now - batch["created_at"] > settings["ttl"] + settings["keep_finished"]:
+                    del self._batches[batch_id]
+        if expired:
+            ACTIONS.inc("expired", amount=expired)
+        return expired
+
+    def get(self, action_id):
+        item = self._actions.get(action_id)
+        return item.as_dict() if item else None
+
+    def batch(self, batch_id):
+        batch = self._batches.get(batch_id)
+        if batch is None:
+            return None
+        counts = {}
+        for action_id in batch["ids"]:
+            item = self._actions.get(action_id)
+            state = item.state if item else "forgotten"
+            counts[state] = counts.get(state, 0) + 1
+        return {"batch_id": batch_id, "action": batch["action"], "scope": batch["scope"],
+                "created_at": batch["created_at"], "targets": len(batch["ids"]), "states": counts}
+
+    def pending_devices(self):
+        return len(self._queues)
+
+    def stats(self):
+        with self._lock:
+            states = {}
+            for item in self._actions.values():
+                states[item.state] = states.get(item.state, 0) + 1
+            return {"devices_with_pending": len(self._queues), "pollers": len(self._waiters),
+                    "batches": len(self._batches), "states": states}
+
+
+SCHEMA = """
+create table if not exists actions (
+    id text primary key, batch_id text, hardware_id text not null, action text not null,
+    params text, state text not null, created_at real not null, expires_at real not null,
+    delivered_at real, finished_at real, attempts integer not null default 0,
+    channel text, result text);
+create index if not exists actions_device on actions (hardware_id, state);
+create index if not exists actions_batch on actions (batch_id);
+create index if not exists actions_finished on actions (finished_at);
+create table if not exists action_batches (
+    id text primary key, action text not null, scope text not null,
+    created_at real not null, targets integer not null);
+"""
+shared_state.register_schema(SCHEMA)
+
+_COLUMNS = Action.__slots__
+_OPEN = "state = 'queued' or (state = 'delivered' and channel = 'poll')"
+
+
+class SharedActionQueue:
+    """ActionQueue over the shared database: every worker sees every device's queue."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}  # local long-polls only: {hardware_id: [threading.Event, active polls]}
+        # Long-polls open in any worker (next_for_heartbeat must leave those devices alone)
+        self._pollers = shared_state.SharedTTLMap("action_pollers", ttl=settings["poll_max_wait"] + 5, max_size=100000)
+
+    @staticmethod
+    def _rows(conn, sql, params=()):
+        cur = conn.execute(sql, params)
+        names = [d[0] for d in cur.description]
+        return [dict(zip(names, row)) for row in cur.fetchall()]
+
+    @staticmethod
+    def _insert(conn, items):
+        conn.executemany(
+            f"insert into actions ({', '.join(_COLUMNS)}) values ({', '.join('?' * len(_COLUMNS))})",
+            [tuple(json.dumps(getattr(item, c)) if c in ("params", "result") else getattr(item, c)
+                   for c in _COLUMNS) for item in items])
+
+    def wake_local(self, hardware_ids):
+        for hid in hardware_ids:
+            waiter = self._waiters.get(hid)
+            if waiter is not None:
+                waiter[0].set()
+
+    def _wake(self, hardware_ids):
+        self.wake_local(hardware_ids)
+        shared_state.publish("actions", list(hardware_ids))
+
+    # --- producers -------------------------------------------------------
+
+    def enqueue(self, hardware_id, action, params=None):
+        item = Action(hardware_id, action, params or {})
+        with shared_state.transaction(immediate=True) as conn:
+            self._insert(conn, [item])
+        ACTIONS.inc("queued")
+        self._wake((hardware_id,))
+        return item
+
+    def enqueue_bulk(self, action, params=None, city=None, tehsil=None, lab=None):
+        """Queue `action` for every bound device in the scope; returns (batch_id, count)."""
+        targets = _targets(city, tehsil, lab)
+        batch_id = uuid.uuid4().hex[:16]
+        params = params or {}
+        items = [Action(hid, action, params, batch_id) for hid in targets]
+        with shared_state.transaction(immediate=True) as conn:
+            self._insert(conn, items)
+            conn.execute("insert into action_batches (id, action, scope, created_at, targets) values (?, ?, ?, ?, ?)",
+                         (batch_id, action, json.dumps({"city": city, "tehsil": tehsil, "lab": lab}),
+                          time.time(), len(items)))
+        ACTIONS.inc("queued", amount=len(targets))
+        self._wake(targets)
+        return batch_id, len(targets)
+
+    # --- consumers -------------------------------------------------------
+
+    def take(self, hardware_id):
+        if not shared_state.query(f"select 1 from actions where hardware_id = ? and ({_OPEN}) limit 1",
+                                  (hardware_id,)):
+            return []
+        now = time.time()
+        out = []
+        with shared_state.transaction(immediate=True) as conn:
+            for row in self._rows(conn, f"select * from actions where hardware_id = ? and ({_OPEN}) order by rowid",
+                                  (hardware_id,)):
+                item = Action.from_row(row)
+                if item.state == "queued" or (
+                    now - item.delivered_at >= settings["redeliver_seconds"]
+                    and item.attempts < settings["max_attempts"]
+                ):
+                    item.state, item.delivered_at, item.channel = "delivered", now, "poll"
+                    item.attempts += 1
+                    conn.execute("update actions set state = ?, delivered_at = ?, attempts = ?, channel = ? where id = ?",
+                                 (item.state, now, item.attempts, item.channel, item.id))
+                    out.append(item)
+        if out:
+            ACTIONS.inc("delivered", amount=len(out))
+        return out
+
+    def poll(self, hardware_id, wait):
+        """Long-poll: return due actions, waiting up to `wait` seconds for one to arrive."""
+        wait = max(0.0, min(wait, settings["poll_max_wait"]))
+        with self._lock:
+            waiter = self._waiters.setdefault(hardware_id, [threading.Event(), 0])
+            waiter[1] += 1
+            waiter[0].clear()
+        try:
+            items = self.take(hardware_id)
+            if items or not wait:
+                return items
+            self._pollers.set(hardware_id, True)
+            waiter[0].wait(wait)
+            return self.take(hardware_id)
+        finally:
+            with self._lock:
+                waiter[1] -= 1
+                last = not waiter[1]
+                if last:
+                    self._waiters.pop(hardware_id, None)
+            if last and wait:
+                self._pollers.pop(hardware_id)
+
+    def next_for_heartbeat(self, hardware_id):
+        """Legacy single-action delivery through the heartbeat response (no ack possible)."""
+        # Cheap read first: almost every beat has nothing queued
+        if not shared_state.query("select 1 from actions where hardware_id = ? and state = 'queued' limit 1",
+                                  (hardware_id,)):
+            return None
+        if hardware_id in self._waiters or hardware_id in self._pollers:
+            # A long-poll is open for this device; it gets the action with ack tracking
+            return None
+        now = time.time()
+        with shared_state.transaction(immediate=True) as conn:
+            row = conn.execute("select id, action from actions where hardware_id = ? and state = 'queued' "
+                               "order by rowid limit 1", (hardware_id,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("update actions set state = 'delivered', delivered_at = ?, finished_at = ?, "
+                         "attempts = attempts + 1, channel = 'heartbeat' where id = ?", (now, now, row[0]))
+        ACTIONS.inc("delivered")
+        return row[1]
+
+    def ack(self, hardware_id, action_id, ok=True, result=None):
+        with shared_state.transaction(immediate=True) as conn:
+            rows = self._rows(conn, "select * from actions where id = ?", (action_id,))
+            if not rows or rows[0]["hardware_id"] != hardware_id:
+                return None
+            item = Action.from_row(rows[0])
+            if item.state not in FINAL_STATES:
+                item.state = "acked" if ok else "failed"
+                item.result, item.finished_at = result, time.time()
+                conn.execute("update actions set state = ?, result = ?, finished_at = ? where id = ?",
+                             (item.state, json.dumps(result), item.finished_at, item.id))
+                ACTIONS.inc(item.state)
+        return item
+
+    # --- housekeeping / reporting -----------------------------------------
+
+    def expire(self):
+        """Expire stale actions and forget finished ones; runs as the leader's scheduler job."""
+        now = time.time()
+        with shared_state.transaction(immediate=True) as conn:
+            expired = conn.execute(
+                f"update actions set state = 'expired', finished_at = ? where ({_OPEN}) and "
+                "(? >= expires_at or (state = 'delivered' and attempts >= ? and ? - delivered_at >= ?))",
+                (now, now, settings["max_attempts"], now, settings["redeliver_seconds"])).rowcount
+            conn.execute("delete from actions where finished_at is not null and finished_at < ?",
+                         (now - settings["keep_finished"],))
+            conn.execute("delete from action_batches where created_at < ?",
+                         (now - settings["ttl"] - settings["keep_finished"],))
+        if expired:
+            ACTIONS.inc("expired", amount=expired)
+        return expired
+
+    def get(self, action_id):
+        with shared_state.transaction() as conn:
+            rows = self._rows(conn, "select * from actions where id = ?", (action_id,))
+        return Action.from_row(rows[0]).as_dict() if rows else None
+
+    def batch(self, batch_id):
+        with shared_state.transaction() as conn:
+            rows = self._rows(conn, "select * from action_batches where id = ?", (batch_id,))
+            states = conn.execute("select state, count(*) from actions where batch_id = ? group by state",
+                                  (batch_id,)).fetchall()
+        if not rows:
+            return None
+        batch = rows[0]
+        counts = dict(states)
+        forgotten = batch["targets"] - sum(counts.values())
+        if forgotten:
+            counts["forgotten"] = forgotten
+        return {"batch_id": batch_id, "action": batch["action"], "scope": json.loads(batch["scope"]),
+                "created_at": batch["created_at"], "targets": batch["targets"], "states": counts}
+
+    def pending_devices(self):
+        return shared_state.query(f"select count(distinct hardware_id) from actions where {_OPEN}")[0][0]
+
+    def stats(self):
+        with shared_state.transaction() as conn:
+            states = dict(conn.execute("select state, count(*) from actions group by state").fetchall())
+            batches = conn.execute("select count(*) from action_batches").fetchone()[0]
+        return {"devices_with_pending": self.pending_devices(), "pollers": len(self._waiters),
+                "batches": batches, "states": states}
+
+
+class _ConfiguredQueue:
+    """The queue picked by configure_actions; routes import this object once, like extensions.supabase."""
+
+    def __init__(self):
+        self.impl = ActionQueue()
+
+    def select(self):
+        shared = shared_state.is_shared()
+        if shared and not isinstance(self.impl, SharedActionQueue):
+            self.impl = SharedActionQueue()
+        elif not shared and isinstance(self.impl, SharedActionQueue):
+            self.impl = ActionQueue()
+
+    def __getattr__(self, name):
+        return getattr(self.impl, name)
+
+
+queue = _ConfiguredQueue()
+
+
+def _on_peer_enqueue(hardware_ids):
+    if isinstance(queue.impl, SharedActionQueue):
+        queue.impl.wake_local(hardware_ids)
+
+
+shared_state.subscribe("actions", _on_peer_enqueue)
+
+
+def expire_actions():
+    queue.expire()
+
+
+@metrics.register_collector
+def _collect_actions():
+    return [
+        "# HELP lab_action_pollers Hardware ids with an open long-poll.",
+        "# TYPE lab_action_pollers gauge",
+        f"lab_action_pollers {len(queue._waiters)}",
+        "# HELP lab_action_devices_pending Devices with undelivered or unacked actions.",
+        "# TYPE lab_action_devices_pending gauge",
+        f"lab_action_devices_pending {queue.pending_devices()}",
+    ]
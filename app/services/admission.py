@@ -0,0 +1,121 @@
+"""
+Admission control for the agent-facing hot paths (/api/heartbeat, /api/auth).
+
+Two layers, both evaluated before any database work:
+  * a token bucket per (endpoint, hardware_id), so one agent stuck in a
+    tight loop can't cost more than its share; idle buckets are forgotten
+    by a bounded TTLCache once they would have refilled anyway
+  * global load shedding when the backend is slow (round-trip EWMA), the
+    connection pool is queueing, or the spool is nearly full. Shedding
+    ramps up linearly from the threshold to twice the threshold instead of
+    flipping every agent off at once, and the Retry-After hint is jittered
+    so shed agents don't come back in lockstep.
+"""
+import random
+import time
+
+from app.services import spool
+from app.utils import db_client, metrics
+from app.utils.load_signals import backend_latency
+from app.utils.ttl_cache import TTLCache
+
+ADMISSION = metrics.counter("lab_admission_total", "Admission decisions on agent endpoints.", ("endpoint", "decision"))
+PRESSURE = metrics.gauge("lab_admission_pressure", "Load pressure at the last decision (1.0 = shedding threshold).")
+
+settings = {
+    "heartbeat_rate": 0.2,       # sustained tokens per second per hardware_id
+    "heartbeat_burst": 6,
+    "auth_rate": 0.1,
+    "auth_burst": 5,
+    "max_tracked": 100000,
+    "shed_backend_latency": 1.0,  # seconds (EWMA of Supabase round trips)
+    "shed_pool_queue": 1.5,       # in-flight calls per pooled connection
+    "shed_spool_fill": 0.9,
+    "shed_retry_after": 20.0,
+}
+
+_buckets = {}  # {endpoint: TTLCache of [tokens, last_refill_monotonic]}
+
+
+def configure_admission(config):
+    settings.update({
+        "heartbeat_rate": float(config.get("HEARTBEAT_RATE_PER_SECOND", settings["heartbeat_rate"])),
+        "heartbeat_burst": float(config.get("HEARTBEAT_BURST", settings["heartbeat_burst"])),
+        "auth_rate": float(config.get("AUTH_RATE_PER_SECOND", settings["auth_rate"])),
+        "auth_burst": float(config.get("AUTH_BURST", settings["auth_burst"])),
+        "max_tracked": int(config.get("ADMISSION_MAX_TRACKED", settings["max_tracked"])),
+        "shed_backend_latency": float(config.get("SHED_BACKEND_LATENCY", settings["shed_backend_latency"])),
+        "shed_pool_queue": float(config.get("SHED_POOL_QUEUE", settings["shed_pool_queue"])),
+        "shed_spool_fill": float(config.get("SHED_SPOOL_FILL", settings["shed_spool_fill"])),
+        "shed_retry_after": float(config.get("SHED_RETRY_AFTER", settings["shed_retry_after"])),
+    })
+    for endpoint, cache in _buckets.items():
+        cache.configure(ttl=settings[f"{endpoint}_burst"] / settings[f"{endpoint}_rate"],
+                        max_size=settings["max_tracked"])
+
+
+def _bucket_cache(endpoint):
+    cache = _buckets.get(endpoint)
+    if cache is None:
+        rate, burst = settings[f"{endpoint}_rate"], settings[f"{endpoint}_burst"]
+        # After burst / rate seconds idle a bucket is full again: same as no entry
+        cache = _buckets[endpoint] = TTLCache(f"admission_{endpoint}", burst / rate, settings["max_tracked"])
+    return cache
+
+
+def take_token(endpoint, hardware_id):
+    """0 when admitted, otherwise seconds until the next token."""
+    rate, burst = settings[f"{endpoint}_rate"], settings[f"{endpoint}_burst"]
+    cache = _bucket_cache(endpoint)
+    now = time.monotonic()
+    bucket = cache.get(hardware_id)
+    if bucket is None:
+        bucket = [burst, now]
+    else:
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+    if bucket[0] >= 1:
+        bucket[0] -= 1
+        cache.set(hardware_id, bucket)
+        return 0
+    cache.set(hardware_id, bucket)
+    return (1 - bucket[0]) / rate
+
+
+def pressure():
+    """Worst of the load signals, each normalized so 1.0 is its shedding threshold."""
+    signals = [
+        backend_latency.value(max_age=30.0) / settings["shed_backend_latency"],
+        spool.fill_ratio() / settings["shed_spool_fill"],
+    ]
+    transport = db_client.transport_stats
+    if transport and transport.max_connections:
+        signals.append(transport.in_flight / transport.max_connections / settings["shed_pool_queue"])
+    return max(signals)
+
+
+def should_shed():
+    """Retry-After seconds when this request should be shed, else 0."""
+    level = pressure()
+    PRESSURE.set(round(level, 3))
+    if level < 1.0 or random.random() >= min(1.0, level - 1.0):
+        return 0
+    base = settings["shed_retry_after"]
+    return round(random.uniform(0.5 * base, 1.5 * base))
+
+
+def admit(endpoint, hardware_id):
+    """
+    (decision, retry_after) for one request: decision is "ok", "limited"
+    (this hardware_id is over its rate) or "shed" (server under pressure).
+    """
+    retry_after = should_shed()
+    if retry_after:
+        ADMISSION.inc(endpoint, "shed")
+        return "shed", retry_after
+    wait = take_token(endpoint, hardware_id)
+    if wait:
+        ADMISSION.inc(endpoint, "limited")
+        return "limited", max(1, round(wait))
+    ADMISSION.inc(endpoint, "ok")
+    return "ok", 0
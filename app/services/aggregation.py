@@ -0,0 +1,282 @@
+"""
+Pure aggregation logic behind the stats routes.
+
+The routes fetch device rows and hand them to these functions, so the hot
+loops can be benchmarked on synthetic fleets without Flask or a database
+(see loadtest/bench_stats.py). `now` is passed in for the same reason.
+"""
+import json
+from datetime import datetime, timedelta
+
+from app.services.app_catalogue import WORK_TIME, catalogue
+
+ONLINE_WINDOW = timedelta(seconds=60)
+
+
+def normalize_name(name):
+    if not name: return "UNKNOWN"
+    return str(name).strip().upper()
+
+
+def is_online(d, threshold):
+    """status says online AND the last pulse is inside the presence window."""
+    if d.get("status") == "online" and d.get("last_seen"):
+        try:
+            ls_dt = datetime.fromisoformat(d["last_seen"].replace('Z', '+00:00'))
+            return ls_dt > threshold
+        except: pass
+    return False
+
+
+def is_actually_used(runtime_mins, app_usage_raw):
+    """Online for 3+ minutes with more than 45s in real work apps."""
+    try:
+        try:
+            rt = float(runtime_mins or 0)
+        except: rt = 0
+
+        if rt < 3: return False
+
+        app_usage = app_usage_raw
+        if isinstance(app_usage, str):
+            try: app_usage = json.loads(app_usage)
+            except: return False
+
+        if not app_usage or not isinstance(app_usage, dict):
+            return False
+
+        total_real_usage_seconds = 0
+        for app, seconds in app_usage.items():
+            try:
+                # Work app and not desktop noise, classified once per name
+                if catalogue.flags_of(app) & WORK_TIME:
+                    total_real_usage_seconds += float(seconds or 0)
+            except: continue
+
+        return total_real_usage_seconds > 45
+    except:
+        return False
+
+
+def location_stats(devices, now):
+    """Per-city totals for /stats/locations."""
+    threshold = now - ONLINE_WINDOW
+    city_map = {}
+
+    for d in devices:
+        city = (d.get("city") or "Unknown").strip()
+        lab = (d.get("lab_name") or "Main Lab").strip()
+        cpu = float(d.get("cpu_score") or 0)
+
+        if city not in city_map:
+            city_map[city] = {
+                "city": city,
+                "total_pcs": 0,
+                "online": 0,
+                "offline": 0,
+                "labs": set(),
+                "tehsils": set(),
+                "online_labs_set": set(),
+                "total_cpu": 0,
+                "online_count_for_cpu": 0
+            }
+
+        target = city_map[city]
+        target["total_pcs"] += 1
+        target["labs"].add(lab)
+        teh = (d.get("tehsil") or "Unknown").strip()
+        if teh:
+            target["tehsils"].add(teh)
+
+        if is_online(d, threshold):
+            target["online"] += 1
+            target["online_labs_set"].add(lab)
+            target["total_cpu"] += cpu
+            target["online_count_for_cpu"] += 1
+        else:
+            target["offline"] += 1
+
+    result = []
+    for city, data in city_map.items():
+        avg_perf = 0
+        if data["total_pcs"] > 0:
+            avg_perf = data["total_cpu"] / data["total_pcs"]
+
+        result.append({
+            "city": city,
+            "total_pcs": data["total_pcs"],
+            "online": data["online"],
+            "offline": data["offline"],
+            "total_labs": len(data["labs"]),
+            "total_tehsils": len(data["tehsils"]),
+            "online_labs": len(data["online_labs_set"]),
+            "offline_labs": len(data["labs"]) - len(data["online_labs_set"]),
+            "avg_performance": round(avg_perf, 2)
+        })
+    return result
+
+
+def city_lab_stats(devices, city, tehsil, now):
+    """Labs of one city (optionally one tehsil) for /stats/city/<city>/labs."""
+    threshold = now - ONLINE_WINDOW
+    lab_map = {}
+    target_city = city.strip().upper()
+    target_tehsil = tehsil.strip().upper() if tehsil else None
+
+    for d in devices:
+        curr_city = normalize_name(d.get("city"))
+        if curr_city != target_city:
+            continue
+
+        curr_tehsil = normalize_name(d.get("tehsil"))
+        if target_tehsil and curr_tehsil != target_tehsil:
+            continue
+
+        lab = normalize_name(d.get("lab_name") or "Main Lab")
+        cpu = float(d.get("cpu_score") or 0)
+
+        if lab not in lab_map:
+            lab_map[lab] = {
+                "lab_name": lab,
+                "total_pcs": 0,
+                "online": 0,
+                "offline": 0,
+                "total_cpu": 0,
+                "online_count": 0,
+                "tehsil": curr_tehsil
+            }
+
+        target = lab_map[lab]
+        target["total_pcs"] += 1
+
+        if is_online(d, threshold):
+            target["online"] += 1
+            target["total_cpu"] += cpu
+            target["online_count"] += 1
+        else:
+            target["offline"] += 1
+
+    # Averages are over TOTAL PCs in the lab
+    result = []
+    for lab, data in lab_map.items():
+        avg_perf = 0
+        if data["total_pcs"] > 0:
+            avg_perf = data["total_cpu"] / data["total_pcs"]
+
+        result.append({
+            "lab_name": lab,
+            "total_pcs": data["total_pcs"],
+            "online": data["online"],
+            "offline": data["offline"],
+            "avg_performance": round(avg_perf, 2),
+            "tehsil": data.get("tehsil", "UNKNOWN")
+        })
+    return result
+
+
+def all_labs(devices, now):
+    """One card per (city, tehsil, lab) for /stats/labs/all."""
+    threshold = now - ONLINE_WINDOW
+    lab_map = {}
+
+    for d in devices:
+        r_city = d.get("city") or "Unknown"
+        r_tehsil = d.get("tehsil") or "Unknown"
+        r_lab = (d.get("lab_name") or d.get("lab") or "Main Lab").strip()
+
+        n_city = normalize_name(r_city)
+        n_tehsil = normalize_name(r_tehsil)
+        n_lab = normalize_name(r_lab)
+
+        # Must be unique for ONE card in the UI
+        key = f"{n_city}::{n_tehsil}::{n_lab}"
+
+        if key not in lab_map:
+            lab_map[key] = {
+                "lab_name": r_lab,
+                "city": r_city,
+                "tehsil": r_tehsil,
+                "norm_lab": n_lab,
+                "norm_city": n_city,
+                "norm_tehsil": n_tehsil,
+                "total_pcs": 0,
+                "online": 0,
+                "offline": 0,
+                "system_ids": []
+            }
+
+        target = lab_map[key]
+        target["total_pcs"] += 1
+        target["system_ids"].append(str(d.get("system_id")))
+
+        if is_online(d, threshold):
+            target["online"] += 1
+        else:
+            target["offline"] += 1
+    return lab_map
+
+
+def utilization(devices, now):
+    """Used/idle/offline labs today plus labs unused for a week or a month."""
+    lab_activity = {}
+    lab_last_seen = {}
+
+    for d in devices:
+        try:
+            raw_city = (d.get('city') or 'Unknown').strip()
+            raw_tehsil = (d.get('tehsil') or 'Unknown').strip()
+            raw_lab = (d.get('lab_name') or 'Main Lab').strip()
+            key = f"{raw_city}|{raw_tehsil}|{raw_lab}"
+
+            if key not in lab_activity:
+                lab_activity[key] = {
+                    "city": raw_city, "lab": raw_lab,
+                    "used": False, "idle": False, "online": 0, "total": 0,
+                    "is_stale": False, "is_ghost": False, "last_used": "Never"
+                }
+
+            target = lab_activity[key]
+            target["total"] += 1
+
+            if d.get("status") == "online":
+                target["online"] += 1
+                if is_actually_used(d.get("runtime_minutes", 0), d.get("app_usage", {})):
+                    target["used"] = True
+                else:
+                    target["idle"] = True
+
+            ls_str = d.get("last_seen")
+            if ls_str:
+                try:
+                    ls_dt = datetime.fromisoformat(ls_str.replace('Z', '+00:00'))
+                    if key not in lab_last_seen or ls_dt > lab_last_seen[key]:
+                        lab_last_seen[key] = ls_dt
+                except: pass
+        except: continue
+
+    today_stats = {"used_labs": 0, "idle_labs": 0, "offline_labs": 0}
+    one_week_unused = []
+    one_month_unused = []
+
+    for key, target in lab_activity.items():
+        if target["used"]: today_stats["used_labs"] += 1
+        elif target["online"] > 0: today_stats["idle_labs"] += 1
+        else: today_stats["offline_labs"] += 1
+
+        last_seen_dt = lab_last_seen.get(key)
+        if last_seen_dt:
+            target["last_used"] = last_seen_dt.date().isoformat()
+            if last_seen_dt < now - timedelta(days=30):
+                target["is_ghost"] = True
+                target["is_stale"] = True
+                one_month_unused.append({"city": target["city"], "lab": target["lab"], "last_used": target["last_used"]})
+            elif last_seen_dt < now - timedelta(days=7):
+                target["is_stale"] = True
+                one_week_unused.append({"city": target["city"], "lab": target["lab"], "last_used": target["last_used"]})
+
+    return {
+        "today": today_stats,
+        "one_week_unused": one_week_unused,
+        "one_month_unused": one_month_unused,
+        "lab_details": list(lab_activity.values()),
+    }
@@ -0,0 +1,176 @@
+"""
+App catalogue: every distinct application name gets a compact integer id
+once, with its classification (agent noise / desktop noise / work app)
+computed at that moment and cached per id.
+
+The heartbeat noise filter and the utilization aggregates used to lowercase
+and substring-scan every name on every pulse; now they do one dict lookup
+per name (the raw spelling the agent sent maps straight to its id).
+
+With APP_USAGE_LOG_IDS enabled, app_usage_logs rows carry `app_id` instead
+of the free-text `app_name`. The ids come from a shared `apps` table, so
+every process agrees on them:
+
+    create table apps (id bigint generated always as identity primary key,
+                       name text not null unique);
+    alter table app_usage_logs add column app_id bigint references apps(id);
+    create unique index on app_usage_logs (device_id, date, app_id);
+
+Keep app_name and its (device_id, date, app_name) key: when the id lookup
+itself fails (backend down), usage is logged by name so it can be spooled.
+
+`devices.app_usage` and `device_daily_history.app_usage` keep app names:
+the dashboard reads those JSON maps as they are.
+"""
+import threading
+
+import app.extensions as extensions
+from app.utils import metrics
+
+WORK_APPS = [
+    'chrome', 'firefox', 'msedge', 'brave', 'browser',
+    'code', 'visual studio', 'pycharm', 'intellij', 'sublime', 'notepad++', 'anaconda', 'jupyter',
+    'word', 'excel', 'powerpoint', 'winword', 'outlook', 'access',
+    'vlc', 'potplayer', 'mpc', 'wmplayer',
+    'zoom', 'teams', 'discord', 'anydesk', 'teamviewer',
+    'photoshop', 'illustrator', 'corel', 'autocad', 'matlab',
+    'python', 'java', 'node', 'cmd', 'powershell'
+]
+NOISE_APPS = ['explorer.exe', 'taskmgr.exe', 'shellexperiencehost.exe', 'searchhost.exe', 'lockapp.exe']
+# The agent's own processes, dropped at ingest
+AGENT_PROCESSES = ["python", "antigravity", "lab_systems_agent"]
+TELEMETRY_KEYS = ("__current_cpu__",)
+
+# Classification bits
+AGENT_NOISE = 1
+NOISE = 2
+WORK = 4
+TELEMETRY = 8
+WORK_TIME = 16  # WORK and not NOISE: counts towards "actually used"
+
+PAGE_SIZE = 1000
+
+settings = {
+    "max_entries": 50000,
+    "log_ids": False,
+}
+
+
+def configure_app_catalogue(config):
+    settings.update({
+        "max_entries": int(config.get("APP_CATALOGUE_MAX_ENTRIES", settings["max_entries"])),
+        "log_ids": bool(config.get("APP_USAGE_LOG_IDS", settings["log_ids"])),
+    })
+
+
+def normalize(name):
+    return str(name).strip().lower()
+
+
+def classify(norm):
+    flags = 0
+    if norm in TELEMETRY_KEYS:
+        flags |= TELEMETRY
+    if any(p in norm for p in AGENT_PROCESSES):
+        flags |= AGENT_NOISE
+    if any(n in norm for n in NOISE_APPS):
+        flags |= NOISE
+    if any(w in norm for w in WORK_APPS):
+        flags |= WORK
+        if not flags & NOISE:
+            flags |= WORK_TIME
+    return flags
+
+
+class AppCatalogue:
+    def __init__(self):
+        self._raw = {}      # {name as sent: id}
+        self._by_name = {}  # {normalized name: id}
+        self._names = []    # id -> normalized name
+        self._flags = []    # id -> classification bits
+        self._db_ids = {}   # id -> apps.id (APP_USAGE_LOG_IDS)
+        self._db_loaded = False
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()  # one batch at a time loads / extends _db_ids
+
+    def intern(self, name):
+        """Id for an app name, or None once the catalogue is full."""
+        app_id = self._raw.get(name)
+        if app_id is not None:
+            return app_id
+        norm = normalize(name)
+        with self._lock:
+            app_id = self._by_name.get(norm)
+            if app_id is None:
+                if len(self._names) >= settings["max_entries"]:
+                    return None
+                app_id = len(self._names)
+                self._names.append(norm)
+                self._flags.append(classify(norm))
+                self._by_name[norm] = app_id
+            if len(self._raw) < 2 * settings["max_entries"]:
+                self._raw[name] = app_id
+        return app_id
+
+    def flags_of(self, name):
+        app_id = self.intern(name)
+        # A full catalogue still answers, just without caching
+        return classify(normalize(name)) if app_id is None else self._flags[app_id]
+
+    def name_of(self, app_id):
+        return self._names[app_id]
+
+    def __len__(self):
+        return len(self._names)
+
+    # --- shared ids for app_usage_logs (APP_USAGE_LOG_IDS) -----------------
+
+    def _load_db_ids(self):
+        ids, last = {}, None
+        while True:
+            query = extensions.supabase.table("apps").select("id, name").order("name").limit(PAGE_SIZE)
+            if last is not None:
+                query = query.gt("name", last)
+            rows = query.execute().data or []
+            for row in rows:
+                app_id = self.intern(row["name"])
+                if app_id is not None:
+                    ids[app_id] = row["id"]
+            if len(rows) < PAGE_SIZE:
+                break
+            last = rows[-1]["name"]
+        # Only a complete load counts; a failed one is retried by the next batch
+        self._db_ids.update(ids)
+        self._db_loaded = True
+
+    def db_ids(self, names):
+        """
+        {name: apps.id}, registering unseen names in one upsert (background use
+        only: does I/O, and raises if the backend is unavailable).
+        """
+        local = {name: self.intern(name) for name in names}
+        with self._db_lock:
+            if not self._db_loaded:
+                self._load_db_ids()
+            missing = sorted({self._names[i] for i in local.values() if i is not None and i not in self._db_ids})
+            if missing:
+                res = extensions.supabase.table("apps")\
+                    .upsert([{"name": n} for n in missing], on_conflict="name")\
+                    .execute()
+                for row in res.data or []:
+                    app_id = self._by_name.get(row["name"])
+                    if app_id is not None:
+                        self._db_ids[app_id] = row["id"]
+            return {name: self._db_ids.get(i) for name, i in local.items() if i is not None}
+
+
+catalogue = AppCatalogue()
+
+
+@metrics.register_collector
+def _collect_catalogue():
+    return [
+        "# HELP lab_app_catalogue_entries Distinct (normalized) app names in the catalogue.",
+        "# TYPE lab_app_catalogue_entries gauge",
+        f"lab_app_catalogue_entries {len(catalogue)}",
+    ]
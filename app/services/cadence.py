@@ -0,0 +1,58 @@
+"""
+Server-chosen heartbeat cadence (`next_interval_seconds` in /api/heartbeat).
+
+Active machines beat at the base interval; idle ones (app_usage unchanged
+since the stored row) back off. Ingest pressure (same signal as admission
+shedding) stretches every interval further. The ceiling comes from the
+stats code's 60 s presence window (aggregation.ONLINE_WINDOW): normally an
+interval stays under ~half of it so a single lost beat doesn't flip a
+device offline; only once the server is past its shedding threshold may it
+approach the window itself, trading presence precision for survival.
+Every value is jittered so machines that reconnected together drift apart.
+"""
+import random
+
+from app.services import admission
+from app.services.aggregation import ONLINE_WINDOW
+from app.utils import metrics
+
+NEXT_INTERVAL = metrics.histogram(
+    "lab_heartbeat_next_interval_seconds", "next_interval_seconds handed to agents.",
+    buckets=(5, 10, 15, 20, 25, 30, 40, 50, 60))
+
+settings = {
+    "active_interval": 10.0,
+    "idle_interval": 25.0,
+    "jitter": 0.1,
+    # Fractions of the presence window: normal ceiling / ceiling while shedding
+    "safe_fraction": 0.45,
+    "overload_fraction": 0.85,
+}
+
+
+def configure_cadence(config):
+    settings.update({
+        "active_interval": float(config.get("HEARTBEAT_ACTIVE_INTERVAL", settings["active_interval"])),
+        "idle_interval": float(config.get("HEARTBEAT_IDLE_INTERVAL", settings["idle_interval"])),
+        "jitter": float(config.get("HEARTBEAT_INTERVAL_JITTER", settings["jitter"])),
+    })
+
+
+def usage_unchanged(stored_usage, new_usage):
+    """True when no app accrued time since the stored row (live CPU telemetry ignored)."""
+    stored_usage = stored_usage or {}
+    return all(stored_usage.get(app) == secs for app, secs in new_usage.items() if app != "__current_cpu__")
+
+
+def next_interval(idle):
+    window = ONLINE_WINDOW.total_seconds()
+    pressure = admission.pressure()
+    interval = settings["idle_interval"] if idle else settings["active_interval"]
+    interval *= 1 + pressure
+    ceiling = window * (settings["overload_fraction"] if pressure >= 1 else settings["safe_fraction"])
+    jitter = settings["jitter"]
+    # Clamp before jittering so clamped values still spread out below the ceiling
+    interval = min(interval, ceiling / (1 + jitter)) * random.uniform(1 - jitter, 1 + jitter)
+    interval = round(interval, 1)
+    NEXT_INTERVAL.observe(interval)
+    return interval
@@ -0,0 +1,249 @@
+"""
+Last known `devices` row per system_id, as this process last read and wrote it.
+
+With a valid device token the heartbeat takes identity from the token and
+the previous state (last_seen, status, today_start_time, app_usage, ...)
+from here, so a steady-state beat needs no devices lookup at all. An entry
+remembers when it was read from the database; any revocation covering the
+device after that (device_tokens.revoke: bind, unbind, delete, rename)
+makes it stale and the next beat reads the row again.
+
+The same state decides whether a beat is worth a full row write. Beats that
+only prove liveness (same status and hierarchy, a few more usage seconds)
+become "touches": last_seen is collected here and written for
+many devices at once by the `touch_flush` job. The full row is still
+written on a meaningful change and at least every HEARTBEAT_FULL_WRITE_INTERVAL.
+
+A touch also writes status "online": while the backend is degraded the
+flush waits, and the offline sweep may meanwhile flip a device that is
+still beating. The sweep reports the rows it flipped back here (`swept`),
+so the device's next beat is a full write and opens a new session.
+
+With several workers a device's beats land on any of them, so each worker
+also follows the last_seen / status its peers publish (events "device"
+channel): otherwise a worker that last saw the device minutes ago would take
+it for offline (new session) or for yesterday's (second daily archive).
+"""
+import threading
+import time
+
+import app.extensions as extensions
+from app.services import device_tokens, shared_state, spool
+from app.utils import metrics
+from app.utils.logger import logger
+from app.utils.ttl_cache import TTLCache
+
+WRITES = metrics.counter("lab_heartbeat_writes_total", "Heartbeat device writes by kind (full / touch).", ("kind",))
+TOUCH_FLUSHES = metrics.counter("lab_heartbeat_touch_flush_rows_total", "Rows updated by batched last_seen flushes.")
+
+settings = {
+    "full_write_interval": 300.0,
+    "usage_min_delta": 120,
+    "touch_chunk": 500,
+}
+
+# Besides status: fields whose change always deserves a full write
+_FULL_WRITE_FIELDS = ("city", "tehsil", "lab_name", "today_start_time")
+
+
+class Entry:
+    __slots__ = ("row", "read_at", "full_written_at", "session_day")
+
+    def __init__(self, row, read_at):
+        self.row = row
+        self.read_at = read_at
+        self.full_written_at = None  # monotonic; None = never by this process
+        self.session_day = None      # UTC date known to have a device_sessions row
+
+
+# Refreshed on every beat, so only devices that went quiet age out
+_cache = TTLCache("device_state", ttl=600, max_size=100000)  # {system_id: Entry}
+
+_touches = {}  # {system_id: latest unflushed last_seen, whole seconds ISO}
+_touch_lock = threading.Lock()
+
+
+def configure_device_state(config):
+    _cache.configure(ttl=config.get("DEVICE_STATE_TTL", 600), max_size=config.get("DEVICE_STATE_MAX_ENTRIES", 100000))
+    settings.update({
+        "full_write_interval": float(config.get("HEARTBEAT_FULL_WRITE_INTERVAL", settings["full_write_interval"])),
+        "usage_min_delta": int(config.get("HEARTBEAT_USAGE_MIN_DELTA", settings["usage_min_delta"])),
+    })
+
+
+def _current(system_id):
+    entry = _cache.get(str(system_id))
+    if entry is None:
+        return None
+    row = entry.row
+    if not device_tokens.is_current(entry.read_at, system_id, row.get("hardware_id"), row.get("city"), row.get("lab_name")):
+        _cache.pop(str(system_id))
+        return None
+    return entry
+
+
+def get(system_id):
+    entry = _current(system_id)
+    return entry.row if entry else None
+
+
+def loaded(row):
+    """Record a row just read from the database (write bookkeeping is kept)."""
+    sid = str(row["system_id"])
+    entry = _current(sid)
+    if entry is None:
+        entry = Entry(row, time.time())
+    else:
+        entry.row, entry.read_at = row, time.time()
+    _cache.set(sid, entry)
+
+
+def session_known(system_id, day):
+    entry = _current(system_id)
+    return entry is not None and entry.session_day == day
+
+
+def mark_session(system_id, day):
+    entry = _current(system_id)
+    if entry is not None:
+        entry.session_day = day
+
+
+def _usage_delta(old, new):
+    """Seconds of app usage added since `old`, or None if the set of apps changed."""
+    old = {k: v for k, v in (old or {}).items() if k != "__current_cpu__"}
+    new = {k: v for k, v in (new or {}).items() if k != "__current_cpu__"}
+    if old.keys() != new.keys():
+        return None
+    try:
+        return sum(abs(float(new[k]) - float(old[k] or 0)) for k in new)
+    except (TypeError, ValueError):
+        return None
+
+
+def needs_full_write(system_id, previous, update_data, previous_status):
+    """Whether this beat changes anything worth writing the whole row for."""
+    entry = _current(system_id)
+    if entry is None or entry.full_written_at is None:
+        return True
+    if time.monotonic() - entry.full_written_at >= settings["full_write_interval"]:
+        return True
+    if update_data.get("status") != previous_status:
+        return True
+    for field in _FULL_WRITE_FIELDS:
+        if field in update_data and update_data[field] != previous.get(field):
+            return True
+    # cpu_score / runtime_minutes move every beat; they ride along with the next full write
+    delta = _usage_delta(previous.get("app_usage"), update_data.get("app_usage"))
+    return delta is None or delta >= settings["usage_min_delta"]
+
+
+def written(system_id, row):
+    """Record a full row write, keeping the time the base row was read."""
+    sid = str(system_id)
+    entry = _current(sid) or Entry(row, time.time())
+    entry.row = row
+    entry.full_written_at = time.monotonic()
+    _cache.set(sid, entry)
+    with _touch_lock:
+        # The full write carries a newer last_seen than any queued touch
+        _touches.pop(sid, None)
+    WRITES.inc("full")
+
+
+def _second(iso):
+    # Rounded down, so never fresher than the beat; beats of one second share an update
+    return iso[:19] + "Z"
+
+
+def touch(system_id, last_seen):
+    """Liveness-only beat: queue last_seen for the next batched flush."""
+    sid = str(system_id)
+    entry = _current(sid)
+    if entry is not None:
+        entry.row = {**entry.row, "last_seen": last_seen}
+        _cache.set(sid, entry)
+    _queue_touch(sid, _second(last_seen))
+    WRITES.inc("touch")
+
+
+def _queue_touch(sid, seen):
+    with _touch_lock:
+        if seen > _touches.get(sid, ""):
+            _touches[sid] = seen
+
+
+def swept(rows):
+    """Rows the offline sweep just flipped: the next beat must write the row and open a session."""
+    for row in rows:
+        entry = _cache.get(str(row["system_id"]))
+        if entry is not None:
+            entry.row = {**entry.row, "status": "offline", "last_seen": row.get("last_seen", entry.row.get("last_seen"))}
+
+
+def _on_peer_device(message):
+    """A peer worker handled a beat (or the offline sweep): keep liveness in step."""
+    system_id, _, fields = message
+    entry = _cache.get(str(system_id))
+    if entry is None:
+        return
+    seen = {k: fields[k] for k in ("last_seen", "status") if k in fields}
+    if seen:
+        entry.row = {**entry.row, **seen}
+
+
+shared_state.subscribe("device", _on_peer_device)
+
+
+def pending_touches():
+    return len(_touches)
+
+
+def flush_touches():
+    """
+    Write queued touches (scheduler job): one update per distinct second and
+    chunk of devices, so each device gets its own last_seen.
+    """
+    if spool.is_degraded():
+        return 0
+    with _touch_lock:
+        pending = dict(_touches)
+        _touches.clear()
+    if not pending:
+        return 0
+    by_second = {}
+    for sid, seen in pending.items():
+        by_second.setdefault(seen, []).append(sid)
+    batches = []
+    chunk = settings["touch_chunk"]
+    for seen in sorted(by_second):
+        sids = sorted(by_second[seen])
+        batches += [(seen, sids[i:i + chunk]) for i in range(0, len(sids), chunk)]
+    flushed = 0
+    try:
+        for n, (seen, batch) in enumerate(batches):
+            # Only ever moves last_seen forward (another worker may have written a newer one);
+            # the device is beating, so it is online even if the sweep got to it first
+            extensions.supabase.table("devices")\
+                .update({"last_seen": seen, "status": "online"})\
+                .in_("system_id", batch)\
+                .lt("last_seen", seen)\
+                .execute()
+            flushed += len(batch)
+    except Exception as e:
+        spool.mark_degraded(f"touch flush: {e}")
+        logger.warning(f"💓 Touch flush failed after {flushed} rows: {e}")
+        for seen, batch in batches[n:]:
+            for sid in batch:
+                _queue_touch(sid, seen)
+    TOUCH_FLUSHES.inc(amount=flushed)
+    return flushed
+
+
+@metrics.register_collector
+def _collect_touches():
+    return [
+        "# HELP lab_heartbeat_touches_pending Devices with a last_seen touch waiting for the batch flush.",
+        "# TYPE lab_heartbeat_touches_pending gauge",
+        f"lab_heartbeat_touches_pending {len(_touches)}",
+    ]
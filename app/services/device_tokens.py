@@ -0,0 +1,154 @@
+"""
+Short-lived signed device tokens (HS256 JWT) issued by /auth and /bind.
+
+A token carries the identity /auth would otherwise look up (hardware_id ->
+system_id, city, tehsil, lab), so /api/heartbeat can trust it without a
+database round trip. Tokens are invalidated by revocation watermarks: bind,
+unbind, delete and rename routes record "nothing issued before now is valid"
+for the device, hardware_id, city or lab they touched; tokens issued before
+the newest matching watermark are rejected and the agent falls back to the
+hardware_id lookup, which hands out a fresh token. DEVICE_TOKEN_EPOCH
+revokes every token at once.
+
+Watermarks live in process memory and are sent to the other workers over
+the shared bus (they apply them within one SHARED_BUS_POLL). To cover a restart, a token is also checked against the
+device registry whenever the registry was loaded after the token was issued.
+"""
+import threading
+import time
+
+import jwt
+
+from app.services import shared_state
+from app.services.registry import registry
+from app.utils import metrics
+
+TOKENS = metrics.counter("lab_device_tokens_total", "Device token issue/verify outcomes.", ("event",))
+
+ALGORITHM = "HS256"
+
+settings = {
+    "secret": None,
+    "ttl": 900.0,
+    "epoch": 0,
+}
+
+_watermarks = {}  # {("sid", id) | ("hid", id) | ("city", CITY) | ("lab", CITY, LAB): unix time}
+_lock = threading.Lock()
+
+
+def configure_tokens(config):
+    settings.update({
+        # Tokens are disabled (heartbeat always looks devices up) without their own
+        # secret; never SUPABASE_JWT_SECRET, or Supabase JWTs would verify as device tokens
+        "secret": config.get("DEVICE_TOKEN_SECRET"),
+        "ttl": float(config.get("DEVICE_TOKEN_TTL", settings["ttl"])),
+        "epoch": int(config.get("DEVICE_TOKEN_EPOCH", settings["epoch"])),
+    })
+
+
+def enabled():
+    return bool(settings["secret"])
+
+
+def _norm(value):
+    return str(value).strip().upper() if value else ""
+
+
+def _keys(system_id=None, hardware_id=None, city=None, lab=None):
+    keys = []
+    if system_id:
+        keys.append(("sid", str(system_id)))
+    if hardware_id:
+        keys.append(("hid", hardware_id))
+    if city:
+        keys.append(("city", _norm(city)))
+        if lab:
+            keys.append(("lab", _norm(city), _norm(lab)))
+    return keys
+
+
+def _mark(keys, at):
+    with _lock:
+        for key in keys:
+            if at > _watermarks.get(key, 0):
+                _watermarks[key] = at
+
+
+def revoke(system_id=None, hardware_id=None, city=None, lab=None):
+    """Invalidate tokens (and cached device state) issued before now for the given scope."""
+    now = time.time()
+    keys = _keys(system_id, hardware_id, city, lab)
+    _mark(keys, now)
+    shared_state.publish("revoke", [keys, now])
+    TOKENS.inc("revocation")
+
+
+def _on_peer_revoke(message):
+    keys, at = message
+    _mark([tuple(key) for key in keys], at)
+
+
+shared_state.subscribe("revoke", _on_peer_revoke)
+
+
+def is_current(issued_at, system_id=None, hardware_id=None, city=None, lab=None):
+    """False if a revocation covering this device happened after `issued_at` (unix time)."""
+    for key in _keys(system_id, hardware_id, city, lab):
+        mark = _watermarks.get(key)
+        if mark is not None and issued_at < mark:
+            return False
+    return True
+
+
+def issue(device):
+    """Signed token for a bound device row (system_id, hardware_id, city, tehsil, lab_name), or None."""
+    if not enabled() or not device.get("hardware_id"):
+        return None
+    # Sub-second iat: a token issued right after a revocation must outlive it
+    now = time.time()
+    claims = {
+        "sub": device["hardware_id"],
+        "sid": str(device["system_id"]),
+        "city": device.get("city"),
+        "tehsil": device.get("tehsil"),
+        "lab": device.get("lab_name"),
+        "ep": settings["epoch"],
+        "iat": now,
+        "exp": int(now + settings["ttl"]),
+    }
+    TOKENS.inc("issued")
+    return jwt.encode(claims, settings["secret"], algorithm=ALGORITHM)
+
+
+def verify(token, hardware_id):
+    """Claims of a valid, unrevoked token for this hardware_id, else None (no I/O)."""
+    if not token or not enabled():
+        return None
+    try:
+        claims = jwt.decode(token, settings["secret"], algorithms=[ALGORITHM],
+                            options={"require": ["sub", "sid", "iat", "exp"]})
+    except jwt.ExpiredSignatureError:
+        TOKENS.inc("expired")
+        return None
+    except jwt.InvalidTokenError:
+        TOKENS.inc("invalid")
+        return None
+    if claims["sub"] != hardware_id or claims.get("ep") != settings["epoch"]:
+        TOKENS.inc("invalid")
+        return None
+    if not is_current(claims["iat"], claims["sid"], hardware_id, claims.get("city"), claims.get("lab")):
+        TOKENS.inc("revoked")
+        return None
+    if registry.loaded_at and registry.loaded_at > claims["iat"]:
+        row = registry.by_hardware_id(hardware_id)
+        if row is None or str(row["system_id"]) != claims["sid"]:
+            TOKENS.inc("revoked")
+            return None
+    TOKENS.inc("verified")
+    return claims
+
+
+def needs_refresh(claims):
+    """Past two thirds of its lifetime: hand the agent a new token with this response."""
+    return claims["exp"] - time.time() < settings["ttl"] / 3
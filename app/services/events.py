@@ -0,0 +1,251 @@
+"""
+Live device-update bus behind the SSE stream (GET /api/stream).
+
+Producers call `publish_device()` with whatever changed. Updates are
+coalesced per device and diffed against the last published state; every
+STREAM_COALESCE_SECONDS the pending deltas become one numbered frame kept in
+a ring buffer, so a reconnecting client can resume from `Last-Event-ID`.
+
+Frames are indexed by device, lab, tehsil and city, and the rendered
+payload is memoized per scope: a thousand viewers watching the same city
+cost one JSON join per frame, not a thousand.
+
+With several workers (shared_state "sqlite" backend) every published update
+and Socket.IO broadcast also goes over the shared bus, so each worker's
+viewers see the whole fleet. Frames are still numbered per process: a client
+that reconnects to a different worker gets a `reset` and refetches.
+"""
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import app.extensions as extensions
+from app.services import shared_state
+from app.utils import metrics
+from app.utils.logger import logger
+
+FRAMES = metrics.counter("lab_stream_frames_total", "Coalesced update frames published to the stream.")
+DEVICE_DELTAS = metrics.counter("lab_stream_device_deltas_total", "Per-device deltas published (after coalescing).")
+
+settings = {
+    "coalesce_seconds": 1.0,
+    "buffer_frames": 600,
+}
+
+
+def _norm(value):
+    return str(value).strip().upper() if value else "UNKNOWN"
+
+
+class Frame:
+    __slots__ = ("id", "seq", "ts", "items", "by_device", "by_lab", "by_tehsil", "by_city", "_rendered")
+
+    def __init__(self, epoch, seq, items):
+        self.id = f"{epoch}-{seq}"
+        self.seq = seq
+        self.ts = time.time()
+        self.items = items  # [(system_id, city, tehsil, lab, json)]
+        self.by_device, self.by_lab, self.by_tehsil, self.by_city = {}, {}, {}, {}
+        for i, (sid, city, tehsil, lab, _) in enumerate(items):
+            self.by_device.setdefault(sid, []).append(i)
+            self.by_lab.setdefault(lab, []).append(i)
+            self.by_tehsil.setdefault(tehsil, []).append(i)
+            self.by_city.setdefault(city, []).append(i)
+        self._rendered = {}
+
+    def render(self, scope):
+        """JSON array of the deltas visible to `scope` (None when nothing matches)."""
+        key = scope.key
+        if key in self._rendered:
+            return self._rendered[key]
+        if scope.devices:
+            index, dim = self.by_device, scope.devices
+        elif scope.labs:
+            index, dim = self.by_lab, scope.labs
+        elif scope.tehsils:
+            index, dim = self.by_tehsil, scope.tehsils
+        elif scope.cities:
+            index, dim = self.by_city, scope.cities
+        else:
+            index, dim = None, None
+
+        if index is None:
+            picked = self.items
+        else:
+            positions = sorted(i for value in dim for i in index.get(value, ()))
+            picked = [self.items[i] for i in positions if scope.matches(self.items[i])]
+        payload = "[" + ",".join(item[4] for item in picked) + "]" if picked else None
+        self._rendered[key] = payload
+        return payload
+
+
+class Scope:
+    """AND across dimensions, OR within one (?city=Lahore,Multan&lab=...)."""
+
+    def __init__(self, cities=(), tehsils=(), labs=(), devices=()):
+        self.cities = frozenset(_norm(c) for c in cities if c)
+        self.tehsils = frozenset(_norm(t) for t in tehsils if t)
+        self.labs = frozenset(_norm(l) for l in labs if l)
+        self.devices = frozenset(str(d) for d in devices if d)
+        self.key = (self.cities, self.tehsils, self.labs, self.devices)
+
+    def matches(self, item):
+        sid, city, tehsil, lab, _ = item
+        return ((not self.devices or sid in self.devices)
+                and (not self.labs or lab in self.labs)
+                and (not self.tehsils or tehsil in self.tehsils)
+                and (not self.cities or city in self.cities))
+
+
+class EventBus:
+    def __init__(self):
+        self._pending = {}       # {system_id: (city, tehsil, lab, {field: value})}
+        self._published = {}     # {system_id: {field: value}} last state sent
+        self._frames = deque(maxlen=settings["buffer_frames"])
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._thread = None
+        self._new_epoch()
+
+    def _new_epoch(self):
+        # Frame ids are "<epoch>-<seq>": ids from another process never resume here
+        self.epoch = f"{int(time.time()):x}{os.getpid():x}"
+
+    def configure(self, config):
+        settings["coalesce_seconds"] = float(config.get("STREAM_COALESCE_SECONDS", settings["coalesce_seconds"]))
+        settings["buffer_frames"] = int(config.get("STREAM_BUFFER_FRAMES", settings["buffer_frames"]))
+        with self._lock:
+            self._frames = deque(self._frames, maxlen=settings["buffer_frames"])
+
+    def publish_device(self, system_id, scope_row, fields):
+        """Queue changed fields of one device; scope_row carries its city/tehsil/lab_name."""
+        sid = str(system_id)
+        with self._lock:
+            entry = self._pending.get(sid)
+            if entry is None:
+                self._pending[sid] = (_norm(scope_row.get("city")), _norm(scope_row.get("tehsil")),
+                                      _norm(scope_row.get("lab_name")), dict(fields))
+            else:
+                entry[3].update(fields)
+
+    def _delta(self, sid, fields):
+        last = self._published.setdefault(sid, {})
+        delta = {}
+        for field, value in fields.items():
+            old = last.get(field)
+            if old == value:
+                continue
+            if isinstance(value, dict) and isinstance(old, dict) and old.keys() <= value.keys():
+                # Nested maps (app_usage): only the keys that changed
+                changed = {k: v for k, v in value.items() if old.get(k) != v}
+                delta[field] = changed
+            else:
+                delta[field] = value
+            last[field] = value
+        return delta
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return None
+        items = []
+        for sid, (city, tehsil, lab, fields) in pending.items():
+            delta = self._delta(sid, fields)
+            if delta:
+                items.append((sid, city, tehsil, lab, json.dumps({"system_id": sid, **delta}, default=str)))
+        if not items:
+            return None
+        with self._cond:
+            self._seq += 1
+            frame = Frame(self.epoch, self._seq, items)
+            self._frames.append(frame)
+            self._cond.notify_all()
+        FRAMES.inc()
+        DEVICE_DELTAS.inc(amount=len(items))
+        return frame
+
+    def _loop(self):
+        while True:
+            time.sleep(settings["coalesce_seconds"])
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"📡 Stream flush failed: {e}")
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._new_epoch()
+            self._thread = threading.Thread(target=self._loop, name="stream-coalescer", daemon=True)
+            self._thread.start()
+
+    @property
+    def last_id(self):
+        return f"{self.epoch}-{self._seq}"
+
+    def since(self, last_event_id):
+        """
+        Frames after `last_event_id`, or None when it can't be resumed
+        (another process epoch, or older than the ring buffer).
+        """
+        epoch, _, seq = (last_event_id or "").partition("-")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        with self._lock:
+            frames = list(self._frames)
+        if seq > self._seq:
+            return None
+        if seq < self._seq and (not frames or frames[0].seq > seq + 1):
+            return None
+        return [f for f in frames if f.seq > seq]
+
+    def wait(self, after_seq, timeout):
+        """
+        Block (cooperatively under gevent) until a frame newer than after_seq
+        exists. None when frames after after_seq already left the ring buffer:
+        the reader fell behind and its state can't be patched up with deltas.
+        """
+        with self._cond:
+            if self._seq <= after_seq:
+                self._cond.wait(timeout)
+            if self._seq <= after_seq:
+                return []
+            if not self._frames or self._frames[0].seq > after_seq + 1:
+                return None
+            return [f for f in self._frames if f.seq > after_seq]
+
+    @property
+    def seq(self):
+        return self._seq
+
+
+bus = EventBus()
+
+
+def publish_device(system_id, scope_row, fields):
+    bus.publish_device(system_id, scope_row, fields)
+    shared_state.publish("device", [str(system_id), {k: scope_row.get(k) for k in ("city", "tehsil", "lab_name")}, fields])
+
+
+def broadcast(event, payload):
+    """Socket.IO emit to the dashboards connected to every worker."""
+    extensions.socketio.emit(event, payload)
+    shared_state.publish("socketio", [event, payload])
+
+
+def _on_peer_device(message):
+    system_id, scope_row, fields = message
+    bus.publish_device(system_id, scope_row, fields)
+
+
+def _on_peer_socketio(message):
+    event, payload = message
+    extensions.socketio.emit(event, payload)
+
+
+shared_state.subscribe("device", _on_peer_device)
+shared_state.subscribe("socketio", _on_peer_socketio)
@@ -0,0 +1,136 @@
+"""
+Background-sampled health state behind /ready and /api/health.
+
+Health endpoints never do I/O themselves: the `health_sample` scheduler job
+refreshes `snapshot` every HEALTH_SAMPLE_INTERVAL seconds and the endpoints
+only read it. Backend reachability is taken from real traffic through the
+Supabase pool; a one-row probe is sent only when the pool has been idle for
+a whole interval, so probes add no database load while the server is busy.
+"""
+import time
+
+import app.extensions as extensions
+from app.services import leader, lifecycle, spool
+from app.services.registry import registry
+from app.services.scheduler import scheduler
+from app.utils import db_client
+from app.utils.logger import logger
+
+settings = {
+    "interval": 10.0,
+    "registry_max_age": 900.0,
+    "spool_high_water": 0.8,
+}
+
+snapshot = {"sampled_at": None}
+_sampled_mono = None
+
+
+def configure_health(config):
+    settings.update({
+        "interval": float(config.get("HEALTH_SAMPLE_INTERVAL", settings["interval"])),
+        # A few missed refreshes before the registry counts as stale
+        "registry_max_age": 3 * float(config.get("REGISTRY_REFRESH_INTERVAL", 300)),
+        "spool_high_water": float(config.get("HEALTH_SPOOL_HIGH_WATER", settings["spool_high_water"])),
+    })
+
+
+def _probe():
+    started = time.monotonic()
+    try:
+        extensions.supabase.table("devices").select("system_id").limit(1).execute()
+        return True, round((time.monotonic() - started) * 1000, 1), None
+    except Exception as e:
+        return False, round((time.monotonic() - started) * 1000, 1), str(e)
+
+
+def _backend_state():
+    now = time.monotonic()
+    transport = db_client.transport_stats
+    last_ok = transport.last_reachable if transport else None
+    last_bad = transport.last_unreachable if transport else None
+
+    if last_ok is not None and now - last_ok <= settings["interval"] and (last_bad is None or last_ok >= last_bad):
+        return {"reachable": True, "source": "traffic", "last_ok_seconds_ago": round(now - last_ok, 1)}
+    if last_bad is not None and now - last_bad <= settings["interval"] and (last_ok is None or last_bad > last_ok):
+        return {"reachable": False, "source": "traffic", "error": transport.last_unreachable_error}
+
+    # Idle pool: one cheap probe
+    ok, latency_ms, error = _probe()
+    state = {"reachable": ok, "source": "probe", "latency_ms": latency_ms}
+    if error:
+        state["error"] = error
+    return state
+
+
+def sample():
+    global _sampled_mono
+    backend = _backend_state()
+    backend["spool_degraded"] = spool.is_degraded()
+
+    reg = registry.stats()
+    reg["fresh"] = reg["warm"] and reg["age_seconds"] is not None and reg["age_seconds"] <= settings["registry_max_age"]
+
+    spool_stats = spool.get_spool_stats()
+    transport = db_client.get_transport_stats()
+    queues = {
+        "spool_pending_bytes": spool_stats["pending_bytes"],
+        "spool_fill": round(spool_stats["pending_bytes"] / spool_stats["max_bytes"], 4) if spool_stats["max_bytes"] else 0,
+        "spool_segments": spool_stats["segments"],
+        "db_in_flight": transport.get("pool", {}).get("in_flight", 0),
+    }
+
+    failing_jobs = sorted(name for name, job in scheduler.jobs.items() if job.last_error)
+
+    snapshot.clear()
+    snapshot.update({
+        "sampled_at": time.time(),
+        "backend": backend,
+        "registry": reg,
+        "queues": queues,
+        "failing_jobs": failing_jobs,
+        "leader": leader.stats(),
+    })
+    _sampled_mono = time.monotonic()
+    if not backend["reachable"]:
+        logger.warning(f"🩺 Backend unreachable ({backend['source']}): {backend.get('error')}")
+
+
+def readiness():
+    """
+    (body, http_status) from the cached snapshot; no I/O.
+
+    503 while starting up or when the sampler itself has stopped. A backend
+    outage only makes the process "degraded": writes are spooled locally, so
+    it should keep receiving traffic rather than be pulled from rotation.
+    """
+    age = None if _sampled_mono is None else time.monotonic() - _sampled_mono
+    if not lifecycle.is_ready():
+        status = "starting"
+    elif age is None or age > 3 * settings["interval"]:
+        status = "stale"
+    else:
+        degraded = (
+            not snapshot["backend"]["reachable"]
+            or snapshot["backend"]["spool_degraded"]
+            or not snapshot["registry"]["fresh"]
+            or snapshot["queues"]["spool_fill"] >= settings["spool_high_water"]
+            or bool(snapshot["failing_jobs"])
+        )
+        status = "degraded" if degraded else "ok"
+
+    body = {
+        "status": status,
+        "ready": status in ("ok", "degraded"),
+        "snapshot_age_seconds": None if age is None else round(age, 1),
+        **{k: v for k, v in snapshot.items() if k != "sampled_at"},
+    }
+    return body, (200 if body["ready"] else 503)
+
+
+def database_state():
+    """'connected' / 'unreachable' / 'unknown' from the last sample."""
+    backend = snapshot.get("backend")
+    if not backend:
+        return "unknown"
+    return "connected" if backend["reachable"] else "unreachable"
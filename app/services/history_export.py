@@ -0,0 +1,122 @@
+"""
+Bulk export of device_daily_history (GET /api/export/history).
+
+Rows are read in primary-key order (device_id, history_date) with keyset
+pagination: each page asks for the rows strictly after the last key of the
+previous page instead of an OFFSET, so the backend does the same bounded
+index walk for the last page of a year-long, fleet-wide export as for the
+first. Every page is encoded and handed to the response as soon as it
+arrives; memory holds one page whatever the size of the export.
+"""
+import csv
+import io
+import json
+from datetime import date
+
+import app.extensions as extensions
+from app.utils import metrics
+
+EXPORT_ROWS = metrics.counter("lab_export_rows_total", "Rows streamed by /api/export/history.", ("format",))
+
+COLUMNS = ["device_id", "history_date", "city", "tehsil", "lab_name",
+           "runtime_minutes", "avg_score", "start_time", "end_time", "app_usage"]
+
+# Scope path segments, outermost first, and the history columns they filter
+SCOPE_LEVELS = ("city", "tehsil", "lab_name")
+
+settings = {
+    "page_size": 1000,
+    "max_days": 400,
+}
+
+
+def configure_export(config):
+    settings.update({
+        "page_size": int(config.get("EXPORT_PAGE_SIZE", settings["page_size"])),
+        "max_days": int(config.get("EXPORT_MAX_DAYS", settings["max_days"])),
+    })
+
+
+def parse_range(start, end):
+    """(from, to) dates from ISO strings; `to` defaults to today. Raises ValueError."""
+    if not start:
+        raise ValueError("'from' is required (YYYY-MM-DD)")
+    start = date.fromisoformat(start)
+    end = date.fromisoformat(end) if end else date.today()
+    if end < start:
+        raise ValueError("'to' is before 'from'")
+    if (end - start).days + 1 > settings["max_days"]:
+        raise ValueError(f"range exceeds {settings['max_days']} days")
+    return start, end
+
+
+def parse_scope(scope):
+    """
+    {column: value} for a scope of the form CITY[/TEHSIL[/LAB]]; an empty
+    segment matches anything (e.g. "Lahore//Lab 1"). Empty or "all" = fleet.
+    """
+    if not scope or scope.strip().lower() == "all":
+        return {}
+    parts = [p.strip() for p in scope.split("/")]
+    if len(parts) > len(SCOPE_LEVELS) or not parts[0]:
+        raise ValueError("scope must look like CITY[/TEHSIL[/LAB]]")
+    return {col: value for col, value in zip(SCOPE_LEVELS, parts) if value}
+
+
+def _quote(value):
+    # PostgREST double-quoted literal: safe inside or=(...) whatever the id contains
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def iter_pages(start, end, scope):
+    """Lists of history rows in (device_id, history_date) order, one backend page at a time."""
+    page_size = settings["page_size"]
+    after = None
+    while True:
+        query = extensions.supabase.table("device_daily_history")\
+            .select(", ".join(COLUMNS))\
+            .gte("history_date", start.isoformat())\
+            .lte("history_date", end.isoformat())
+        for column, value in scope.items():
+            query = query.ilike(column, value)
+        if after is not None:
+            device_id, day = after
+            query = query.or_(f"device_id.gt.{_quote(device_id)},"
+                              f"and(device_id.eq.{_quote(device_id)},history_date.gt.{day})")
+        rows = query.order("device_id").order("history_date").limit(page_size).execute().data or []
+        if rows:
+            yield rows
+        if len(rows) < page_size:
+            return
+        after = (rows[-1]["device_id"], rows[-1]["history_date"])
+
+
+def _encode_csv(pages):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(COLUMNS)
+    for rows in pages:
+        for row in rows:
+            writer.writerow([
+                json.dumps(row.get(c) or {}, separators=(",", ":")) if c == "app_usage" else row.get(c)
+                for c in COLUMNS
+            ])
+        EXPORT_ROWS.inc("csv", amount=len(rows))
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def _encode_ndjson(pages):
+    for rows in pages:
+        EXPORT_ROWS.inc("ndjson", amount=len(rows))
+        yield "".join(json.dumps({c: row.get(c) for c in COLUMNS}, separators=(",", ":")) + "\n" for row in rows)
+
+
+# format -> (mimetype, encoder over iter_pages)
+FORMATS = {
+    "csv": ("text/csv", _encode_csv),
+    "ndjson": ("application/x-ndjson", _encode_ndjson),
+}
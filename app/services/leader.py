@@ -0,0 +1,147 @@
+"""
+Leader election for the background jobs that write to the database.
+
+Every gunicorn worker runs the scheduler, but fleet-wide jobs (offline sweep,
+retention, shared action expiry) only need to run once per host: the worker
+holding an exclusive file lock on LEADER_LOCK_PATH runs them, the others stand
+by. The kernel drops the lock when its holder exits or is killed, and the
+standby workers retry every LEADER_RENEW_INTERVAL, so a new leader takes
+over within one interval of the old one dying.
+
+The leader renews a lease record in the lock file ({pid, since, renewed_at})
+on the same interval. A lock can't be stolen from a live process, so the
+record is what tells a wedged leader from a busy one: standbys log when it
+is older than LEADER_LEASE_TTL, and /ready and /api/health show it.
+
+The lock is per host (per SPOOL_DIR); several hosts against one database
+would still each elect their own leader.
+"""
+import json
+import os
+import threading
+import time
+
+from app.utils import metrics
+from app.utils.file_lock import try_lock
+from app.utils.logger import logger
+
+LEADER_ACQUIRED = metrics.counter("lab_leader_acquired_total", "Times this process became the background job leader.")
+
+settings = {
+    "path": os.path.join("spool", "leader.lock"),
+    "renew_interval": 5.0,
+    "lease_ttl": 30.0,
+}
+
+_state = {
+    "file": None,       # open lock file while we lead
+    "pid": None,        # process that started the election thread
+    "since": None,      # wall clock time leadership was gained
+    "renewed_at": None,
+    "stale_logged": False,
+}
+_lock = threading.Lock()
+
+
+def configure_leader(config):
+    settings.update({
+        "path": config.get("LEADER_LOCK_PATH") or os.path.join(config.get("SPOOL_DIR", "spool"), "leader.lock"),
+        "renew_interval": float(config.get("LEADER_RENEW_INTERVAL", settings["renew_interval"])),
+        "lease_ttl": float(config.get("LEADER_LEASE_TTL", settings["lease_ttl"])),
+    })
+
+
+def is_leader():
+    return _state["file"] is not None and _state["pid"] == os.getpid()
+
+
+def _write_lease(fh, now):
+    fh.seek(0)
+    fh.truncate()
+    fh.write(json.dumps({"pid": os.getpid(), "since": _state["since"], "renewed_at": now}))
+    fh.flush()
+    _state["renewed_at"] = now
+
+
+def _read_lease():
+    try:
+        with open(settings["path"]) as fh:
+            return json.loads(fh.read() or "null")
+    except (OSError, ValueError):
+        return None
+
+
+def _try_acquire():
+    os.makedirs(os.path.dirname(settings["path"]) or ".", exist_ok=True)
+    # "a+" so a standby's open never truncates the leader's record
+    return try_lock(settings["path"], "a+")
+
+
+def _step():
+    """Renew the lease if we lead, otherwise try to take it over."""
+    now = time.time()
+    with _lock:
+        if is_leader():
+            try:
+                _write_lease(_state["file"], now)
+            except OSError as e:
+                # The lock is still ours; only the record is behind
+                logger.warning(f"👑 Could not renew leader lease: {e}")
+            return True
+        fh = _try_acquire()
+        if fh is None:
+            lease = _read_lease()
+            stale = bool(lease) and now - float(lease.get("renewed_at") or 0) > settings["lease_ttl"]
+            if stale and not _state["stale_logged"]:
+                logger.warning(f"👑 Leader pid {lease.get('pid')} holds the lock but has not renewed "
+                               f"its lease for {now - float(lease.get('renewed_at') or 0):.0f}s")
+            _state["stale_logged"] = stale
+            return False
+        _state.update(file=fh, since=now, stale_logged=False)
+        _write_lease(fh, now)
+    LEADER_ACQUIRED.inc()
+    logger.info(f"👑 pid {os.getpid()} is now the background job leader")
+    return True
+
+
+def _loop():
+    while True:
+        time.sleep(settings["renew_interval"])
+        try:
+            _step()
+        except Exception as e:
+            logger.error(f"👑 Leader election step failed: {e}")
+
+
+def start_leader_election():
+    """Try for leadership now and keep trying / renewing in the background (once per process)."""
+    if _state["pid"] == os.getpid():
+        return is_leader()
+    # A forked child inherits its parent's open lock file but is not the leader
+    _state.update(file=None, since=None, renewed_at=None, stale_logged=False, pid=os.getpid())
+    leading = _step()
+    threading.Thread(target=_loop, name="leader-lease", daemon=True).start()
+    return leading
+
+
+def stats():
+    lease = {"pid": os.getpid(), "since": _state["since"], "renewed_at": _state["renewed_at"]} \
+        if is_leader() else _read_lease()
+    age = None
+    if lease and lease.get("renewed_at"):
+        age = round(time.time() - float(lease["renewed_at"]), 1)
+    return {
+        "is_leader": is_leader(),
+        "leader_pid": lease.get("pid") if lease else None,
+        "lease_age_seconds": age,
+        "lease_stale": age is not None and age > settings["lease_ttl"],
+    }
+
+
+@metrics.register_collector
+def _collect_leader():
+    return [
+        "# HELP lab_leader Whether this process runs the leader-only background jobs.",
+        "# TYPE lab_leader gauge",
+        f"lab_leader {int(is_leader())}",
+    ]
@@ -0,0 +1,66 @@
+"""
+Explicit start of per-process background services.
+
+create_app() has no side effects beyond building the Flask app, so it is
+safe to run in the preloading gunicorn master. Everything that spawns
+threads or touches the backend starts here, once per process, after fork:
+gunicorn's post_worker_init hook (gunicorn_config.py), `python wsgi.py`, or
+as a fallback the first request the process serves.
+"""
+import os
+import threading
+
+from app.utils import startup
+from app.utils.logger import logger
+
+_lock = threading.Lock()
+_started_pid = None
+state = {"started": False, "warm": False}
+
+
+def _warm_up():
+    from app.services.registry import warm_up
+    from app.services import health
+    if warm_up():
+        state["warm"] = True
+        health.sample()
+        startup.mark("warm_up")
+        logger.info(f"🚀 Ready in {startup.since_start_ms():.0f}ms since import: {startup.report()['phases_ms']}")
+
+
+def start_background_services(app):
+    """Start shared state, spool replay, the stream coalescer, leader election, the job scheduler and the cache warm-up (idempotent per process)."""
+    global _started_pid
+    if _started_pid == os.getpid():
+        return False
+    with _lock:
+        if _started_pid == os.getpid():
+            return False
+        # A forked child inherits the parent's flags but none of its threads
+        state.update(started=False, warm=False)
+
+        from app.services.spool import init_spool
+        from app.services.jobs import register_default_jobs
+        from app.services.scheduler import scheduler
+        from app.services.events import bus
+        from app.services.shared_state import start_shared_state
+        from app.services.leader import start_leader_election
+
+        start_shared_state()
+        init_spool(app.config)
+        bus.configure(app.config)
+        bus.start()
+        register_default_jobs(app.config)
+        start_leader_election()
+        scheduler.start()
+        threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
+
+        _started_pid = os.getpid()
+        state["started"] = True
+        startup.mark("background_start")
+        logger.info(f"⚙️ Background services started in pid {_started_pid}")
+        return True
+
+
+def is_ready():
+    return state["started"] and state["warm"]
@@ -0,0 +1,309 @@
+"""
+In-memory device registry: identity and hierarchy of every device slot,
+indexed by system_id and (for bound machines) hardware_id.
+
+Loaded on boot by the warm-up (keyset-paged, so a large fleet doesn't need
+one huge response) and refreshed periodically by the scheduler. The process
+only reports ready (/ready) once the first load has completed.
+
+It also keeps a hierarchy index, city -> tehsil -> lab -> {system_id}, keyed
+by the loosest name match any filter applies (scope_name: letters and digits
+only, so "Lab-1", "lab1" and "LAB 1" share a branch); scope_ids() narrows
+that to the stats' exact match (aggregation.normalize_name) unless asked
+for the loose one. Routes
+that change identity or hierarchy (registration, bind, auth, renames,
+deletes, heartbeats that move a machine) pass the rows their write returned
+to apply(), which also publishes them to the other workers, so scope
+filters go from the index straight to `devices` by primary key
+(fetch_rows) instead of scanning a city or the whole fleet. A refresh
+re-applies whatever apply() / discard() changed while it was fetching, so
+its older snapshot can't undo them.
+"""
+import re
+import threading
+import time
+
+import app.extensions as extensions
+from app.services import shared_state
+from app.services.aggregation import normalize_name
+from app.utils import metrics
+from app.utils.logger import logger
+
+COLUMNS = "system_id, hardware_id, pc_name, city, tehsil, lab_name"
+FIELDS = tuple(c.strip() for c in COLUMNS.split(","))
+PAGE_SIZE = 1000
+# system_ids per `in.(...)` lookup: keeps the request URL well under proxy limits
+FETCH_CHUNK = 200
+
+
+def scope_key(row):
+    """(city, tehsil, lab) of a devices row, normalized like the stats group them."""
+    return (normalize_name(row.get("city")), normalize_name(row.get("tehsil")),
+            normalize_name(row.get("lab_name") or "Main Lab"))
+
+
+def scope_name(name):
+    """Lower-case letters and digits only: how the device list filters compare names."""
+    if not name: return ""
+    return re.sub(r"[^a-z0-9]", "", str(name).lower())
+
+
+def _tree_key(row):
+    return (scope_name(row.get("city") or "Unknown"), scope_name(row.get("tehsil") or "Unknown"),
+            scope_name(row.get("lab_name") or "Main Lab"))
+
+
+class DeviceRegistry:
+    def __init__(self):
+        self._by_system_id = {}
+        self._by_hardware_id = {}
+        self._tree = {}  # {city: {tehsil: {lab: {system_id}}}}, scope_name keys
+        self._lock = threading.Lock()
+        self._refreshing = 0  # refreshes fetching right now
+        self._journal = []    # [(op, arg)] apply / discard calls made meanwhile
+        self.loaded_at = None        # wall clock of the last successful load
+        self._loaded_mono = None
+        self.load_seconds = None
+        self.loads = 0
+        self.failures = 0
+        self.last_error = None
+
+    def _fetch_all(self):
+        rows, last = [], None
+        while True:
+            query = extensions.supabase.table("devices").select(COLUMNS).order("system_id").limit(PAGE_SIZE)
+            if last is not None:
+                query = query.gt("system_id", last)
+            batch = query.execute().data or []
+            rows.extend(batch)
+            if len(batch) < PAGE_SIZE:
+                return rows
+            last = batch[-1]["system_id"]
+
+    def _end_refresh(self):
+        self._refreshing -= 1
+        if not self._refreshing:
+            self._journal = []
+
+    def refresh(self):
+        started = time.monotonic()
+        with self._lock:
+            self._refreshing += 1
+            since = len(self._journal)
+        try:
+            rows = self._fetch_all()
+        except Exception as e:
+            with self._lock:
+                self._end_refresh()
+            self.failures += 1
+            self.last_error = str(e)
+            raise
+        by_sid = {str(r["system_id"]): r for r in rows}
+        by_hid = {r["hardware_id"]: r for r in rows if r.get("hardware_id")}
+        tree = {}
+        for sid, r in by_sid.items():
+            self._place(tree, sid, r)
+        with self._lock:
+            self._by_system_id, self._by_hardware_id, self._tree = by_sid, by_hid, tree
+            # The snapshot may predate these (the page was read before the write)
+            for op, arg in self._journal[since:]:
+                if op == "apply":
+                    self._apply_locked(arg)
+                else:
+                    self._discard_locked(arg)
+            self._end_refresh()
+            self.loaded_at = time.time()
+            self._loaded_mono = time.monotonic()
+            self.load_seconds = round(time.monotonic() - started, 3)
+            self.loads += 1
+            self.last_error = None
+        return len(rows)
+
+    @staticmethod
+    def _place(tree, sid, row):
+        city, tehsil, lab = _tree_key(row)
+        tree.setdefault(city, {}).setdefault(tehsil, {}).setdefault(lab, set()).add(sid)
+
+    def _unplace(self, sid, row):
+        city, tehsil, lab = _tree_key(row)
+        tehsils = self._tree.get(city, {})
+        labs = tehsils.get(tehsil, {})
+        members = labs.get(lab)
+        if members is None:
+            return
+        members.discard(sid)
+        # Drop emptied branches so renamed-away names stop showing up as scopes
+        if not members:
+            del labs[lab]
+            if not labs:
+                del tehsils[tehsil]
+                if not tehsils:
+                    del self._tree[city]
+
+    def _forget(self, sid):
+        row = self._by_system_id.pop(sid, None)
+        if row is None:
+            return None
+        self._unplace(sid, row)
+        hid = row.get("hardware_id")
+        if hid and self._by_hardware_id.get(hid) is row:
+            del self._by_hardware_id[hid]
+        return row
+
+    def apply(self, rows, publish=True):
+        """
+        Take in devices rows just written (or partial rows with system_id);
+        returns how many changed identity or hierarchy. Changes are published
+        to the other workers unless they came from one.
+        """
+        rows = [row for row in rows or [] if row and row.get("system_id") is not None]
+        with self._lock:
+            if self._refreshing:
+                self._journal.append(("apply", rows))
+            changed = self._apply_locked(rows)
+        if changed and publish:
+            shared_state.publish("registry", {"rows": changed})
+        return len(changed)
+
+    def _apply_locked(self, rows):
+        changed = []
+        for row in rows:
+            sid = str(row["system_id"])
+            old = self._by_system_id.get(sid)
+            new = {**(old or {}), **{f: row[f] for f in FIELDS if f in row}}
+            if new == old:
+                continue
+            self._forget(sid)
+            if new.get("hardware_id"):
+                # The machine left whatever slot it was bound to before
+                stale = self._by_hardware_id.get(new["hardware_id"])
+                if stale is not None and str(stale["system_id"]) != sid:
+                    self._by_system_id[str(stale["system_id"])] = {**stale, "hardware_id": None}
+                self._by_hardware_id[new["hardware_id"]] = new
+            self._by_system_id[sid] = new
+            self._place(self._tree, sid, new)
+            changed.append(new)
+        return changed
+
+    def discard(self, system_ids, publish=True):
+        """Forget slots that no longer exist (a registration that moved a machine to a new system_id)."""
+        sids = [str(sid) for sid in system_ids]
+        with self._lock:
+            if self._refreshing:
+                self._journal.append(("discard", sids))
+            gone = self._discard_locked(sids)
+        if gone and publish:
+            shared_state.publish("registry", {"discard": gone})
+        return len(gone)
+
+    def _discard_locked(self, sids):
+        return [sid for sid in sids if self._forget(sid) is not None]
+
+    def scope_ids(self, city=None, tehsil=None, lab=None, exact=True):
+        """
+        system_ids in a scope; None / "" for a level matches everything under it.
+        Names match like the stats group them (normalize_name), or with
+        exact=False like the device list filters them (scope_name).
+        """
+        given = (city, tehsil, lab)
+        want = [scope_name(v) if v else None for v in given]
+        found = set()
+        with self._lock:
+            cities = [self._tree.get(want[0], {})] if want[0] else self._tree.values()
+            for tehsils in cities:
+                for labs in ([tehsils.get(want[1], {})] if want[1] else tehsils.values()):
+                    for members in ([labs.get(want[2], ())] if want[2] else labs.values()):
+                        found.update(members)
+            if exact and found:
+                target = [normalize_name(v) if v else None for v in given]
+                found = {sid for sid in found
+                         if all(t is None or t == k for t, k in zip(target, scope_key(self._by_system_id[sid])))}
+        return found
+
+    def is_warm(self):
+        return self.loaded_at is not None
+
+    def age_seconds(self):
+        return None if self._loaded_mono is None else time.monotonic() - self._loaded_mono
+
+    def by_hardware_id(self, hid):
+        return self._by_hardware_id.get(hid)
+
+    def by_system_id(self, sid):
+        return self._by_system_id.get(str(sid))
+
+    def bound_devices(self):
+        """Rows that currently have a hardware_id bound (a snapshot list)."""
+        return list(self._by_hardware_id.values())
+
+    def __len__(self):
+        return len(self._by_system_id)
+
+    def stats(self):
+        age = self.age_seconds()
+        return {
+            "warm": self.is_warm(),
+            "devices": len(self._by_system_id),
+            "bound": len(self._by_hardware_id),
+            "cities": len(self._tree),
+            "loads": self.loads,
+            "failures": self.failures,
+            "last_load_seconds": self.load_seconds,
+            "age_seconds": None if age is None else round(age, 1),
+            "last_error": self.last_error,
+        }
+
+
+registry = DeviceRegistry()
+
+
+def warm_up(max_wait=300.0):
+    """Load the registry, retrying with backoff until it succeeds or `max_wait` passes."""
+    delay, deadline = 1.0, time.monotonic() + max_wait
+    while True:
+        try:
+            count = registry.refresh()
+            logger.info(f"🗂️ Device registry warm: {count} devices in {registry.load_seconds}s")
+            return True
+        except Exception as e:
+            if time.monotonic() + delay > deadline:
+                logger.error(f"🗂️ Device registry warm-up gave up: {e}")
+                return False
+            logger.warning(f"🗂️ Device registry warm-up failed ({e}), retrying in {delay:.0f}s")
+            time.sleep(delay)
+            delay = min(delay * 2, 30.0)
+
+
+def refresh_registry():
+    registry.refresh()
+
+
+def fetch_rows(system_ids, columns="*"):
+    """devices rows for the given system_ids, by primary key in FETCH_CHUNK lookups."""
+    ids = sorted(system_ids)
+    rows = []
+    for i in range(0, len(ids), FETCH_CHUNK):
+        res = extensions.supabase.table("devices").select(columns).in_("system_id", ids[i:i + FETCH_CHUNK]).execute()
+        rows.extend(res.data or [])
+    return rows
+
+
+def _on_peer_registry(message):
+    registry.discard(message.get("discard") or [], publish=False)
+    registry.apply(message.get("rows"), publish=False)
+
+
+shared_state.subscribe("registry", _on_peer_registry)
+
+
+@metrics.register_collector
+def _collect_registry():
+    age = registry.age_seconds()
+    return [
+        "# HELP lab_registry_devices Device slots held in the in-memory registry.",
+        "# TYPE lab_registry_devices gauge",
+        f"lab_registry_devices {len(registry)}",
+        "# HELP lab_registry_age_seconds Seconds since the registry was last loaded (-1 = never).",
+        "# TYPE lab_registry_age_seconds gauge",
+        f"lab_registry_age_seconds {-1 if age is None else round(age, 1)}",
+    ]
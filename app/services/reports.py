@@ -0,0 +1,320 @@
+"""
+Asynchronous report jobs (POST /api/reports, GET /api/reports/<id>).
+
+Questions like "labs unused in the last 30 days, by tehsil" need a pass over
+device_daily_history, far more than a request should do inline. Submitting a
+report only validates its parameters and queues it; a small pool of worker
+threads (greenlets under gevent) computes it and the result is kept for
+REPORT_RESULT_TTL. Submitting the same report with the same parameters
+while one is queued, running or fresh returns that job instead of starting
+another, so a dashboard polling the same question costs one computation.
+Job records are SharedTTLMaps: with several workers any of them can answer
+GET /api/reports/<id>, whichever one computes it. The queue itself is in
+the process that took the submission, so a job another process still shows
+as queued or running REPORT_STALE_SECONDS after it was queued / started
+is taken as lost with it (a restarted worker): it reads as failed and the
+next submission starts a new one (well before REPORT_RESULT_TTL, when the
+record of a lost job would expire anyway).
+
+Workers read history with the export's keyset pages and yield between
+pages, so a long report never monopolizes the process that serves
+heartbeats. History rows are attributed to a lab through the device's
+current devices row (renames don't rewrite history); each live devices row
+also counts for the day of its last_seen, which covers today and any day
+not yet archived to history (device_sessions only keeps the last 24 h).
+"""
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+import app.extensions as extensions
+from app.services import history_export
+from app.services.shared_state import SharedTTLMap
+from app.services.aggregation import is_actually_used, normalize_name
+from app.utils import metrics
+from app.utils.logger import logger
+
+REPORT_JOBS = metrics.counter("lab_report_jobs_total", "Report job lifecycle events.", ("kind", "event"))
+REPORT_DURATION = metrics.histogram(
+    "lab_report_duration_seconds", "Report computation time.", ("kind",),
+    buckets=(0.5, 1, 5, 15, 30, 60, 120, 300, 600))
+
+DEVICE_COLUMNS = "system_id, city, tehsil, lab_name, runtime_minutes, app_usage, last_seen"
+PAGE_SIZE = 1000
+
+settings = {
+    "workers": 1,
+    "result_ttl": 900.0,
+    "max_pending": 20,
+    "max_jobs": 500,
+    "stale_after": 300.0,
+}
+
+
+def configure_reports(config):
+    settings.update({
+        "workers": int(config.get("REPORT_WORKERS", settings["workers"])),
+        "result_ttl": float(config.get("REPORT_RESULT_TTL", settings["result_ttl"])),
+        "max_pending": int(config.get("REPORT_MAX_PENDING", settings["max_pending"])),
+        "max_jobs": int(config.get("REPORT_MAX_JOBS", settings["max_jobs"])),
+        "stale_after": float(config.get("REPORT_STALE_SECONDS", settings["stale_after"])),
+    })
+    _jobs.configure(ttl=settings["result_ttl"], max_size=settings["max_jobs"])
+    _latest.configure(ttl=settings["result_ttl"], max_size=settings["max_jobs"])
+
+
+class QueueFull(Exception):
+    """Too many reports waiting; the caller should retry later."""
+
+
+class ReportJob:
+    __slots__ = ("id", "kind", "params", "state", "owner", "submitted_at", "started_at", "finished_at",
+                 "result", "error")
+
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex[:16]
+        self.kind = kind
+        self.params = params
+        self.state = "queued"
+        self.owner = os.getpid()  # the process whose queue holds it
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+
+    def as_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+# --- data passes --------------------------------------------------------------
+
+def _today():
+    return datetime.now(timezone.utc).date()
+
+
+def _in_scope(device, scope):
+    return all(normalize_name(device.get(col)) == normalize_name(value) for col, value in scope.items())
+
+
+def _lab_key(device):
+    return (normalize_name(device.get("city")),
+            normalize_name(device.get("tehsil")),
+            normalize_name(device.get("lab_name") or "Main Lab"))
+
+
+def _lab_days(start, end, scope):
+    """
+    {lab key: {"city", "tehsil", "lab", "pcs", "days_used": set, "runtime_minutes",
+    "last_seen"}} over [start, end] for the labs in scope.
+    """
+    labs, device_lab = {}, {}
+    last = None
+    while True:
+        query = extensions.supabase.table("devices").select(DEVICE_COLUMNS).order("system_id").limit(PAGE_SIZE)
+        if last is not None:
+            query = query.gt("system_id", last)
+        batch = query.execute().data or []
+        for d in batch:
+            if not _in_scope(d, scope):
+                continue
+            key = _lab_key(d)
+            lab = labs.get(key)
+            if lab is None:
+                lab = labs[key] = {
+                    "city": key[0], "tehsil": key[1], "lab": key[2], "pcs": 0,
+                    "days_used": set(), "runtime_minutes": 0, "last_seen": None,
+                }
+            lab["pcs"] += 1
+            device_lab[str(d["system_id"])] = lab
+            seen = (d.get("last_seen") or "")[:10]
+            if seen:
+                lab["last_seen"] = max(lab["last_seen"] or seen, seen)
+                # The live row is the usage of its last_seen day until it gets archived
+                if start.isoformat() <= seen <= end.isoformat() and \
+                        is_actually_used(d.get("runtime_minutes"), d.get("app_usage")):
+                    lab["days_used"].add(seen)
+        if len(batch) < PAGE_SIZE:
+            break
+        last = batch[-1]["system_id"]
+        time.sleep(0)
+
+    for rows in history_export.iter_pages(start, end, {}):
+        for row in rows:
+            lab = device_lab.get(str(row.get("device_id")))
+            if lab is None:
+                continue
+            try:
+                lab["runtime_minutes"] += int(row.get("runtime_minutes") or 0)
+            except (TypeError, ValueError):
+                pass
+            if is_actually_used(row.get("runtime_minutes"), row.get("app_usage")):
+                lab["days_used"].add(row["history_date"])
+        # Let heartbeats through between pages
+        time.sleep(0)
+    return labs
+
+
+def _range_params(params, default_days):
+    """Canonical {"from", "to", "scope"} from either days=N or from/to. Raises ValueError."""
+    if params.get("from"):
+        start, end = history_export.parse_range(params.get("from"), params.get("to"))
+    else:
+        days = int(params.get("days", default_days))
+        if days < 1:
+            raise ValueError("days must be at least 1")
+        end = _today()
+        start, end = history_export.parse_range((end - timedelta(days=days - 1)).isoformat(), end.isoformat())
+    scope = params.get("scope") or ""
+    history_export.parse_scope(scope)
+    return {"from": start.isoformat(), "to": end.isoformat(), "scope": scope.strip()}
+
+
+def _unpack(params):
+    return (date.fromisoformat(params["from"]), date.fromisoformat(params["to"]),
+            history_export.parse_scope(params["scope"]))
+
+
+def unused_labs(params):
+    """Labs with no actually-used day in the range, grouped by (city, tehsil)."""
+    labs = _lab_days(*_unpack(params))
+    tehsils = {}
+    for lab in labs.values():
+        group = tehsils.setdefault((lab["city"], lab["tehsil"]), {
+            "city": lab["city"], "tehsil": lab["tehsil"], "total_labs": 0, "unused_labs": [],
+        })
+        group["total_labs"] += 1
+        if not lab["days_used"]:
+            group["unused_labs"].append({"lab": lab["lab"], "pcs": lab["pcs"], "last_seen": lab["last_seen"]})
+    groups = sorted(tehsils.values(), key=lambda g: (g["city"], g["tehsil"]))
+    for group in groups:
+        group["unused_labs"].sort(key=lambda l: l["lab"])
+    return {
+        **params,
+        "total_labs": len(labs),
+        "unused_total": sum(len(g["unused_labs"]) for g in groups),
+        "tehsils": [g for g in groups if g["unused_labs"]],
+    }
+
+
+def lab_usage(params):
+    """Days used and archived runtime per lab over the range."""
+    labs = _lab_days(*_unpack(params))
+    rows = [{
+        "city": lab["city"], "tehsil": lab["tehsil"], "lab": lab["lab"], "pcs": lab["pcs"],
+        "days_used": len(lab["days_used"]),
+        "last_used": max(lab["days_used"]) if lab["days_used"] else None,
+        "runtime_minutes": lab["runtime_minutes"],
+    } for lab in labs.values()]
+    rows.sort(key=lambda r: (r["city"], r["tehsil"], r["lab"]))
+    return {**params, "labs": rows}
+
+
+# kind -> (parameter validation, computation)
+REPORTS = {
+    "unused_labs": (lambda p: _range_params(p, 30), unused_labs),
+    "lab_usage": (lambda p: _range_params(p, 30), lab_usage),
+}
+
+
+# --- jobs ----------------------------------------------------------------------
+
+_jobs = SharedTTLMap("report_jobs", ttl=settings["result_ttl"], max_size=settings["max_jobs"])    # {job_id: job dict}
+_latest = SharedTTLMap("report_keys", ttl=settings["result_ttl"], max_size=settings["max_jobs"])  # {"kind params": job_id}
+_pending = queue.Queue()
+_workers = []
+_lock = threading.Lock()
+
+
+def _save(job):
+    _jobs.set(job.id, job.as_dict())
+
+
+def _run(job):
+    job.state, job.started_at = "running", time.time()
+    _save(job)
+    started = time.monotonic()
+    try:
+        job.result = REPORTS[job.kind][1](job.params)
+        job.state = "done"
+        logger.info(f"📊 Report {job.kind} {job.id} done in {time.monotonic() - started:.1f}s")
+    except Exception as e:
+        job.state, job.error = "failed", str(e)
+        logger.error(f"Report {job.kind} {job.id} failed: {e}")
+    job.finished_at = time.time()
+    REPORT_DURATION.observe(time.monotonic() - started, job.kind)
+    REPORT_JOBS.inc(job.kind, job.state)
+    # Completion starts the result's TTL
+    _save(job)
+
+
+def _worker():
+    while True:
+        job = _pending.get()
+        try:
+            _run(job)
+        finally:
+            _pending.task_done()
+
+
+def _ensure_workers():
+    with _lock:
+        while len(_workers) < settings["workers"]:
+            t = threading.Thread(target=_worker, name=f"report-worker-{len(_workers)}", daemon=True)
+            t.start()
+            _workers.append(t)
+
+
+def _abandoned(job):
+    """
+    A queued / running job from another process that has been at it for too
+    long: that process restarted and took its queue along.
+    """
+    if job["state"] not in ("queued", "running") or job.get("owner") == os.getpid():
+        return False
+    since = job["started_at"] or job["submitted_at"]
+    return time.time() - since > settings["stale_after"]
+
+
+def submit(kind, params, refresh=False):
+    """
+    (job dict, reused) for a report request. Raises KeyError for an unknown kind,
+    ValueError for bad parameters and QueueFull when too many are waiting.
+    """
+    prepare = REPORTS[kind][0]
+    params = prepare(params or {})
+    key = f"{kind} {json.dumps(params, sort_keys=True)}"
+    if not refresh:
+        job = _jobs.get(_latest.get(key))
+        if job is not None and job["state"] != "failed" and not _abandoned(job):
+            REPORT_JOBS.inc(kind, "reused")
+            return job, True
+    if _pending.qsize() >= settings["max_pending"]:
+        REPORT_JOBS.inc(kind, "rejected")
+        raise QueueFull(f"{_pending.qsize()} reports already pending")
+    job = ReportJob(kind, params)
+    _save(job)
+    _latest.set(key, job.id)
+    _ensure_workers()
+    _pending.put(job)
+    REPORT_JOBS.inc(kind, "submitted")
+    return job.as_dict(), False
+
+
+def _view(job):
+    if job is not None and _abandoned(job):
+        return {**job, "state": "failed", "error": "abandoned: the worker that queued it restarted"}
+    return job
+
+
+def get(job_id):
+    return _view(_jobs.get(job_id))
+
+
+def recent():
+    jobs = [{k: v for k, v in _view(job).items() if k != "result"} for _, job in _jobs.items()]
+    return sorted(jobs, key=lambda j: j["submitted_at"], reverse=True)
@@ -0,0 +1,174 @@
+"""
+Retention pruning for transient tables (device_sessions, app_usage_logs).
+
+Instead of one unbounded `delete().lt(...)` per table, each run deletes in
+bounded chunks: select up to RETENTION_CHUNK primary keys of expired rows,
+delete exactly those, pause, repeat. app_usage_logs has no surrogate key
+(rows are identified by device_id, date, app_name / app_id), so it is pruned
+a day at a time, oldest first, in chunks of devices: the rows of the devices
+in one chunk-sized select are deleted with `date = d and device_id in (...)`.
+Between chunks the job watches the
+heartbeat latency and backs off (or stops early, resuming next run) so a
+large backlog after downtime never stalls the ingest path.
+
+Scheduled by app/services/jobs.py (RETENTION_INTERVAL, hourly by default).
+"""
+import time
+from datetime import datetime, timedelta
+
+import app.extensions as extensions
+from app.utils import metrics
+from app.utils.load_signals import heartbeat_latency
+from app.utils.logger import logger
+
+settings = {
+    "interval": 3600.0,
+    "chunk": 500,
+    "pause": 0.5,
+    "max_pause": 30.0,
+    "max_run_seconds": 300.0,
+    "latency_threshold": 0.5,
+    "sessions_hours": 24,
+    "usage_days": 1,
+}
+
+# Per-table rules: which column ages out, and either the key that identifies a
+# row or the column that splits one expired value (a day) into chunks
+TARGETS = [
+    {"table": "device_sessions", "column": "start_time", "key": "id"},
+    {"table": "app_usage_logs", "column": "date", "group": "device_id"},
+]
+
+last_run = {}   # summary of the most recent run
+totals = {"runs": 0, "rows_pruned": 0, "throttled": 0, "errors": 0}
+
+
+def _cutoff(table, now):
+    if table == "device_sessions":
+        return (now - timedelta(hours=settings["sessions_hours"])).isoformat() + "Z"
+    # app_usage_logs is keyed by calendar day (already archived to history at midnight)
+    return (now - timedelta(days=settings["usage_days"])).date().isoformat()
+
+
+def _delete_by_key(target, cutoff):
+    """Delete one chunk of expired rows by primary key. Returns (rows deleted, more left)."""
+    table, column, key = target["table"], target["column"], target["key"]
+    res = extensions.supabase.table(table)\
+        .select(key)\
+        .lt(column, cutoff)\
+        .order(key)\
+        .limit(settings["chunk"])\
+        .execute()
+    ids = [row[key] for row in (res.data or [])]
+    if ids:
+        extensions.supabase.table(table).delete().in_(key, ids).execute()
+    return len(ids), len(ids) == settings["chunk"]
+
+
+def _delete_by_group(target, cutoff):
+    """
+    Delete the rows of the oldest expired day for the devices in one chunk
+    (no surrogate key to select). Returns (rows deleted, more left).
+    """
+    table, column, group = target["table"], target["column"], target["group"]
+    res = extensions.supabase.table(table)\
+        .select(f"{column}, {group}")\
+        .lt(column, cutoff)\
+        .order(column)\
+        .order(group)\
+        .limit(settings["chunk"])\
+        .execute()
+    rows = res.data or []
+    if not rows:
+        return 0, False
+    day = rows[0][column]
+    ids = sorted({row[group] for row in rows if row[column] == day})
+    deleted = extensions.supabase.table(table).delete().eq(column, day).in_(group, ids).execute()
+    return len(deleted.data or []), len(rows) == settings["chunk"] or rows[-1][column] != day
+
+
+def _prune_table(target, cutoff, deadline, report):
+    table = target["table"]
+    delete_chunk = _delete_by_key if "key" in target else _delete_by_group
+    pause = settings["pause"]
+    pruned = 0
+
+    while time.monotonic() < deadline:
+        # Back off while heartbeats are slow; give up for this run if it persists
+        latency = heartbeat_latency.value()
+        if latency > settings["latency_threshold"]:
+            report["throttled"] += 1
+            totals["throttled"] += 1
+            pause = min(pause * 2, settings["max_pause"])
+            if time.monotonic() + pause >= deadline:
+                break
+            time.sleep(pause)
+            continue
+        pause = settings["pause"]
+
+        deleted, more = delete_chunk(target, cutoff)
+        pruned += deleted
+        if not more:
+            report["complete"][table] = True
+            break
+        time.sleep(pause)
+
+    report["rows_pruned"][table] = pruned
+    return pruned
+
+
+def run_retention():
+    """One pruning pass over every target, bounded by max_run_seconds."""
+    started = time.monotonic()
+    deadline = started + settings["max_run_seconds"]
+    now = datetime.utcnow()
+    report = {"started_at": now.isoformat() + "Z", "rows_pruned": {}, "complete": {}, "throttled": 0}
+
+    for i, target in enumerate(TARGETS):
+        report["complete"][target["table"]] = False
+        # Fair share of what is left, so one huge backlog can't starve the next table
+        share = (deadline - time.monotonic()) / (len(TARGETS) - i)
+        try:
+            _prune_table(target, _cutoff(target["table"], now), time.monotonic() + share, report)
+        except Exception as e:
+            totals["errors"] += 1
+            report.setdefault("errors", {})[target["table"]] = str(e)
+            logger.error(f"Retention Error ({target['table']}): {e}")
+
+    report["duration_seconds"] = round(time.monotonic() - started, 3)
+    total = sum(report["rows_pruned"].values())
+    totals["runs"] += 1
+    totals["rows_pruned"] += total
+    last_run.clear()
+    last_run.update(report)
+
+    logger.info(
+        f"🧹 Retention: pruned {total} rows {report['rows_pruned']} in {report['duration_seconds']}s "
+        f"(throttled {report['throttled']}x)"
+    )
+    return report
+
+
+def configure_retention(config):
+    settings.update({
+        "interval": float(config.get("RETENTION_INTERVAL", settings["interval"])),
+        "chunk": int(config.get("RETENTION_CHUNK", settings["chunk"])),
+        "pause": float(config.get("RETENTION_PAUSE", settings["pause"])),
+        "max_run_seconds": float(config.get("RETENTION_MAX_RUN_SECONDS", settings["max_run_seconds"])),
+        "latency_threshold": float(config.get("RETENTION_LATENCY_THRESHOLD", settings["latency_threshold"])),
+        "sessions_hours": int(config.get("RETENTION_SESSIONS_HOURS", settings["sessions_hours"])),
+        "usage_days": int(config.get("RETENTION_USAGE_DAYS", settings["usage_days"])),
+    })
+
+
+def get_retention_stats():
+    return {"totals": totals, "last_run": last_run, "interval_seconds": settings["interval"]}
+
+
+@metrics.register_collector
+def _collect_retention():
+    lines = ["# TYPE lab_retention_rows_pruned_total counter",
+             f"lab_retention_rows_pruned_total {totals['rows_pruned']}",
+             "# TYPE lab_retention_throttled_total counter",
+             f"lab_retention_throttled_total {totals['throttled']}"]
+    return lines
@@ -0,0 +1,171 @@
+"""
+Small in-process job scheduler for periodic background work.
+
+Each job has its own interval and jitter and runs in its own thread (a
+greenlet under gevent), so a slow or failing job never delays the others.
+A job that is still running when it comes due again is skipped (overlap
+protection). Under gevent the per-job timeout interrupts the run at its
+next blocking call; without gevent the overrun is recorded instead.
+Per-job timing and failure counts are available via `get_job_stats()`.
+
+Jobs registered with leader_only=True run only in the process that holds
+the leader lock (app/services/leader.py); in the others they stay scheduled
+but each due run is skipped, so with several workers fleet-wide jobs still
+run once per host.
+"""
+import random
+import threading
+import time
+
+from app.services import leader
+from app.utils import metrics
+from app.utils.logger import logger
+
+try:
+    import gevent
+    from gevent import monkey as _monkey
+except ImportError:  # pragma: no cover - gevent is in requirements.txt
+    gevent = None
+    _monkey = None
+
+
+JOB_DURATION = metrics.histogram(
+    "lab_job_duration_seconds", "Background job run time.", ("job",),
+    buckets=(0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600))
+JOB_RUNS = metrics.counter("lab_job_runs_total", "Background job runs by outcome.", ("job", "result"))
+
+
+def _gevent_threads():
+    return _monkey is not None and _monkey.is_module_patched("threading")
+
+
+class Job:
+    def __init__(self, name, func, interval, jitter=0.0, timeout=None, initial_delay=None, leader_only=False):
+        self.name = name
+        self.func = func
+        self.interval = float(interval)
+        self.jitter = float(jitter)
+        self.timeout = timeout
+        self.leader_only = leader_only
+        # Spread first runs so jobs registered together don't fire together
+        delay = initial_delay if initial_delay is not None else random.uniform(0, self.jitter)
+        self.next_run = time.monotonic() + delay
+
+        self.running = False
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.skipped = 0
+        self.standby = 0  # due runs skipped because another process leads
+        self.last_run_at = None
+        self.last_duration = None
+        self.max_duration = 0.0
+        self.last_error = None
+
+    def schedule_next(self, now):
+        self.next_run = now + self.interval + random.uniform(0, self.jitter)
+
+    def as_dict(self):
+        return {
+            "interval_seconds": self.interval,
+            "jitter_seconds": self.jitter,
+            "timeout_seconds": self.timeout,
+            "running": self.running,
+            "runs": self.runs,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "skipped_overlaps": self.skipped,
+            "leader_only": self.leader_only,
+            "skipped_standby": self.standby,
+            "last_run_at": self.last_run_at,
+            "last_duration_seconds": self.last_duration,
+            "max_duration_seconds": round(self.max_duration, 3),
+            "last_error": self.last_error,
+            "next_run_in_seconds": round(max(0.0, self.next_run - time.monotonic()), 1),
+        }
+
+
+class Scheduler:
+    def __init__(self, tick=1.0):
+        self.tick = tick
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def register(self, name, func, interval, jitter=0.0, timeout=None, initial_delay=None, leader_only=False):
+        with self._lock:
+            self.jobs[name] = Job(name, func, interval, jitter, timeout, initial_delay, leader_only)
+        return self.jobs[name]
+
+    def _execute(self, job):
+        started = time.monotonic()
+        job.last_run_at = time.time()
+        try:
+            if job.timeout and _gevent_threads():
+                with gevent.Timeout(job.timeout):
+                    job.func()
+            else:
+                job.func()
+            job.last_error = None
+            JOB_RUNS.inc(job.name, "ok")
+        except BaseException as e:
+            if gevent is not None and isinstance(e, gevent.Timeout):
+                job.timeouts += 1
+                job.last_error = f"timed out after {job.timeout}s"
+                JOB_RUNS.inc(job.name, "timeout")
+            else:
+                job.last_error = str(e)
+                JOB_RUNS.inc(job.name, "error")
+            job.failures += 1
+            logger.error(f"⏱️ Job '{job.name}' failed: {job.last_error}")
+        finally:
+            duration = time.monotonic() - started
+            job.last_duration = round(duration, 3)
+            job.max_duration = max(job.max_duration, duration)
+            JOB_DURATION.observe(duration, job.name)
+            if job.timeout and duration > job.timeout and not _gevent_threads():
+                job.timeouts += 1
+            job.runs += 1
+            job.running = False
+
+    def _loop(self):
+        logger.info(f"⏱️ Scheduler started with jobs: {', '.join(self.jobs)}")
+        while True:
+            now = time.monotonic()
+            for job in list(self.jobs.values()):
+                if now < job.next_run:
+                    continue
+                job.schedule_next(now)
+                if job.leader_only and not leader.is_leader():
+                    job.standby += 1
+                    continue
+                if job.running:
+                    job.skipped += 1
+                    continue
+                job.running = True
+                threading.Thread(target=self._execute, args=(job,), name=f"job-{job.name}", daemon=True).start()
+            time.sleep(self.tick)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, name="scheduler", daemon=True)
+            self._thread.start()
+
+    def stats(self):
+        return {name: job.as_dict() for name, job in self.jobs.items()}
+
+
+scheduler = Scheduler()
+
+
+def get_job_stats():
+    return scheduler.stats()
+
+
+@metrics.register_collector
+def _collect_jobs():
+    lines = ["# TYPE lab_job_skipped_overlaps_total counter"]
+    lines += [f'lab_job_skipped_overlaps_total{{job="{n}"}} {j.skipped}' for n, j in scheduler.jobs.items()]
+    lines.append("# TYPE lab_job_running gauge")
+    lines += [f'lab_job_running{{job="{n}"}} {int(j.running)}' for n, j in scheduler.jobs.items()]
+    return lines
@@ -0,0 +1,326 @@
+"""
+State shared by the gunicorn workers of one host.
+
+With SHARED_STATE_BACKEND=memory (the default, and all that workers = 1
+needs) everything stays in process memory as before. With "sqlite" every
+worker opens the same SQLite database (SHARED_STATE_PATH, WAL mode) and gets:
+
+  * SharedTTLMap: the TTLCache interface over a `kv` table, for maps any
+    worker may write and any worker must be able to read (discovery,
+    report jobs)
+  * a message bus: publish() queues a message locally; a pump thread per
+    process writes its outbox in one transaction and reads what the other
+    workers published since its cursor, every SHARED_BUS_POLL seconds, and
+    hands each message to the handlers registered with subscribe().
+    Messages are kept SHARED_BUS_RETENTION seconds, then pruned.
+  * transaction(): plain SQL for stores that need real queries (actions.py
+    registers its tables with register_schema()).
+
+Publishing is for the *other* processes: callers apply a change locally and
+publish it; handlers only ever see messages from peers.
+
+SQLite's own busy handler sleeps inside the C call, which under gevent
+stalls every greenlet of the worker. The connection has no busy timeout
+instead: when another worker holds the write lock, transaction() / query()
+give up the connection, sleep cooperatively (1 ms doubling to 50 ms) and try
+again, for up to SHARED_STATE_BUSY_TIMEOUT seconds in all.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from app.utils import metrics
+from app.utils.logger import logger
+from app.utils.ttl_cache import TTLCache
+
+BUS_MESSAGES = metrics.counter("lab_shared_bus_messages_total", "Cross-worker bus messages.", ("channel", "direction"))
+BUSY_RETRIES = metrics.counter("lab_shared_state_busy_retries_total", "Backoffs while another worker held the SQLite write lock.")
+
+BACKENDS = ("memory", "sqlite")
+
+settings = {
+    "backend": "memory",
+    "path": os.path.join("spool", "shared_state.db"),
+    "poll_interval": 0.25,
+    "bus_retention": 60.0,
+    "busy_timeout": 5.0,
+    "max_outbox": 50000,
+}
+
+SCHEMA = """
+create table if not exists kv (
+    ns text not null, key text not null, value text not null, expires real not null,
+    primary key (ns, key));
+create index if not exists kv_expires on kv (ns, expires);
+create table if not exists messages (
+    id integer primary key autoincrement, pid integer not null,
+    channel text not null, payload text not null, ts real not null);
+"""
+_schemas = [SCHEMA]
+
+_handlers = {}   # {channel: [handler(payload)]}
+_outbox = []     # [(channel, payload json, ts)] waiting for the next pump
+_outbox_lock = threading.Lock()
+_db_lock = threading.Lock()
+_db = {"conn": None, "pid": None, "cursor": 0, "pruned_at": 0.0}
+_pump = {"thread": None, "pid": None}
+
+
+def configure_shared_state(config):
+    backend = str(config.get("SHARED_STATE_BACKEND") or settings["backend"]).lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"SHARED_STATE_BACKEND must be one of {BACKENDS}, not {backend!r}")
+    settings.update({
+        "backend": backend,
+        "path": config.get("SHARED_STATE_PATH") or os.path.join(config.get("SPOOL_DIR", "spool"), "shared_state.db"),
+        "poll_interval": float(config.get("SHARED_BUS_POLL", settings["poll_interval"])),
+        "bus_retention": float(config.get("SHARED_BUS_RETENTION", settings["bus_retention"])),
+        "busy_timeout": float(config.get("SHARED_STATE_BUSY_TIMEOUT", settings["busy_timeout"])),
+    })
+
+
+def is_shared():
+    return settings["backend"] == "sqlite"
+
+
+def register_schema(sql):
+    """Extra tables a store needs, created with the database."""
+    _schemas.append(sql)
+
+
+# --- database --------------------------------------------------------------
+
+def _connection():
+    # One connection per process: a forked worker must never reuse its parent's
+    if _db["pid"] != os.getpid():
+        path = settings["path"]
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # timeout=0: a locked database fails fast and _locked() backs off without blocking the hub
+        conn = sqlite3.connect(path, timeout=0, isolation_level=None, check_same_thread=False)
+        try:
+            conn.execute("pragma journal_mode=wal")
+            conn.execute("pragma synchronous=normal")
+            for sql in _schemas:
+                conn.executescript(sql)
+            # Start listening from now: a new worker doesn't replay old traffic
+            cursor = conn.execute("select coalesce(max(id), 0) from messages").fetchone()[0]
+        except BaseException:
+            conn.close()
+            raise
+        _db.update(conn=conn, pid=os.getpid(), cursor=cursor)
+    return _db["conn"]
+
+
+def _is_busy(error):
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in str(error) or "busy" in str(error))
+
+
+def _locked(step):
+    """
+    Take _db_lock and run step(conn), keeping the lock on success. While
+    another process holds the database, retry with a cooperative sleep
+    (_db_lock released) until busy_timeout runs out.
+    """
+    delay, deadline = 0.001, time.monotonic() + settings["busy_timeout"]
+    while True:
+        _db_lock.acquire()
+        try:
+            conn = _connection()
+            return conn, step(conn)
+        except BaseException as e:
+            _db_lock.release()
+            if not _is_busy(e) or time.monotonic() >= deadline:
+                raise
+        BUSY_RETRIES.inc()
+        time.sleep(delay)
+        delay = min(delay * 2, 0.05)
+
+
+@contextmanager
+def transaction(immediate=False):
+    """The process's connection inside one transaction (IMMEDIATE takes the write lock up front)."""
+    conn, _ = _locked(lambda c: c.execute("begin immediate" if immediate else "begin"))
+    try:
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("rollback")
+            raise
+        conn.execute("commit")
+    finally:
+        _db_lock.release()
+
+
+def query(sql, params=()):
+    """Rows of one autocommit statement."""
+    _, rows = _locked(lambda c: c.execute(sql, params).fetchall())
+    _db_lock.release()
+    return rows
+
+
+# --- message bus -----------------------------------------------------------
+
+def subscribe(channel, handler):
+    _handlers.setdefault(channel, []).append(handler)
+
+
+def publish(channel, payload):
+    """Tell the other workers (no-op when state isn't shared: there are none)."""
+    if not is_shared():
+        return
+    with _outbox_lock:
+        if len(_outbox) >= settings["max_outbox"]:
+            # The pump is failing; the oldest news is the least useful
+            del _outbox[0]
+            BUS_MESSAGES.inc(channel, "dropped")
+        _outbox.append((channel, json.dumps(payload, default=str), time.time()))
+    BUS_MESSAGES.inc(channel, "out")
+
+
+def pump():
+    """Write this process's outbox, deliver what peers published since the last pump."""
+    with _outbox_lock:
+        out = _outbox[:]
+        del _outbox[:]
+    pid = os.getpid()
+    now = time.time()
+    try:
+        with transaction(immediate=bool(out)) as conn:
+            if out:
+                conn.executemany("insert into messages (pid, channel, payload, ts) values (?, ?, ?, ?)",
+                                 [(pid, channel, payload, ts) for channel, payload, ts in out])
+            rows = conn.execute("select id, pid, channel, payload from messages where id > ? order by id",
+                                (_db["cursor"],)).fetchall()
+            if now - _db["pruned_at"] >= settings["bus_retention"] / 4:
+                conn.execute("delete from messages where ts < ?", (now - settings["bus_retention"],))
+                _db["pruned_at"] = now
+    except Exception:
+        with _outbox_lock:
+            _outbox[:0] = out
+        raise
+    if rows:
+        _db["cursor"] = rows[-1][0]
+    delivered = 0
+    for _, sender, channel, payload in rows:
+        if sender == pid:
+            continue
+        handlers = _handlers.get(channel)
+        if not handlers:
+            continue
+        message = json.loads(payload)
+        for handler in handlers:
+            try:
+                handler(message)
+            except Exception as e:
+                logger.error(f"🔀 Shared bus handler for {channel} failed: {e}")
+        BUS_MESSAGES.inc(channel, "in")
+        delivered += 1
+    return delivered
+
+
+def _pump_loop():
+    while True:
+        time.sleep(settings["poll_interval"])
+        try:
+            pump()
+        except Exception as e:
+            logger.error(f"🔀 Shared bus pump failed: {e}")
+
+
+def start_shared_state():
+    """Open the database and start the bus pump in this process (no-op for the memory backend)."""
+    if not is_shared() or _pump["pid"] == os.getpid():
+        return False
+    query("select 1")
+    _pump["thread"] = threading.Thread(target=_pump_loop, name="shared-bus", daemon=True)
+    _pump["thread"].start()
+    _pump["pid"] = os.getpid()
+    logger.info(f"🔀 Shared state: {settings['path']} (bus every {settings['poll_interval']}s)")
+    return True
+
+
+# --- maps ------------------------------------------------------------------
+
+class SharedTTLMap:
+    """TTLCache interface: the kv table when state is shared, a local TTLCache otherwise. Values must be JSON."""
+
+    PRUNE_EVERY = 64  # writes between expiry / size-cap sweeps of the namespace
+
+    def __init__(self, name, ttl, max_size):
+        self.name = name
+        self._local = TTLCache(name, ttl, max_size)
+        self._writes = 0
+
+    def configure(self, ttl=None, max_size=None):
+        self._local.configure(ttl=ttl, max_size=max_size)
+
+    def _prune(self, conn, now):
+        conn.execute("delete from kv where ns = ? and expires <= ?", (self.name, now))
+        count = conn.execute("select count(*) from kv where ns = ?", (self.name,)).fetchone()[0]
+        excess = count - self._local.max_size
+        if excess > 0:
+            conn.execute("delete from kv where ns = ? and key in "
+                         "(select key from kv where ns = ? order by expires limit ?)",
+                         (self.name, self.name, excess))
+
+    def set(self, key, value):
+        if not is_shared():
+            return self._local.set(key, value)
+        now = time.time()
+        with transaction(immediate=True) as conn:
+            conn.execute("insert or replace into kv (ns, key, value, expires) values (?, ?, ?, ?)",
+                         (self.name, str(key), json.dumps(value, default=str), now + self._local.ttl))
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._prune(conn, now)
+
+    def get(self, key, default=None):
+        if not is_shared():
+            return self._local.get(key, default)
+        if key is None:
+            return default
+        rows = query("select value from kv where ns = ? and key = ? and expires > ?",
+                     (self.name, str(key), time.time()))
+        return json.loads(rows[0][0]) if rows else default
+
+    def pop(self, key, default=None):
+        if not is_shared():
+            return self._local.pop(key, default)
+        # Most pops are for keys that aren't there (discovery on every bound beat): read before locking
+        if not query("select 1 from kv where ns = ? and key = ?", (self.name, str(key))):
+            return default
+        with transaction(immediate=True) as conn:
+            row = conn.execute("select value, expires from kv where ns = ? and key = ?",
+                               (self.name, str(key))).fetchone()
+            if row is None:
+                return default
+            conn.execute("delete from kv where ns = ? and key = ?", (self.name, str(key)))
+        return json.loads(row[0]) if row[1] > time.time() else default
+
+    def items(self):
+        """Live (key, value) pairs, oldest write first."""
+        if not is_shared():
+            return self._local.items()
+        rows = query("select key, value from kv where ns = ? and expires > ? order by expires",
+                     (self.name, time.time()))
+        return [(key, json.loads(value)) for key, value in rows]
+
+    def __len__(self):
+        if not is_shared():
+            return len(self._local)
+        return query("select count(*) from kv where ns = ? and expires > ?", (self.name, time.time()))[0][0]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+@metrics.register_collector
+def _collect_shared_state():
+    return [
+        "# HELP lab_shared_bus_outbox Messages waiting for the next shared-bus pump.",
+        "# TYPE lab_shared_bus_outbox gauge",
+        f"lab_shared_bus_outbox {len(_outbox)}",
+    ]
@@ -0,0 +1,538 @@
+"""
+Durable local write spool (WAL) for when Supabase is slow or down.
+
+Writes on the ingest path go through `write()`. Normally that is a direct
+Supabase call; if the call fails, or the backend is currently flagged as
+degraded (a recent write blew the latency budget), the operation is appended
+to a local JSON-lines segment instead and acknowledged. Appends are buffered
+and fsync'd in batches by the spool worker, which also drains the spool back
+into the database in bulk once the backend recovers:
+
+  * device updates are coalesced per match (last write wins per column), but
+    never past a later update of the same column: a device row is matched
+    by hardware_id (degraded presence) or by system_id (full writes), so the
+    replay keeps the order in which those were written
+  * upserts are de-duplicated on their conflict key and sent in chunks
+  * inserts are sent in chunks; with `dedupe_on` rows already in the table
+    (a timed out request that did commit) are skipped, so a replay never
+    inserts them twice
+
+Only timeouts, transport errors and 5xx are spooled. A write the database
+refuses (4xx: bad value, unknown foreign key, constraint violation) would
+fail the same way on every retry, so `write()` raises WriteRejected for it
+instead, and a spooled record refused during replay is moved to `dead.wal`
+so it can't hold up everything behind it.
+
+While anything is pending, new writes are spooled as well so a replayed
+(older) update can never overwrite a newer direct one; when the backend is
+healthy the worker drains on every tick, so that lag is about a second.
+
+Segments: `active.wal` receives appends; the worker rotates it to
+`replay-<ns>.wal` and drains replay segments oldest first, persisting its
+byte offset in `<segment>.pos` so a restart resumes where it stopped.
+
+Each process spools into its own slot directory, claimed with an exclusive
+file lock: slot 0 is SPOOL_DIR itself, further gunicorn workers use
+SPOOL_DIR/worker-<n>, so two processes never append to or replay the same
+segment. Segments left in a slot nobody holds (a worker that died, or fewer
+workers than last run) are adopted on start.
+"""
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import app.extensions as extensions
+from app.utils import db_client, metrics
+from app.utils.file_lock import try_lock
+from app.utils.logger import logger
+
+_lock = threading.RLock()
+_worker = None
+_slot = {"file": None, "index": None}  # slot lock held for the life of the process
+_settings = {
+    "dir": "spool",
+    "max_bytes": 64 * 1024 * 1024,
+    "fsync_interval": 1.0,
+    "latency_budget": 2.0,
+    "degraded_seconds": 30.0,
+    "replay_interval": 5.0,
+    "replay_batch": 500,
+}
+
+_state = {
+    "fh": None,             # open handle on active.wal
+    "dirty": False,         # appended since last fsync
+    "bytes": 0,             # pending bytes on disk (active + replay segments)
+    "degraded_until": 0.0,  # monotonic deadline, writes spool while in the future
+}
+
+stats = {
+    "spooled": 0,
+    "dropped": 0,
+    "corrupt": 0,
+    "direct_failures": 0,
+    "rejected": 0,
+    "dead_lettered": 0,
+    "over_budget": 0,
+    "replayed": 0,
+    "replay_requests": 0,
+    "replay_errors": 0,
+    "last_replay_rate": 0.0,  # records/s of the last drain pass
+    "last_replay_at": None,
+}
+
+
+class WriteRejected(Exception):
+    """The database refused the write itself; retrying it can't succeed."""
+
+
+def init_spool(config):
+    """Apply config and resume draining whatever a previous process left behind."""
+    _settings.update({
+        "dir": _claim_slot(config.get("SPOOL_DIR", "spool")),
+        "max_bytes": int(config.get("SPOOL_MAX_BYTES", _settings["max_bytes"])),
+        "fsync_interval": float(config.get("SPOOL_FSYNC_INTERVAL", _settings["fsync_interval"])),
+        "latency_budget": float(config.get("SPOOL_LATENCY_BUDGET", _settings["latency_budget"])),
+        "degraded_seconds": float(config.get("SPOOL_DEGRADED_SECONDS", _settings["degraded_seconds"])),
+        "replay_interval": float(config.get("SPOOL_REPLAY_INTERVAL", _settings["replay_interval"])),
+        "replay_batch": int(config.get("SPOOL_REPLAY_BATCH", _settings["replay_batch"])),
+    })
+    os.makedirs(_settings["dir"], exist_ok=True)
+    _state["bytes"] = _disk_bytes()
+    if _state["bytes"] > 0:
+        logger.warning(f"📼 Spool has {_state['bytes']} bytes pending from a previous run, replaying.")
+        _ensure_worker()
+
+
+def _slot_dir(base, index):
+    return base if index == 0 else os.path.join(base, f"worker-{index}")
+
+
+def _try_lock(base, index):
+    return try_lock(os.path.join(base, f".slot-{index}.lock"))
+
+
+def _adopt(src, dst):
+    """Move another slot's pending segments into ours as replay segments."""
+    moved = 0
+    for name in sorted(os.listdir(src)):
+        if name == "active.wal" or (name.startswith("replay-") and name.endswith(".wal")):
+            target = f"replay-{time.time_ns()}.wal"
+            pos = os.path.join(src, name + ".pos")
+            if os.path.exists(pos):
+                os.replace(pos, os.path.join(dst, target + ".pos"))
+            os.replace(os.path.join(src, name), os.path.join(dst, target))
+            moved += 1
+    return moved
+
+
+def _claim_slot(base):
+    """Lock the lowest free slot for this process and adopt orphaned slots' segments."""
+    if _slot["file"] is not None:
+        _slot["file"].close()
+        _slot.update(file=None, index=None)
+    os.makedirs(base, exist_ok=True)
+    index = 0
+    while True:
+        fh = _try_lock(base, index)
+        if fh is not None:
+            break
+        index += 1
+    _slot.update(file=fh, index=index)
+    mine = _slot_dir(base, index)
+    os.makedirs(mine, exist_ok=True)
+
+    others = [int(name.split("-", 1)[1]) for name in os.listdir(base)
+              if name.startswith("worker-") and name.split("-", 1)[1].isdigit()]
+    for other in sorted(set(others + [0]) - {index}):
+        fh = _try_lock(base, other)
+        if fh is None:
+            continue  # a live worker owns it
+        try:
+            moved = _adopt(_slot_dir(base, other), mine)
+            if moved:
+                logger.warning(f"📼 Adopted {moved} orphaned spool segment(s) from slot {other}.")
+        finally:
+            fh.close()
+    return mine
+
+
+def is_degraded():
+    return time.monotonic() < _state["degraded_until"]
+
+
+def fill_ratio():
+    """Pending spool bytes as a fraction of SPOOL_MAX_BYTES (no disk access)."""
+    return _state["bytes"] / _settings["max_bytes"] if _settings["max_bytes"] else 0.0
+
+
+def mark_degraded(reason):
+    if not is_degraded():
+        logger.warning(f"📼 Backend degraded ({reason}), spooling writes locally.")
+    _state["degraded_until"] = time.monotonic() + _settings["degraded_seconds"]
+
+
+def _execute(table, op, payload, match=None, on_conflict=None):
+    query = extensions.supabase.table(table)
+    if op == "update":
+        query = query.update(payload)
+        for col, val in (match or {}).items():
+            query = query.eq(col, val)
+    elif op == "upsert":
+        query = query.upsert(payload, on_conflict=on_conflict or "")
+    elif op == "insert":
+        query = query.insert(payload)
+    else:
+        raise ValueError(f"Unsupported spool op: {op}")
+    return query.execute()
+
+
+def write(table, op, payload, match=None, on_conflict=None, dedupe_on=None):
+    """
+    Write-through with local fallback.
+    Returns "written" or "spooled" ("dropped" if the spool is full); raises
+    WriteRejected when the database refuses the write (4xx).
+    """
+    if not is_degraded() and _state["bytes"] == 0:
+        started = time.monotonic()
+        try:
+            _execute(table, op, payload, match, on_conflict)
+            elapsed = time.monotonic() - started
+            if elapsed > _settings["latency_budget"]:
+                stats["over_budget"] += 1
+                mark_degraded(f"{table}.{op} took {elapsed:.1f}s")
+            return "written"
+        except Exception as e:
+            if not db_client.is_transient(e):
+                stats["rejected"] += 1
+                raise WriteRejected(f"{table}.{op}: {e}") from e
+            stats["direct_failures"] += 1
+            mark_degraded(f"{table}.{op}: {e}")
+
+    return spool(table, op, payload, match, on_conflict, dedupe_on)
+
+
+def spool(table, op, payload, match=None, on_conflict=None, dedupe_on=None):
+    """
+    Append one pending operation to the WAL (fsync happens in batches).
+    `dedupe_on` ("col,col") identifies an inserted row, so replay can skip
+    rows that are already in the table.
+    """
+    record = {"t": table, "op": op, "p": payload, "ts": time.time()}
+    if match: record["m"] = match
+    if on_conflict: record["oc"] = on_conflict
+    if dedupe_on: record["k"] = dedupe_on
+    line = json.dumps(record, separators=(",", ":"), default=str) + "\n"
+    size = len(line.encode("utf-8"))
+
+    with _lock:
+        if _state["bytes"] + size > _settings["max_bytes"]:
+            stats["dropped"] += 1
+            if stats["dropped"] % 1000 == 1:
+                logger.error(f"📼 Spool full ({_settings['max_bytes']} bytes), dropped {stats['dropped']} writes so far.")
+            return "dropped"
+        fh = _active_handle()
+        fh.write(line)
+        fh.flush()  # survives a process crash now, fsync (power loss) is batched
+        _state["bytes"] += size
+        _state["dirty"] = True
+        stats["spooled"] += 1
+
+    _ensure_worker()
+    return "spooled"
+
+
+def _path(name):
+    return os.path.join(_settings["dir"], name)
+
+
+def _active_handle():
+    if _state["fh"] is None:
+        os.makedirs(_settings["dir"], exist_ok=True)
+        fh = open(_path("active.wal"), "a", encoding="utf-8")
+        if _torn(_path("active.wal")):
+            # Crash mid-append: end the torn line so the next record isn't glued onto it
+            fh.write("\n")
+        _state["fh"] = fh
+    return _state["fh"]
+
+
+def _torn(path):
+    """True if the file doesn't end with a newline (an append cut short)."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return False
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) != b"\n"
+
+
+def _replay_segments():
+    try:
+        names = os.listdir(_settings["dir"])
+    except FileNotFoundError:
+        return []
+    return sorted(n for n in names if n.startswith("replay-") and n.endswith(".wal"))
+
+
+def _disk_bytes():
+    total = 0
+    for name in ["active.wal"] + _replay_segments():
+        try:
+            total += os.path.getsize(_path(name))
+        except OSError:
+            pass
+    return total
+
+
+def _fsync():
+    with _lock:
+        fh = _state["fh"]
+        if fh is None or not _state["dirty"]:
+            return
+        os.fsync(fh.fileno())
+        _state["dirty"] = False
+
+
+def _rotate():
+    """Seal active.wal into a replay segment (no-op when it is empty)."""
+    with _lock:
+        if _state["fh"] is not None:
+            _state["fh"].flush()
+            os.fsync(_state["fh"].fileno())
+            _state["fh"].close()
+            _state["fh"] = None
+            _state["dirty"] = False
+        active = _path("active.wal")
+        if os.path.exists(active) and os.path.getsize(active) > 0:
+            os.replace(active, _path(f"replay-{time.time_ns()}.wal"))
+
+
+def _read_pos(segment):
+    try:
+        with open(_path(segment + ".pos")) as f:
+            return int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def _write_pos(segment, pos):
+    with open(_path(segment + ".pos"), "w") as f:
+        f.write(str(pos))
+
+
+def _key_value(value):
+    # timestamptz comes back as "...+00:00" for the "...Z" that was sent
+    if isinstance(value, str) and "T" in value:
+        try:
+            return datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            pass
+    return str(value)
+
+
+def _not_inserted(table, dedupe_on, rows):
+    """The rows not in `table` yet, matched on the `dedupe_on` columns (one select)."""
+    cols = [c.strip() for c in dedupe_on.split(",")]
+    query = extensions.supabase.table(table).select(",".join(cols))
+    for col in cols:
+        query = query.in_(col, sorted({str(r[col]) for r in rows if r.get(col) is not None}))
+    existing = {tuple(_key_value(row.get(c)) for c in cols) for row in query.execute().data or []}
+    return [r for r in rows if tuple(_key_value(r.get(c)) for c in cols) not in existing]
+
+
+def _flush_batch(records):
+    """Send one batch of spooled records to Supabase with as few requests as possible."""
+    updates = {}   # {seq: {"t", "m": match, "p": merged payload, "seq"}}, in the order they run
+    latest = {}    # {(table, match-json): newest entry for that match}
+    written = {}   # {(table, column): seq of the last update that set it}
+    upserts = {}   # {(table, on_conflict, columns): {conflict-key: row}}
+    inserts = {}   # {(table, dedupe_on, columns): [rows]}
+
+    for seq, r in enumerate(records):
+        table, op, payload = r["t"], r["op"], r["p"]
+        if op == "update":
+            key = (table, json.dumps(r.get("m") or {}, sort_keys=True))
+            entry = latest.get(key)
+            # Merging moves the entry's other columns up to this record: only
+            # if no update (on any match) set one of them in between
+            if entry is not None and all(written[(table, c)] <= entry["seq"]
+                                         for c in entry["p"] if c not in payload):
+                del updates[entry["seq"]]
+            else:
+                entry = latest[key] = {"t": table, "m": r.get("m") or {}, "p": {}}
+            entry["p"].update(payload)
+            entry["seq"] = seq
+            updates[seq] = entry
+            for c in payload:
+                written[(table, c)] = seq
+            continue
+
+        rows = payload if isinstance(payload, list) else [payload]
+        for row in rows:
+            cols = tuple(sorted(row.keys()))
+            if op == "upsert":
+                oc = r.get("oc") or ""
+                conflict_key = tuple(row.get(c.strip()) for c in oc.split(",")) if oc else id(row)
+                upserts.setdefault((table, oc, cols), {})[conflict_key] = row
+            else:
+                inserts.setdefault((table, r.get("k"), cols), []).append(row)
+
+    chunk = _settings["replay_batch"]
+    for (table, oc, _), rows in upserts.items():
+        rows = list(rows.values())
+        for i in range(0, len(rows), chunk):
+            _execute(table, "upsert", rows[i:i + chunk], on_conflict=oc)
+            stats["replay_requests"] += 1
+    for (table, dedupe_on, _), rows in inserts.items():
+        for i in range(0, len(rows), chunk):
+            part = rows[i:i + chunk]
+            if dedupe_on:
+                part = _not_inserted(table, dedupe_on, part)
+                stats["replay_requests"] += 1
+                if not part:
+                    continue
+            _execute(table, "insert", part)
+            stats["replay_requests"] += 1
+    for entry in updates.values():
+        _execute(entry["t"], "update", entry["p"], match=entry["m"])
+        stats["replay_requests"] += 1
+
+
+def _dead_letter(record, error):
+    """Set aside a record the database refuses, with the reason (never replayed)."""
+    line = json.dumps({"record": record, "error": str(error), "at": time.time()},
+                      separators=(",", ":"), default=str) + "\n"
+    with _lock:
+        with open(_path("dead.wal"), "a", encoding="utf-8") as f:
+            f.write(line)
+        stats["dead_lettered"] += 1
+    logger.error(f"📼 Spooled {record.get('t')}.{record.get('op')} refused, moved to dead.wal: {error}")
+
+
+def _replay_batch(batch):
+    """
+    Flush one batch. If the database refuses it, replay it record by record
+    and dead-letter the ones it refuses. Raises on a transient failure.
+    """
+    try:
+        _flush_batch(batch)
+        return
+    except Exception as e:
+        if db_client.is_transient(e):
+            raise
+    # Upserts, updates and deduplicated inserts are safe to send again
+    for record in batch:
+        try:
+            _flush_batch([record])
+        except Exception as e:
+            if db_client.is_transient(e):
+                raise
+            _dead_letter(record, e)
+
+
+def _drain_segment(segment):
+    """Replay one sealed segment. Returns False on a transient failure (retried next pass)."""
+    path = _path(segment)
+    pos = _read_pos(segment)
+    started = time.monotonic()
+    replayed = 0
+
+    with open(path, "rb") as f:
+        f.seek(pos)
+        while True:
+            batch = []
+            while len(batch) < _settings["replay_batch"]:
+                line = f.readline()
+                if not line:
+                    break
+                try:
+                    batch.append(json.loads(line))
+                except ValueError:
+                    stats["corrupt"] += 1  # torn tail from a crash mid-append
+            if not batch:
+                break
+            try:
+                _replay_batch(batch)
+            except Exception as e:
+                stats["replay_errors"] += 1
+                mark_degraded(f"replay: {e}")
+                return False
+            replayed += len(batch)
+            stats["replayed"] += len(batch)
+            _write_pos(segment, f.tell())
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    stats["last_replay_rate"] = round(replayed / elapsed, 1)
+    stats["last_replay_at"] = time.time()
+    with _lock:
+        _state["bytes"] = max(0, _state["bytes"] - os.path.getsize(path))
+        os.remove(path)
+    try:
+        os.remove(_path(segment + ".pos"))
+    except OSError:
+        pass
+    logger.info(f"📼 Spool segment {segment} replayed: {replayed} records at {stats['last_replay_rate']}/s")
+    return True
+
+
+def _replay_once():
+    if not _replay_segments():
+        _rotate()
+    for segment in _replay_segments():
+        if not _drain_segment(segment):
+            return
+    _state["degraded_until"] = 0.0
+
+
+def _worker_loop():
+    last_replay = 0.0
+    while True:
+        time.sleep(_settings["fsync_interval"])
+        try:
+            _fsync()
+            if _state["bytes"] == 0:
+                continue
+            # Healthy backend: drain every tick. Degraded: probe at replay_interval.
+            now = time.monotonic()
+            if not is_degraded() or now - last_replay >= _settings["replay_interval"]:
+                last_replay = now
+                _replay_once()
+        except Exception as e:
+            logger.error(f"Spool Worker Error: {e}")
+
+
+def _ensure_worker():
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return
+    with _lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_worker_loop, name="spool-worker", daemon=True)
+            _worker.start()
+
+
+def get_spool_stats():
+    return {
+        **stats,
+        "degraded": is_degraded(),
+        "pending_bytes": _state["bytes"],
+        "max_bytes": _settings["max_bytes"],
+        "segments": len(_replay_segments()),
+    }
+
+
+@metrics.register_collector
+def _collect_spool():
+    lines = [
+        "# TYPE lab_spool_pending_bytes gauge", f"lab_spool_pending_bytes {_state['bytes']}",
+        "# TYPE lab_spool_segments gauge", f"lab_spool_segments {len(_replay_segments())}",
+        "# TYPE lab_spool_degraded gauge", f"lab_spool_degraded {int(is_degraded())}",
+        "# TYPE lab_spool_replay_rate gauge", f"lab_spool_replay_rate {stats['last_replay_rate']}",
+    ]
+    for key in ("spooled", "dropped", "replayed", "replay_errors", "direct_failures", "over_budget",
+                "rejected", "dead_lettered"):
+        lines += [f"# TYPE lab_spool_{key}_total counter", f"lab_spool_{key}_total {stats[key]}"]
+    return lines
@@ -0,0 +1,336 @@
+"""
+Pooled HTTP transport for the Supabase client.
+
+Every greenlet and the background threads share ONE supabase client, so the
+httpx connection pool underneath it is the real concurrency limit towards the
+database. This module builds that pool explicitly (size, keep-alive, HTTP/2,
+timeouts) and instruments every PostgREST round trip per table/operation:
+call counts, latency histograms, connection reuse, time spent waiting for a
+free pooled connection and how often the pool ran saturated.
+"""
+import threading
+import time
+
+import httpx
+
+from app.utils import metrics, tracing
+from app.utils.load_signals import backend_latency
+from app.utils.logger import logger
+
+# Latency histogram buckets (seconds). Upper bounds, last bucket is +Inf.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# PostgREST verbs -> logical operation names used in the stats
+_METHOD_OPS = {
+    "GET": "select",
+    "HEAD": "count",
+    "POST": "insert",
+    "PATCH": "update",
+    "DELETE": "delete",
+}
+
+
+# SQLSTATE classes a retry can fix: connection, insufficient resources, operator
+# intervention (statement timeout, shutdown), rollbacks (deadlock, serialization),
+# system errors, lock not available
+_TRANSIENT_SQLSTATES = ("08", "40", "53", "57", "58", "XX", "55P03")
+# PostgREST's own: database unreachable / connection pool timed out (503, 504)
+_TRANSIENT_PGRST = ("PGRST000", "PGRST001", "PGRST002", "PGRST003")
+
+
+def is_transient(exc):
+    """
+    Whether a failed Supabase call is worth retrying later: timeouts, transport
+    errors and 5xx. A 4xx (bad value, unknown foreign key, constraint
+    violation, auth) fails the same way every time.
+    """
+    if isinstance(exc, (httpx.TransportError, OSError)):
+        return True
+    from postgrest.exceptions import APIError
+    if not isinstance(exc, APIError):
+        return False
+    code = str(exc.code or "")
+    if not code:
+        return True  # not from PostgREST itself (gateway error page)
+    if code.isdigit() and len(code) == 3:
+        return int(code) >= 500  # non-JSON body: the HTTP status
+    if code.startswith("PGRST"):
+        return code in _TRANSIENT_PGRST
+    return code.startswith(_TRANSIENT_SQLSTATES)
+
+
+def _classify(request):
+    """Map an outgoing request to (table, operation)."""
+    path = request.url.path
+    marker = "/rest/v1/"
+    idx = path.find(marker)
+    if idx >= 0:
+        table = path[idx + len(marker):].strip("/").split("/")[0] or "unknown"
+        if table == "rpc":
+            return path[idx + len(marker):].strip("/").replace("/", ":"), "rpc"
+    else:
+        table = path.strip("/").split("/")[0] or "unknown"
+
+    op = _METHOD_OPS.get(request.method, request.method.lower())
+    if op == "insert" and "merge-duplicates" in request.headers.get("prefer", ""):
+        op = "upsert"
+    return table, op
+
+
+class _CallStats:
+    __slots__ = ("count", "errors", "total_seconds", "max_seconds", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds, failed):
+        self.count += 1
+        if failed:
+            self.errors += 1
+        self.total_seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": round(self.total_seconds / self.count * 1000, 2) if self.count else 0,
+            "max_ms": round(self.max_seconds * 1000, 2),
+            "histogram": {
+                **{f"le_{b}": n for b, n in zip(LATENCY_BUCKETS, self.buckets)},
+                "le_inf": self.buckets[-1],
+            },
+        }
+
+
+class TransportStats:
+    """Thread-safe aggregate of every round trip made through the pool."""
+
+    def __init__(self, max_connections):
+        self.max_connections = max_connections
+        self._lock = threading.Lock()
+        self._calls = {}  # {(table, op): _CallStats}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.saturated_requests = 0  # requests that found every connection busy
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.pool_wait_total = 0.0
+        self.pool_wait_max = 0.0
+        # Passive reachability: any response below 500 proves the backend is up
+        self.last_reachable = None    # monotonic
+        self.last_unreachable = None  # monotonic
+        self.last_unreachable_error = None
+
+    def saw_backend(self, reachable, error=None):
+        if reachable:
+            self.last_reachable = time.monotonic()
+        else:
+            self.last_unreachable = time.monotonic()
+            self.last_unreachable_error = error
+
+    def begin(self):
+        with self._lock:
+            self.in_flight += 1
+            if self.in_flight > self.peak_in_flight:
+                self.peak_in_flight = self.in_flight
+            if self.in_flight > self.max_connections:
+                self.saturated_requests += 1
+
+    def end(self, table, op, seconds, failed, pool_wait, new_connection):
+        with self._lock:
+            self.in_flight -= 1
+            stats = self._calls.get((table, op))
+            if stats is None:
+                stats = self._calls[(table, op)] = _CallStats()
+            stats.observe(seconds, failed)
+            if new_connection is not None:
+                if new_connection:
+                    self.new_connections += 1
+                else:
+                    self.reused_connections += 1
+            if pool_wait is not None:
+                self.pool_wait_total += pool_wait
+                if pool_wait > self.pool_wait_max:
+                    self.pool_wait_max = pool_wait
+
+    def snapshot(self):
+        with self._lock:
+            total = sum(s.count for s in self._calls.values())
+            connections = self.new_connections + self.reused_connections
+            return {
+                "pool": {
+                    "max_connections": self.max_connections,
+                    "in_flight": self.in_flight,
+                    "peak_in_flight": self.peak_in_flight,
+                    "saturated_requests": self.saturated_requests,
+                    "new_connections": self.new_connections,
+                    "reused_connections": self.reused_connections,
+                    "reuse_ratio": round(self.reused_connections / connections, 3) if connections else 0,
+                    "avg_pool_wait_ms": round(self.pool_wait_total / total * 1000, 2) if total else 0,
+                    "max_pool_wait_ms": round(self.pool_wait_max * 1000, 2),
+                },
+                "round_trips": total,
+                "calls": {f"{t}.{op}": s.as_dict() for (t, op), s in sorted(self._calls.items())},
+            }
+
+
+class _TimedStream(httpx.SyncByteStream):
+    """Wraps a response body so the round trip is only closed once it is read."""
+
+    def __init__(self, inner, on_close):
+        self._inner = inner
+        self._on_close = on_close
+
+    def __iter__(self):
+        for chunk in self._inner:
+            yield chunk
+
+    def close(self):
+        try:
+            self._inner.close()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close:
+                on_close()
+
+
+class InstrumentedTransport(httpx.HTTPTransport):
+    """HTTPTransport that records latency, pool wait and connection reuse."""
+
+    def __init__(self, stats, **kwargs):
+        super().__init__(**kwargs)
+        self.stats = stats
+
+    def handle_request(self, request):
+        table, op = _classify(request)
+        started = time.perf_counter()
+        marks = {}
+
+        def trace(event, info):
+            # First of these events = a pooled connection was handed to us
+            if event == "connection.connect_tcp.started":
+                marks.setdefault("acquired", time.perf_counter())
+                marks["new"] = True
+            elif event.endswith("send_request_headers.started"):
+                marks.setdefault("acquired", time.perf_counter())
+                marks.setdefault("new", False)
+
+        request.extensions["trace"] = trace
+        self.stats.begin()
+
+        def finish(failed):
+            acquired = marks.get("acquired")
+            elapsed = time.perf_counter() - started
+            self.stats.end(
+                table, op,
+                elapsed,
+                failed,
+                (acquired - started) if acquired else None,
+                marks.get("new"),
+            )
+            backend_latency.observe(elapsed)
+            # Attribute the round trip to the request running in this greenlet
+            tracing.record_call(table, op, elapsed, failed)
+
+        try:
+            response = super().handle_request(request)
+        except Exception as e:
+            self.stats.saw_backend(False, f"{type(e).__name__}: {e}")
+            finish(True)
+            raise
+
+        self.stats.saw_backend(response.status_code < 500, f"HTTP {response.status_code}")
+        failed = response.status_code >= 400
+        response.stream = _TimedStream(response.stream, lambda: finish(failed))
+        return response
+
+
+# Module-level stats for the process-wide client (None until configured)
+transport_stats = None
+
+
+def build_http_client(config):
+    """Create the pooled, instrumented httpx client shared by the Supabase SDK."""
+    global transport_stats
+
+    max_connections = int(config.get("DB_MAX_CONNECTIONS", 20))
+    http2 = bool(config.get("DB_HTTP2", True))
+    if http2:
+        try:
+            import h2  # noqa: F401  (optional: httpx[http2])
+        except ImportError:
+            logger.info("HTTP/2 requested for Supabase but 'h2' is not installed, using HTTP/1.1")
+            http2 = False
+
+    limits = httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=int(config.get("DB_MAX_KEEPALIVE", 10)),
+        keepalive_expiry=float(config.get("DB_KEEPALIVE_EXPIRY", 30)),
+    )
+    timeout = httpx.Timeout(
+        connect=float(config.get("DB_CONNECT_TIMEOUT", 5)),
+        read=float(config.get("DB_READ_TIMEOUT", 15)),
+        write=float(config.get("DB_WRITE_TIMEOUT", 15)),
+        pool=float(config.get("DB_POOL_TIMEOUT", 10)),
+    )
+
+    transport_stats = TransportStats(max_connections)
+    transport = InstrumentedTransport(transport_stats, limits=limits, http2=http2)
+    logger.info(
+        f"🔌 Supabase pool: max={max_connections} keepalive={limits.max_keepalive_connections} "
+        f"http2={http2} timeout={timeout}"
+    )
+    return httpx.Client(transport=transport, timeout=timeout, follow_redirects=True)
+
+
+def get_transport_stats():
+    """Snapshot of the shared pool's counters ({} before the client exists)."""
+    return transport_stats.snapshot() if transport_stats else {}
+
+
+@metrics.register_collector
+def _collect_transport():
+    """Export the pool's own counters at scrape time (no double bookkeeping)."""
+    stats = transport_stats
+    if stats is None:
+        return []
+    with stats._lock:
+        calls = [(k, list(v.buckets), v.total_seconds, v.count, v.errors) for k, v in stats._calls.items()]
+        pool = {
+            "in_flight": stats.in_flight,
+            "peak_in_flight": stats.peak_in_flight,
+            "max_connections": stats.max_connections,
+        }
+        counters = {
+            "saturated_requests": stats.saturated_requests,
+            "new_connections": stats.new_connections,
+            "reused_connections": stats.reused_connections,
+            "pool_wait_seconds": stats.pool_wait_total,
+        }
+
+    name = "lab_supabase_request_duration_seconds"
+    lines = [f"# HELP {name} Supabase round-trip latency by table and operation.", f"# TYPE {name} histogram"]
+    for (table, op), buckets, total, count, _ in calls:
+        lines.extend(metrics.histogram_lines(name, ("table", "op"), (table, op), LATENCY_BUCKETS, buckets, total, count))
+
+    lines += ["# HELP lab_supabase_request_errors_total Failed Supabase round trips.",
+              "# TYPE lab_supabase_request_errors_total counter"]
+    for (table, op), _, _, _, errors in calls:
+        lines.append(f'lab_supabase_request_errors_total{{table="{table}",op="{op}"}} {errors}')
+
+    for key, value in pool.items():
+        lines += [f"# TYPE lab_supabase_pool_{key} gauge", f"lab_supabase_pool_{key} {value}"]
+    for key, value in counters.items():
+        lines += [f"# TYPE lab_supabase_pool_{key}_total counter", f"lab_supabase_pool_{key}_total {value}"]
+    return lines
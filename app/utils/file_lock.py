@@ -0,0 +1,32 @@
+"""
+Non-blocking exclusive lock on a file, held while its handle stays open.
+
+flock on POSIX. On Windows (Start_Server_Live.bat runs `python wsgi.py`)
+there is no fcntl, so msvcrt.locking takes one byte far past the file's
+data instead: the lock excludes other lockers without blocking plain reads
+of the file. Either way the OS drops it when the process exits.
+"""
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+# Windows byte-range lock position (locking past EOF is allowed)
+_WINDOWS_LOCK_OFFSET = 1 << 30
+
+
+def try_lock(path, mode="a"):
+    """Open `path` and lock it; None when another process holds the lock."""
+    fh = open(path, mode)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            fh.seek(_WINDOWS_LOCK_OFFSET)
+            msvcrt.locking(fh.fileno(), msvcrt.LK_NBLCK, 1)
+            fh.seek(0)
+    except OSError:
+        fh.close()
+        return None
+    return fh
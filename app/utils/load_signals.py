@@ -0,0 +1,37 @@
+"""
+Cheap, process-wide load signals that background work can consult before
+adding pressure (e.g. retention pruning backs off when heartbeats slow down).
+"""
+import threading
+import time
+
+
+class Ewma:
+    """Exponentially weighted moving average of a latency, in seconds."""
+
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self._value = 0.0
+        self._updated = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            if self._updated == 0.0:
+                self._value = seconds
+            else:
+                self._value += self.alpha * (seconds - self._value)
+            self._updated = time.monotonic()
+
+    def value(self, max_age=120.0):
+        """Current average, or 0 if nothing was observed within max_age seconds."""
+        if not self._updated or time.monotonic() - self._updated > max_age:
+            return 0.0
+        return self._value
+
+
+# Wall time of /api/heartbeat requests (fed by the agent blueprint)
+heartbeat_latency = Ewma()
+
+# Duration of every Supabase round trip (fed by the pooled transport)
+backend_latency = Ewma()
@@ -0,0 +1,160 @@
+"""
+Minimal Prometheus-format metrics registry (no extra dependency).
+
+Hot-path updates are a dict lookup plus an add under a per-metric lock that
+is never held across I/O, so under gevent it is effectively uncontended and
+costs well under a microsecond. Anything that already keeps its own numbers
+(transport pool, spool, scheduler) is exported through collectors, which
+are only evaluated when /metrics is scraped.
+"""
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = []
+_collectors = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.extend(f'{n}="{_escape(v)}"' for n, v in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = list(self._values.items())
+        for labelvalues, value in items:
+            lines.append(f"{self.name}{format_labels(self.labelnames, labelvalues)} {format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def get(self, *labelvalues):
+        return self._values.get(labelvalues, 0)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                # [per-bucket counts (+Inf last), sum, count]
+                entry = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][idx] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = [(k, (list(v[0]), v[1], v[2])) for k, v in self._values.items()]
+        for labelvalues, (counts, total, count) in items:
+            lines.extend(histogram_lines(self.name, self.labelnames, labelvalues, self.buckets, counts, total, count))
+        return lines
+
+
+def histogram_lines(name, labelnames, labelvalues, buckets, counts, total, count):
+    """Prometheus lines for one histogram series from non-cumulative bucket counts."""
+    lines = []
+    cumulative = 0
+    for bound, n in zip(tuple(buckets) + (float("inf"),), counts):
+        cumulative += n
+        labels = format_labels(labelnames, labelvalues, [("le", format_value(float(bound)))])
+        lines.append(f"{name}_bucket{labels} {cumulative}")
+    labels = format_labels(labelnames, labelvalues)
+    lines.append(f"{name}_sum{labels} {total}")
+    lines.append(f"{name}_count{labels} {count}")
+    return lines
+
+
+def counter(name, documentation, labelnames=()):
+    metric = Counter(name, documentation, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def gauge(name, documentation, labelnames=()):
+    metric = Gauge(name, documentation, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    metric = Histogram(name, documentation, labelnames, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def register_collector(func):
+    """func() -> list of exposition lines, evaluated on every scrape."""
+    _collectors.append(func)
+    return func
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    for collect in _collectors:
+        try:
+            lines.extend(collect())
+        except Exception as e:
+            lines.append(f"# collector {getattr(collect, '__name__', collect)} failed: {_escape(e)}")
+    return "\n".join(lines) + "\n"
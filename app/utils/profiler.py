@@ -0,0 +1,193 @@
+"""
+On-demand sampling profiler for live diagnosis (GET /api/admin/profile).
+
+A sampler walks every stack at a fixed rate and counts identical stacks,
+producing "collapsed" output (`root;frame;frame count`) that flamegraph.pl,
+speedscope and similar tools read directly.
+
+Under gevent the sampler runs in a native OS thread, so it can catch a
+greenlet that hogs the CPU without yielding. Each sample covers:
+  * the frame currently executing in every OS thread (sys._current_frames)
+  * in "wall" mode, also the frame each parked greenlet is waiting in
+    (e.g. a heartbeat blocked on a Supabase round trip)
+Parked greenlets are found with one gc scan at start, plus a greenlet trace
+hook that picks up greenlets spawned while the profile runs.
+
+Overhead is bounded: the sample interval stretches so that time spent
+sampling stays below `max_overhead` of wall time, and the duration and rate
+are capped by the caller. Only one profile runs at a time.
+"""
+import gc
+import sys
+import threading
+import time
+import weakref
+
+try:
+    import greenlet
+    from gevent import monkey as _monkey
+    import gevent
+except ImportError:  # pragma: no cover - gevent is in requirements.txt
+    greenlet = None
+    _monkey = None
+    gevent = None
+
+MAX_DEPTH = 128
+
+_busy = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def _gevent_threads():
+    return _monkey is not None and _monkey.is_module_patched("threading")
+
+
+def _original(module, name):
+    if _gevent_threads():
+        return _monkey.get_original(module, name)
+    return getattr(__import__(module), name)
+
+
+def _label(frame, lines):
+    code = frame.f_code
+    module = frame.f_globals.get("__name__", "?")
+    label = f"{module}:{code.co_name}"
+    if lines:
+        label += f":{frame.f_lineno}"
+    return label.replace(";", ":").replace(" ", "_")
+
+
+def _collapse(root, frame, lines):
+    stack = []
+    while frame is not None and len(stack) < MAX_DEPTH:
+        stack.append(_label(frame, lines))
+        frame = frame.f_back
+    stack.append(root)
+    stack.reverse()
+    return ";".join(stack)
+
+
+class _GreenletRegistry:
+    """Weak set of greenlets seen so far, safe to snapshot from another thread."""
+
+    def __init__(self):
+        self._refs = {}
+        self._previous = None
+
+    def _add(self, g):
+        self._refs[id(g)] = weakref.ref(g)
+
+    def _trace(self, event, args):
+        if event in ("switch", "throw"):
+            self._add(args[1])
+        if self._previous is not None:
+            self._previous(event, args)
+
+    def start(self):
+        for obj in gc.get_objects():
+            if isinstance(obj, greenlet.greenlet):
+                self._add(obj)
+        self._previous = greenlet.settrace(self._trace)
+
+    def stop(self):
+        greenlet.settrace(self._previous)
+
+    def snapshot(self):
+        alive = []
+        for key, ref in list(self._refs.items()):
+            g = ref()
+            if g is None or g.dead:
+                self._refs.pop(key, None)
+            else:
+                alive.append(g)
+        return alive
+
+
+def _sample_loop(seconds, hz, max_overhead, mode, lines, thread_names, skip_threads, skip_greenlets, registry):
+    sleep = _original("time", "sleep")
+    own_thread = _original("_thread", "get_ident")()
+    skip_threads = set(skip_threads) | {own_thread}
+    counts = {}
+    samples = 0
+    sampling_time = 0.0
+    base_interval = 1.0 / hz
+    interval = base_interval
+
+    started = time.perf_counter()
+    deadline = started + seconds
+    while True:
+        t0 = time.perf_counter()
+        if t0 >= deadline:
+            break
+        for ident, frame in sys._current_frames().items():
+            if ident in skip_threads:
+                continue
+            root = thread_names.get(ident) or f"thread-{ident}"
+            key = _collapse(root, frame, lines)
+            counts[key] = counts.get(key, 0) + 1
+        if mode == "wall" and registry is not None:
+            for g in registry.snapshot():
+                frame = g.gr_frame
+                if frame is None or id(g) in skip_greenlets:
+                    continue
+                key = _collapse("greenlets-waiting", frame, lines)
+                counts[key] = counts.get(key, 0) + 1
+        samples += 1
+        cost = time.perf_counter() - t0
+        sampling_time += cost
+        # Stretch the interval rather than exceed the overhead budget
+        interval = max(base_interval, cost / max_overhead)
+        sleep(max(0.0, min(interval - cost, deadline - time.perf_counter())))
+
+    elapsed = time.perf_counter() - started
+    return {
+        "samples": samples,
+        "duration_seconds": round(elapsed, 3),
+        "requested_hz": hz,
+        "effective_hz": round(samples / elapsed, 1) if elapsed else 0.0,
+        "overhead": round(sampling_time / elapsed, 4) if elapsed else 0.0,
+        "stacks": counts,
+    }
+
+
+def profile(seconds, hz, max_overhead=0.05, mode="wall", lines=False):
+    """
+    Sample all threads (and parked greenlets in "wall" mode) for `seconds`.
+    Returns a summary dict with `stacks` = {collapsed stack: count}.
+    Raises ProfilerBusy if another profile is already running.
+    """
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy("a profile is already running")
+    registry = None
+    try:
+        caller_thread = _original("_thread", "get_ident")()
+        if _gevent_threads():
+            setup_started = time.perf_counter()
+            registry = _GreenletRegistry()
+            registry.start()
+            setup_seconds = time.perf_counter() - setup_started
+            # The requesting greenlet only waits on the sampler; leave it out
+            skip_greenlets = {id(greenlet.getcurrent())}
+            # Greenlets all run on the requesting (main) OS thread
+            thread_names = {caller_thread: "MainThread"}
+            result = gevent.get_hub().threadpool.apply(
+                _sample_loop, (seconds, hz, max_overhead, mode, lines, thread_names, (), skip_greenlets, registry))
+        else:
+            setup_seconds = 0.0
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            result = _sample_loop(seconds, hz, max_overhead, mode, lines, thread_names, (caller_thread,), set(), None)
+        result["setup_ms"] = round(setup_seconds * 1000, 1)
+        result["mode"] = mode
+        return result
+    finally:
+        if registry is not None:
+            registry.stop()
+        _busy.release()
+
+
+def to_collapsed(stacks):
+    return "\n".join(f"{stack} {count}" for stack, count in
+                     sorted(stacks.items(), key=lambda kv: kv[1], reverse=True)) + "\n"
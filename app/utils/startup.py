@@ -0,0 +1,43 @@
+"""
+Startup cost accounting.
+
+`mark(phase)` records how long each boot phase took (imports, app factory,
+background start, cache warm-up) so cold starts can be compared across
+deploys. The timeline is logged once the process becomes ready and is part
+of the /ready response.
+"""
+import time
+
+_t0 = time.perf_counter()
+_last = _t0
+phases = {}       # {phase: ms}
+details = {}      # {phase: {item: ms}} e.g. per-blueprint import cost
+
+
+def mark(phase):
+    """Close `phase`: the time since the previous mark (or process import)."""
+    global _last
+    now = time.perf_counter()
+    phases[phase] = round((now - _last) * 1000, 1)
+    _last = now
+
+
+class timed:
+    """`with timed("blueprints", "agent"):` adds one item to a phase breakdown."""
+
+    def __init__(self, phase, item):
+        self.phase, self.item = phase, item
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        details.setdefault(self.phase, {})[self.item] = round((time.perf_counter() - self.started) * 1000, 1)
+
+
+def since_start_ms():
+    return round((time.perf_counter() - _t0) * 1000, 1)
+
+
+def report():
+    return {"phases_ms": dict(phases), "details_ms": {k: dict(v) for k, v in details.items()}}
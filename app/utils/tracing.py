@@ -0,0 +1,121 @@
+"""
+Per-request backend call tracing.
+
+The Supabase transport reports every round trip to `record_call()`, which
+attaches it to the trace of the request running in the current thread
+(greenlet under gevent). After the request we know how many backend calls it
+made, how long they took and how much time was left for Python itself.
+Requests over SLOW_REQUEST_MS get one structured log line with the call
+breakdown; SERVER_TIMING adds a `Server-Timing` header for browser devtools.
+"""
+import json
+import threading
+import time
+
+from flask import request
+
+from app.utils import metrics
+from app.utils.logger import logger
+
+_local = threading.local()
+
+DB_CALLS_PER_REQUEST = metrics.histogram(
+    "lab_http_request_db_calls", "Supabase round trips per HTTP request.",
+    ("blueprint", "route"), buckets=(0, 1, 2, 3, 4, 6, 8, 12, 20, 50))
+SLOW_REQUESTS = metrics.counter(
+    "lab_http_slow_requests_total", "Requests over the slow-request budget.", ("blueprint", "route"))
+
+# Sequential calls kept per trace (beyond this only the aggregates grow)
+MAX_CALLS_KEPT = 50
+
+
+class RequestTrace:
+    __slots__ = ("started", "calls", "db_seconds", "count")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.calls = []
+        self.db_seconds = 0.0
+        self.count = 0
+
+    def add(self, table, op, seconds, failed):
+        self.count += 1
+        self.db_seconds += seconds
+        if len(self.calls) < MAX_CALLS_KEPT:
+            self.calls.append((table, op, seconds, failed))
+
+    def breakdown(self):
+        grouped = {}
+        for table, op, seconds, _ in self.calls:
+            entry = grouped.setdefault(f"{table}.{op}", {"count": 0, "ms": 0.0})
+            entry["count"] += 1
+            entry["ms"] = round(entry["ms"] + seconds * 1000, 2)
+        return grouped
+
+
+def begin():
+    _local.trace = RequestTrace()
+    return _local.trace
+
+
+def current():
+    return getattr(_local, "trace", None)
+
+
+def end():
+    trace = getattr(_local, "trace", None)
+    _local.trace = None
+    return trace
+
+
+def record_call(table, op, seconds, failed=False):
+    """Called by the transport for every completed round trip."""
+    trace = getattr(_local, "trace", None)
+    if trace is not None:
+        trace.add(table, op, seconds, failed)
+
+
+def init_tracing(app):
+    budget = float(app.config.get("SLOW_REQUEST_MS", 500)) / 1000.0
+    server_timing = bool(app.config.get("SERVER_TIMING", False))
+
+    @app.before_request
+    def _begin_trace():
+        begin()
+
+    @app.after_request
+    def _finish_trace(response):
+        trace = current()
+        if trace is None:
+            return response
+        total = time.perf_counter() - trace.started
+        app_seconds = max(total - trace.db_seconds, 0.0)
+        blueprint = request.blueprint or "app"
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        DB_CALLS_PER_REQUEST.observe(trace.count, blueprint, route)
+
+        if server_timing:
+            response.headers["Server-Timing"] = (
+                f'db;dur={trace.db_seconds * 1000:.1f};desc="{trace.count} calls", '
+                f"app;dur={app_seconds * 1000:.1f}, total;dur={total * 1000:.1f}"
+            )
+
+        if total > budget:
+            SLOW_REQUESTS.inc(blueprint, route)
+            logger.warning("SLOW_REQUEST " + json.dumps({
+                "method": request.method,
+                "route": route,
+                "path": request.path,
+                "status": response.status_code,
+                "total_ms": round(total * 1000, 1),
+                "db_ms": round(trace.db_seconds * 1000, 1),
+                "app_ms": round(app_seconds * 1000, 1),
+                "db_calls": trace.count,
+                "by_call": trace.breakdown(),
+                "sequence": [f"{t}.{op}:{s * 1000:.0f}ms{'!' if failed else ''}" for t, op, s, failed in trace.calls],
+            }))
+        return response
+
+    @app.teardown_request
+    def _drop_trace(exc):
+        end()
@@ -0,0 +1,102 @@
+"""
+Bounded map whose entries expire a fixed time after their last write.
+
+Entries are kept in an OrderedDict in write order. Because every entry has
+the same TTL, that is also expiry order, so:
+  * set() refreshes an entry in O(1) by moving it to the end
+  * expiry only ever looks at the front, popping until it meets a live
+    entry (each write also reaps a couple of expired ones, so the cost is
+    amortized over writes instead of paid by readers)
+  * when the cap is hit the front entry, the least recently written one,
+    is evicted
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from app.utils import metrics
+
+REMOVALS = metrics.counter("lab_ttl_cache_removals_total", "Entries dropped from TTL caches.", ("cache", "reason"))
+
+_caches = []
+
+
+class TTLCache:
+    # Expired entries reaped per write; keeps expiry amortized without a sweeper
+    REAP_PER_WRITE = 2
+
+    def __init__(self, name, ttl, max_size):
+        self.name = name
+        self.ttl = float(ttl)
+        self.max_size = int(max_size)
+        self._data = OrderedDict()  # {key: (expires_at_monotonic, value)}
+        self._lock = threading.Lock()
+        _caches.append(self)
+
+    def configure(self, ttl=None, max_size=None):
+        with self._lock:
+            if ttl is not None:
+                self.ttl = float(ttl)
+            if max_size is not None:
+                self.max_size = int(max_size)
+            self._evict_over_cap()
+
+    def _reap(self, now, limit=None):
+        reaped = 0
+        while self._data and (limit is None or reaped < limit):
+            key, (expires_at, _) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[key]
+            reaped += 1
+        if reaped:
+            REMOVALS.inc(self.name, "expired", amount=reaped)
+
+    def _evict_over_cap(self):
+        evicted = 0
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            evicted += 1
+        if evicted:
+            REMOVALS.inc(self.name, "evicted", amount=evicted)
+
+    def set(self, key, value):
+        now = time.monotonic()
+        with self._lock:
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            self._reap(now, self.REAP_PER_WRITE)
+            self._evict_over_cap()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return default
+        return entry[1]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def items(self):
+        """Live (key, value) pairs, oldest write first."""
+        with self._lock:
+            self._reap(time.monotonic())
+            return [(key, value) for key, (_, value) in self._data.items()]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._data)
+
+
+@metrics.register_collector
+def _collect_sizes():
+    lines = [
+        "# HELP lab_ttl_cache_entries Entries held by each TTL cache (including not-yet-reaped expired ones).",
+        "# TYPE lab_ttl_cache_entries gauge",
+    ]
+    lines.extend(f'lab_ttl_cache_entries{{cache="{cache.name}"}} {len(cache)}' for cache in _caches)
+    return lines
@@ -2,14 +2,26 @@ import os
 
 # Gunicorn configuration settings
 bind = "0.0.0.0:" + os.environ.get("PORT", "5050")
-workers = 1
+# More than one worker needs state shared between them (discovery, actions,
+# report jobs, token revocations, live updates): app/services/shared_state.py
+workers = int(os.environ.get("WEB_CONCURRENCY", "1"))
+if workers > 1:
+    os.environ.setdefault("SHARED_STATE_BACKEND", "sqlite")
 worker_class = "geventwebsocket.gunicorn.workers.GeventWebSocketWorker"
 timeout = 120
 keepalive = 5
 threads = 4
-worker_connections = 1000
+# Size against GET /api/stats/transport: concurrent greenlets mostly wait on
+# the Supabase pool (DB_MAX_CONNECTIONS), so watch peak_in_flight/saturation.
+worker_connections = int(os.environ.get("WORKER_CONNECTIONS", "1000"))
 loglevel = "info"
 accesslog = "-"
 errorlog = "-"
 proc_name = "lab_guardian_api"
 preload_app = True
+
+def post_worker_init(worker):
+    # preload_app builds the app in the master; threads, the DB pool and the
+    # registry warm-up must start in each worker after fork, not before.
+    from app.services.lifecycle import start_background_services
+    start_background_services(worker.wsgi)
@@ -0,0 +1,151 @@
+"""
+Micro-benchmarks for the stats aggregation loops (app/services/aggregation.py).
+
+Runs location_stats, city_lab_stats, all_labs and utilization directly on
+synthetic fleets (loadtest/fleet.py, same shape as the exported lab payloads)
+of 1k, 10k and 100k devices, measuring wall time (best of repeats after a
+warm-up) and peak Python allocation (tracemalloc, in a separate run so it
+doesn't skew timing).
+
+    python -m loadtest.bench_stats                 # compare against baselines
+    python -m loadtest.bench_stats --save          # record new baselines
+    python -m loadtest.bench_stats --sizes 1000,10000 --only all_labs
+
+Baselines live in loadtest/baselines/stats.json. Timings are machine-specific:
+re-record them on the machine that runs the comparison. Exits 1 when any
+case regresses beyond --time-tolerance / --mem-tolerance.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timezone
+
+from app.services import aggregation
+from loadtest.fleet import build_devices
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "stats.json")
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+
+
+def _cases(devices, now):
+    busiest_city = Counter(d["city"] for d in devices).most_common(1)[0][0]
+    return {
+        "location_stats": lambda: aggregation.location_stats(devices, now),
+        "city_lab_stats": lambda: aggregation.city_lab_stats(devices, busiest_city, None, now),
+        "all_labs": lambda: aggregation.all_labs(devices, now),
+        "utilization": lambda: aggregation.utilization(devices, now),
+    }
+
+
+def _repeats(size):
+    return 25 if size <= 1_000 else 7 if size <= 10_000 else 3
+
+
+def measure(func, repeats):
+    func()  # warm-up: first call pays for cold caches and lazy imports
+    timings = []
+    for _ in range(repeats):
+        gc.collect()
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+
+    gc.collect()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"time_ms": round(min(timings) * 1000, 3), "peak_kb": round(peak / 1024, 1)}
+
+
+def run(sizes, only=None, seed=42):
+    results = {}
+    for size in sizes:
+        naive_now = datetime.utcnow()
+        devices = build_devices(size, seed, now=naive_now)
+        now = naive_now.replace(tzinfo=timezone.utc)
+        for name, func in _cases(devices, now).items():
+            if only and name not in only:
+                continue
+            results[f"{name}@{size}"] = measure(func, _repeats(size))
+            r = results[f"{name}@{size}"]
+            print(f"{name:16} {size:>7} rows  {r['time_ms']:>10.2f} ms  {r['peak_kb']:>10.1f} KiB peak", flush=True)
+    return results
+
+
+def compare(results, baselines, time_tol, mem_tol):
+    regressions = []
+    print(f"\n{'case':24} {'time':>10} {'base':>10} {'Δ%':>7}   {'peak KiB':>10} {'base':>10} {'Δ%':>7}")
+    for case, r in results.items():
+        base = baselines.get(case)
+        if not base:
+            print(f"{case:24} {r['time_ms']:>10.2f} {'-':>10} {'new':>7}")
+            continue
+        dt = (r["time_ms"] / base["time_ms"] - 1) * 100 if base["time_ms"] else 0.0
+        dm = (r["peak_kb"] / base["peak_kb"] - 1) * 100 if base["peak_kb"] else 0.0
+        flag = ""
+        if dt > time_tol * 100:
+            flag += " TIME"
+        if dm > mem_tol * 100:
+            flag += " MEM"
+        if flag:
+            regressions.append(case)
+        print(f"{case:24} {r['time_ms']:>10.2f} {base['time_ms']:>10.2f} {dt:>+7.1f}   "
+              f"{r['peak_kb']:>10.1f} {base['peak_kb']:>10.1f} {dm:>+7.1f}{flag}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES))
+    parser.add_argument("--only", help="comma separated case names")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--save", action="store_true", help="write results as the new baselines")
+    parser.add_argument("--baseline", default=BASELINE_FILE)
+    parser.add_argument("--time-tolerance", type=float, default=0.25, help="allowed slowdown, fraction")
+    parser.add_argument("--mem-tolerance", type=float, default=0.10, help="allowed peak memory growth, fraction")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    only = set(args.only.split(",")) if args.only else None
+    results = run(sizes, only, args.seed)
+
+    if args.save:
+        baselines = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baselines = json.load(f).get("cases", {})
+        baselines.update(results)
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({
+                "recorded_at": datetime.utcnow().isoformat() + "Z",
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cases": dict(sorted(baselines.items())),
+            }, f, indent=2)
+            f.write("\n")
+        print(f"\nBaselines saved to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baselines at {args.baseline}; run with --save first.")
+        return 0
+    with open(args.baseline) as f:
+        baselines = json.load(f).get("cases", {})
+    regressions = compare(results, baselines, args.time_tolerance, args.mem_tolerance)
+    if regressions:
+        print(f"\nRegressed: {', '.join(regressions)}")
+        return 1
+    print("\nNo regressions.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
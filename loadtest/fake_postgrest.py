@@ -0,0 +1,233 @@
+"""
+In-memory stand-in for the Supabase PostgREST API, good enough for load tests.
+
+Implements the subset the server uses: select (column list, eq/neq/lt/lte/
+gt/gte/ilike/is/in filters, `or=`/`and()` groups, multi-column order, limit,
+count=exact), insert, upsert with on_conflict, update and delete with
+filters. It is NOT a database: no indexes, JSON columns are stored as-is.
+
+    python -m loadtest.fake_postgrest --port 54321 --devices 5000
+"""
+import argparse
+import fnmatch
+import json
+import threading
+from urllib.parse import parse_qsl, unquote
+
+PRIMARY_KEYS = {
+    "devices": ("system_id",),
+    "device_daily_history": ("device_id", "history_date"),
+    "app_usage_logs": ("device_id", "date", "app_name"),
+}
+
+
+class Store:
+    def __init__(self):
+        self.tables = {}  # {table: {pk-tuple: row}}
+        self.next_id = 1
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def rows(self, table):
+        return self.tables.setdefault(table, {})
+
+    def key(self, table, row, on_conflict=None):
+        cols = tuple(c.strip() for c in on_conflict.split(",")) if on_conflict else PRIMARY_KEYS.get(table, ("id",))
+        return tuple(str(row.get(c)) for c in cols)
+
+    def seed(self, table, rows):
+        with self.lock:
+            for row in rows:
+                self.rows(table)[self.key(table, row)] = dict(row)
+
+
+def _coerce(sample, raw):
+    if isinstance(sample, bool):
+        return raw == "true"
+    if isinstance(sample, int):
+        try: return int(raw)
+        except ValueError: return raw
+    if isinstance(sample, float):
+        try: return float(raw)
+        except ValueError: return raw
+    return raw
+
+
+def _matches(row, col, op, arg):
+    val = row.get(col)
+    if op == "is":
+        return val is None if arg == "null" else str(val).lower() == arg
+    if op == "in":
+        return str(val) in {v.strip('"') for v in arg.strip("()").split(",")}
+    if op == "ilike":
+        return val is not None and fnmatch.fnmatch(str(val).lower(), arg.lower().replace("%", "*"))
+    if val is None:
+        return False
+    other = _coerce(val, arg)
+    try:
+        return {
+            "eq": val == other, "neq": val != other,
+            "lt": val < other, "lte": val <= other,
+            "gt": val > other, "gte": val >= other,
+        }[op]
+    except (KeyError, TypeError):
+        return False
+
+
+def _split_terms(expr):
+    """Top-level comma-separated terms of an or()/and() body, honouring quotes and parentheses."""
+    terms, depth, quoted, start = [], 0, False, 0
+    for i, ch in enumerate(expr):
+        if ch == '"' and (i == 0 or expr[i - 1] != "\\"):
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            terms.append(expr[start:i])
+            start = i + 1
+    terms.append(expr[start:])
+    return terms
+
+
+def _logic(kind, body):
+    """Predicate for `or=(...)` / `and=(...)` bodies, nesting allowed."""
+    preds = []
+    for term in _split_terms(body):
+        if term.startswith(("or(", "and(")):
+            inner_kind, _, rest = term.partition("(")
+            preds.append(_logic(inner_kind, rest[:-1]))
+        else:
+            col, op, arg = term.split(".", 2)
+            if len(arg) >= 2 and arg[0] == arg[-1] == '"':
+                arg = arg[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+            preds.append(lambda r, f=(col, op, arg): _matches(r, *f))
+    combine = any if kind == "or" else all
+    return lambda r: combine(p(r) for p in preds)
+
+
+class _Group:
+    """A parsed or=/and= query parameter, usable wherever a filter tuple is."""
+
+    def __init__(self, kind, body):
+        self.pred = _logic(kind, body.strip()[1:-1])
+
+
+def _parse(query):
+    params = parse_qsl(query, keep_blank_values=True)
+    filters, opts = [], {}
+    for k, v in params:
+        if k in ("select", "order", "limit", "offset", "on_conflict", "columns"):
+            opts[k] = v
+        elif k in ("or", "and"):
+            filters.append(_Group(k, v))
+        elif "." in v:
+            op, arg = v.split(".", 1)
+            filters.append((k, op, unquote(arg)))
+    return filters, opts
+
+
+def _filter(row, f):
+    return f.pred(row) if isinstance(f, _Group) else _matches(row, *f)
+
+
+class FakePostgrest:
+    def __init__(self, store=None):
+        self.store = store or Store()
+
+    def __call__(self, environ, start_response):
+        self.store.requests += 1
+        path = environ.get("PATH_INFO", "")
+        table = path.rstrip("/").split("/")[-1]
+        method = environ["REQUEST_METHOD"]
+        filters, opts = _parse(environ.get("QUERY_STRING", ""))
+        prefer = environ.get("HTTP_PREFER", "")
+        body = b""
+        if method in ("POST", "PATCH"):
+            length = int(environ.get("CONTENT_LENGTH") or 0)
+            body = environ["wsgi.input"].read(length) if length else b""
+
+        store = self.store
+        with store.lock:
+            rows = store.rows(table)
+            if method in ("GET", "HEAD"):
+                result = [r for r in rows.values() if all(_filter(r, f) for f in filters)]
+                total = len(result)
+                if "order" in opts:
+                    # Stable sorts, least significant column first
+                    for term in reversed(opts["order"].split(",")):
+                        col, _, direction = term.partition(".")
+                        result.sort(key=lambda r: (r.get(col) is None, r.get(col)), reverse=direction.startswith("desc"))
+                offset = int(opts.get("offset", 0))
+                if "limit" in opts:
+                    result = result[offset:offset + int(opts["limit"])]
+                cols = [c.strip() for c in opts.get("select", "*").split(",")]
+                if cols != ["*"]:
+                    result = [{c: r.get(c) for c in cols} for r in result]
+            elif method == "POST":
+                payload = json.loads(body or b"[]")
+                payload = payload if isinstance(payload, list) else [payload]
+                upsert = "merge-duplicates" in prefer
+                result = []
+                for row in payload:
+                    row = dict(row)
+                    if "id" not in row and table not in PRIMARY_KEYS:
+                        row["id"] = store.next_id
+                        store.next_id += 1
+                    key = store.key(table, row, opts.get("on_conflict"))
+                    if upsert and key in rows:
+                        rows[key].update(row)
+                        row = rows[key]
+                    else:
+                        rows[key] = row
+                    result.append(row)
+                total = len(result)
+            elif method == "PATCH":
+                patch = json.loads(body or b"{}")
+                result = []
+                for r in rows.values():
+                    if all(_filter(r, f) for f in filters):
+                        r.update(patch)
+                        result.append(r)
+                total = len(result)
+            elif method == "DELETE":
+                doomed = [k for k, r in rows.items() if all(_filter(r, f) for f in filters)]
+                result = [rows.pop(k) for k in doomed]
+                total = len(result)
+            else:
+                start_response("405 Method Not Allowed", [("Content-Length", "0")])
+                return [b""]
+            payload = json.dumps(result if "return=minimal" not in prefer else []).encode()
+
+        headers = [("Content-Type", "application/json"), ("Content-Length", str(len(payload)))]
+        if "count=" in prefer:
+            headers.append(("Content-Range", f"0-{max(len(result) - 1, 0)}/{total}"))
+        status = "201 Created" if method == "POST" else "200 OK"
+        start_response(status, headers)
+        return [payload] if method != "HEAD" else [b""]
+
+
+def serve(port, devices=0, seed=42, host="127.0.0.1"):
+    from gevent.pywsgi import WSGIServer
+    from loadtest.fleet import build_devices
+
+    app = FakePostgrest()
+    if devices:
+        app.store.seed("devices", build_devices(devices, seed))
+    server = WSGIServer((host, port), app, log=None)
+    print(f"Fake PostgREST on http://{host}:{port}/rest/v1 with {devices} devices", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    from gevent import monkey
+    monkey.patch_all()
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=54321)
+    parser.add_argument("--devices", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    serve(args.port, args.devices, args.seed)
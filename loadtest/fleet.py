@@ -0,0 +1,125 @@
+"""
+Synthetic lab fleet shaped like the exported lab payloads (d.json / data.json):
+city -> tehsil -> lab ("341302 | GOVT. GRADUATE COLLEGE (W), KAMOKE, GUJRANWALA")
+-> PCs, with devices rows carrying the same columns the server reads.
+
+Deterministic for a given seed so load runs and benchmarks are comparable.
+"""
+import random
+import uuid
+from datetime import datetime, timedelta
+
+CITIES = {
+    "Lahore": ["FAWARA CHOWK", "GHULAM MUHAMMADABAD", "MODEL TOWN", "SHALIMAR", "RAIWIND"],
+    "Gujranwala": ["KAMOKE", "GAKHAR MANDI", "RAHWALI", "WAZIRABAD", "NOWSHERA VIRKAN"],
+    "Chiniot": ["AMINPUR BANGLOW", "BHAWANA", "LALIAN"],
+    "Bhakkar": ["47/TDA", "DARYA KHAN", "KALLUR KOT", "MANKERA"],
+    "Faisalabad": ["JARANWALA", "SAMUNDRI", "TANDLIANWALA", "CHAK JHUMRA"],
+    "Multan": ["SHUJABAD", "JALALPUR PIRWALA", "MULTAN SADDAR"],
+    "Rawalpindi": ["GUJAR KHAN", "KAHUTA", "MURREE", "TAXILA"],
+    "Sargodha": ["BHALWAL", "KOT MOMIN", "SILLANWALI", "SAHIWAL"],
+}
+COLLEGE_KINDS = [
+    "GOVT. ASSOCIATE COLLEGE", "GOVT. ASSOCIATE COLLEGE (W)", "GOVT. GRADUATE COLLEGE",
+    "GOVT. GRADUATE COLLEGE (W)", "GOVT. HIGHER SECONDARY SCHOOL", "GOVT. POSTGRADUATE COLLEGE",
+]
+# Work apps count as "used" in utilization stats, the rest is background noise
+WORK_APPS = ["chrome.exe", "msedge.exe", "code.exe", "winword.exe", "excel.exe", "powerpnt.exe",
+             "pycharm64.exe", "vlc.exe", "zoom.exe", "notepad++.exe"]
+IDLE_APPS = ["explorer.exe", "taskmgr.exe", "searchhost.exe", "shellexperiencehost.exe"]
+
+
+class Lab:
+    __slots__ = ("city", "tehsil", "name", "size")
+
+    def __init__(self, city, tehsil, name, size):
+        self.city, self.tehsil, self.name, self.size = city, tehsil, name, size
+
+
+def build_labs(n_devices, seed=42, pcs_per_lab=(15, 40)):
+    """Enough labs to hold n_devices PCs, spread over the city/tehsil hierarchy."""
+    rnd = random.Random(seed)
+    labs, total, code = [], 0, 330000
+    cities = list(CITIES.items())
+    while total < n_devices:
+        city, tehsils = cities[len(labs) % len(cities)]
+        tehsil = rnd.choice(tehsils)
+        code += rnd.randint(1, 40)
+        name = f"{code} | {rnd.choice(COLLEGE_KINDS)}, {tehsil}, {city.upper()}"
+        size = min(rnd.randint(*pcs_per_lab), n_devices - total)
+        labs.append(Lab(city, tehsil, name, size))
+        total += size
+    return labs
+
+
+def hardware_id(index):
+    return str(uuid.uuid5(uuid.NAMESPACE_DNS, f"lab-guardian-loadtest-{index}")).upper()
+
+
+def build_devices(n_devices, seed=42, now=None, online_ratio=0.6, stale_ratio=0.1):
+    """devices table rows (as returned by select('*')) for a synthetic fleet."""
+    rnd = random.Random(seed)
+    now = now or datetime.utcnow()
+    rows, index = [], 0
+    for lab in build_labs(n_devices, seed):
+        for pc in range(lab.size):
+            index += 1
+            roll = rnd.random()
+            if roll < online_ratio:
+                status, last_seen = "online", now - timedelta(seconds=rnd.randint(0, 50))
+            elif roll < online_ratio + stale_ratio:
+                status, last_seen = "offline", now - timedelta(days=rnd.randint(8, 60))
+            else:
+                status, last_seen = "offline", now - timedelta(minutes=rnd.randint(2, 600))
+            usage = {app: rnd.randint(0, 3600) for app in rnd.sample(WORK_APPS + IDLE_APPS, rnd.randint(1, 6))}
+            usage["__current_cpu__"] = round(rnd.uniform(1, 95), 1)
+            rows.append({
+                "system_id": str(index),
+                "hardware_id": hardware_id(index),
+                "pc_name": f"PC-{pc + 1:02d}",
+                "city": lab.city,
+                "tehsil": lab.tehsil,
+                "lab_name": lab.name,
+                "status": status,
+                "last_seen": last_seen.isoformat() + "Z",
+                "today_start_time": (now - timedelta(hours=rnd.randint(0, 8))).isoformat() + "Z",
+                "today_last_active": last_seen.isoformat() + "Z",
+                "cpu_score": round(rnd.uniform(10, 100), 1),
+                "runtime_minutes": rnd.randint(0, 480),
+                "app_usage": usage,
+            })
+    return rows
+
+
+class Agent:
+    """One simulated PC: stable identity plus an app_usage map that grows per beat."""
+
+    def __init__(self, device, seed=0):
+        self.device = device
+        self.rnd = random.Random(f"{seed}-{device['system_id']}")
+        self.session_start = datetime.utcnow().isoformat() + "Z"
+        self.usage = {}
+        self.beats = 0
+        self.favourites = self.rnd.sample(WORK_APPS, 3) + self.rnd.sample(IDLE_APPS, 1)
+
+    def heartbeat_payload(self, interval):
+        self.beats += 1
+        # Usually the foreground app accrues the whole interval; sometimes a new app opens
+        app = self.rnd.choice(self.favourites)
+        if self.rnd.random() < 0.05:
+            app = self.rnd.choice(WORK_APPS)
+        self.usage[app] = self.usage.get(app, 0) + interval
+        now = datetime.utcnow().isoformat() + "Z"
+        return {
+            "hardware_id": self.device["hardware_id"],
+            "pc_name": self.device["pc_name"],
+            "city": self.device["city"],
+            "tehsil": self.device["tehsil"],
+            "lab_name": self.device["lab_name"],
+            "cpu_score": round(self.rnd.uniform(10, 100), 1),
+            "runtime_minutes": self.beats * interval / 60,
+            "session_start": self.session_start,
+            "last_active": now,
+            "status": "online",
+            "app_usage": {**self.usage, "__current_cpu__": round(self.rnd.uniform(1, 95), 1)},
+        }
@@ -0,0 +1,246 @@
+"""
+Simulated agent fleet load test.
+
+Spins up the in-memory PostgREST stand-in and the real server
+(gunicorn -c gunicorn_config.py wsgi:app, i.e. the production worker setup),
+then drives N simulated agents beating /api/heartbeat at the agent cadence
+plus M dashboards polling the stats routes, and reports throughput and
+p50/p95/p99 latency per endpoint.
+
+    python -m loadtest.run --agents 1000 --duration 60
+    python -m loadtest.run --agents 50000 --interval 10 --concurrency 500 --json out.json
+    python -m loadtest.run --target http://127.0.0.1:5050 --agents 200   # existing server
+"""
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import gevent
+import gevent.pool
+import requests
+
+from loadtest.fleet import Agent, build_devices, hardware_id
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DASHBOARD_ROUTES = [
+    ("GET /api/stats/overview", "/api/stats/overview"),
+    ("GET /api/stats/locations", "/api/stats/locations"),
+    ("GET /api/stats/labs/all", "/api/stats/labs/all"),
+    ("GET /api/stats/utilization", "/api/stats/utilization"),
+    ("GET /api/stats/city/<city>/labs", "/api/stats/city/{city}/labs"),
+    ("GET /api/devices?city=", "/api/devices?city={city}"),
+]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_http(url, proc=None, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc is not None and proc.poll() is not None:
+            raise RuntimeError(f"{' '.join(proc.args)} exited with {proc.returncode}")
+        try:
+            if requests.get(url, timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * pct / 100.0
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}  # {endpoint: [seconds]}
+        self.errors = {}
+        self.statuses = {}
+
+    def record(self, endpoint, seconds, status):
+        self.latencies.setdefault(endpoint, []).append(seconds)
+        self.statuses.setdefault(endpoint, {}).setdefault(status, 0)
+        self.statuses[endpoint][status] += 1
+        if status == "error" or (isinstance(status, int) and status >= 500):
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, elapsed):
+        rows = {}
+        for endpoint, values in sorted(self.latencies.items()):
+            values.sort()
+            rows[endpoint] = {
+                "requests": len(values),
+                "rps": round(len(values) / elapsed, 1),
+                "errors": self.errors.get(endpoint, 0),
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+                "max_ms": round(values[-1] * 1000, 1),
+                "statuses": {str(k): v for k, v in self.statuses[endpoint].items()},
+            }
+        return rows
+
+
+def _call(session, recorder, endpoint, method, url, **kwargs):
+    started = time.perf_counter()
+    resp = None
+    try:
+        resp = session.request(method, url, timeout=30, **kwargs)
+        status = resp.status_code
+    except requests.RequestException:
+        status = "error"
+    recorder.record(endpoint, time.perf_counter() - started, status)
+    return resp
+
+
+def run_agent(agent, args, base, session, pool, recorder, stop_at):
+    gevent.sleep(random.uniform(0, args.interval))  # agents boot at different times
+    interval = args.interval
+    while time.time() < stop_at:
+        payload = agent.heartbeat_payload(interval)
+        job = pool.spawn(_call, session, recorder, "POST /api/heartbeat", "POST", f"{base}/api/heartbeat", json=payload)
+        if args.adaptive:
+            # Follow the server-chosen cadence like a real agent would
+            resp = job.get()
+            try:
+                interval = float(resp.json().get("next_interval_seconds") or args.interval)
+            except (AttributeError, ValueError):
+                interval = args.interval
+        gevent.sleep(interval)
+
+
+def run_dashboard(idx, args, base, session, pool, recorder, cities, stop_at):
+    gevent.sleep(random.uniform(0, args.dashboard_interval))
+    i = idx
+    while time.time() < stop_at:
+        endpoint, path = DASHBOARD_ROUTES[i % len(DASHBOARD_ROUTES)]
+        i += 1
+        url = base + path.format(city=random.choice(cities))
+        pool.spawn(_call, session, recorder, endpoint, "GET", url)
+        gevent.sleep(args.dashboard_interval)
+
+
+def start_stack(args, workdir, procs):
+    """Fake backend + gunicorn app; appends both to procs and returns the base URL."""
+    db_port = _free_port()
+    procs.append(subprocess.Popen(
+        [sys.executable, "-m", "loadtest.fake_postgrest", "--port", str(db_port),
+         "--devices", str(args.agents), "--seed", str(args.seed)],
+        cwd=ROOT))
+    _wait_http(f"http://127.0.0.1:{db_port}/rest/v1/devices?limit=1", procs[-1])
+
+    app_port = _free_port()
+    env = dict(os.environ,
+               PORT=str(app_port),
+               SUPABASE_URL=f"http://127.0.0.1:{db_port}",
+               SUPABASE_SERVICE_KEY="loadtest",
+               SPOOL_DIR=os.path.join(workdir, "spool"))
+    log = open(os.path.join(workdir, "server.log"), "w")
+    procs.append(subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn_config.py", "--access-logfile", "/dev/null", "wsgi:app"],
+        cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT))
+    base = f"http://127.0.0.1:{app_port}"
+    try:
+        _wait_http(f"{base}/ready", procs[-1])
+    except RuntimeError:
+        raise RuntimeError(f"server did not start, see {log.name}") from None
+    return base
+
+
+def print_report(rows, elapsed, args):
+    print(f"\n=== {args.agents} agents @ {args.interval}s, {args.dashboards} dashboards, {elapsed:.0f}s ===")
+    header = f"{'endpoint':34} {'reqs':>8} {'rps':>8} {'err':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}"
+    print(header)
+    print("-" * len(header))
+    for endpoint, r in rows.items():
+        print(f"{endpoint:34} {r['requests']:8} {r['rps']:8} {r['errors']:6} "
+              f"{r['p50_ms']:8} {r['p95_ms']:8} {r['p99_ms']:8} {r['max_ms']:8}")
+    expected = args.agents / args.interval
+    got = rows.get("POST /api/heartbeat", {}).get("rps", 0)
+    print(f"\nHeartbeat throughput: {got} rps (offered ~{expected:.1f} rps)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--agents", type=int, default=100, help="simulated PCs (100 .. 50000)")
+    parser.add_argument("--unregistered", type=int, default=0, help="extra agents not in the registry (discovery path)")
+    parser.add_argument("--interval", type=float, default=10.0, help="heartbeat cadence per agent, seconds")
+    parser.add_argument("--adaptive", action="store_true", help="follow next_interval_seconds from heartbeat responses")
+    parser.add_argument("--dashboards", type=int, default=5, help="dashboard viewers polling stats routes")
+    parser.add_argument("--dashboard-interval", type=float, default=5.0)
+    parser.add_argument("--duration", type=float, default=60.0, help="measured seconds")
+    parser.add_argument("--concurrency", type=int, default=200, help="max in-flight requests from the generator")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--target", help="use an already running server instead of spawning the stack")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix="lab-loadtest-")
+    procs = []
+    try:
+        if args.target:
+            base = args.target.rstrip("/")
+        else:
+            base = start_stack(args, workdir, procs)
+
+        devices = build_devices(args.agents, args.seed)
+        agents = [Agent(d, args.seed) for d in devices]
+        for i in range(args.unregistered):
+            ghost = dict(devices[i % len(devices)], hardware_id=hardware_id(10_000_000 + i), pc_name=f"GHOST-{i}")
+            agents.append(Agent(ghost, args.seed))
+        cities = sorted({d["city"] for d in devices})
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=args.concurrency)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        pool = gevent.pool.Pool(args.concurrency)
+        recorder = Recorder()
+
+        started = time.time()
+        stop_at = started + args.duration
+        workers = [gevent.spawn(run_agent, a, args, base, session, pool, recorder, stop_at) for a in agents]
+        workers += [gevent.spawn(run_dashboard, i, args, base, session, pool, recorder, cities, stop_at)
+                    for i in range(args.dashboards)]
+        gevent.joinall(workers)
+        pool.join(timeout=30)
+        elapsed = time.time() - started
+
+        rows = recorder.report(elapsed)
+        print_report(rows, elapsed, args)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"config": vars(args), "elapsed_seconds": elapsed, "endpoints": rows}, f, indent=2)
+        if procs:
+            print(f"Server log: {os.path.join(workdir, 'server.log')}")
+    finally:
+        for p in reversed(procs):
+            p.terminate()
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Shared fixtures.
+
+`db`: an in-memory stand-in for the Supabase query builder. Only the calls
+the services under test make are supported (select / insert / upsert /
+update with eq, in_ and lt filters). `db.fail` lets a test make calls
+raise: a callable taking the Query and returning an exception or None.
+
+`postgrest`: the real Supabase client talking to loadtest.fake_postgrest
+in-process, for code whose PostgREST query strings matter (or=, order).
+"""
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app.extensions as extensions
+
+
+def _value(v):
+    # Postgres compares timestamptz by value: "...Z" equals "...+00:00"
+    if isinstance(v, str) and "T" in v:
+        try:
+            return datetime.fromisoformat(v.replace("Z", "+00:00"))
+        except ValueError:
+            pass
+    return str(v)
+
+
+class Result:
+    def __init__(self, data):
+        self.data = data
+        self.count = len(data)
+
+
+class Query:
+    def __init__(self, db, table):
+        self.db, self.table = db, table
+        self.op, self.payload, self.filters, self.on_conflict = "select", None, [], None
+
+    def select(self, cols="*", count=None):
+        self.op, self.cols = "select", cols
+        return self
+
+    def insert(self, payload):
+        self.op, self.payload = "insert", payload
+        return self
+
+    def upsert(self, payload, on_conflict=""):
+        self.op, self.payload, self.on_conflict = "upsert", payload, on_conflict
+        return self
+
+    def update(self, payload):
+        self.op, self.payload = "update", payload
+        return self
+
+    def eq(self, col, val):
+        self.filters.append(lambda r: _value(r.get(col)) == _value(val))
+        return self
+
+    def in_(self, col, vals):
+        vals = {_value(v) for v in vals}
+        self.filters.append(lambda r: _value(r.get(col)) in vals)
+        return self
+
+    def lt(self, col, val):
+        self.filters.append(lambda r: r.get(col) is not None and r.get(col) < val)
+        return self
+
+    def execute(self):
+        self.db.calls.append(self)
+        if self.db.fail:
+            error = self.db.fail(self)
+            if error is not None:
+                raise error
+        rows = self.db.tables.setdefault(self.table, [])
+        matched = [r for r in rows if all(f(r) for f in self.filters)]
+        payload = self.payload if isinstance(self.payload, list) else [self.payload]
+        if self.op == "select":
+            return Result([dict(r) for r in matched])
+        if self.op == "insert":
+            rows.extend(dict(p) for p in payload)
+            return Result(payload)
+        if self.op == "upsert":
+            keys = [c.strip() for c in self.on_conflict.split(",")]
+            for p in payload:
+                same = [r for r in rows if all(r.get(k) == p.get(k) for k in keys)]
+                if same:
+                    same[0].update(p)
+                else:
+                    rows.append(dict(p))
+            return Result(payload)
+        for r in matched:
+            r.update(self.payload)
+        return Result([dict(r) for r in matched])
+
+
+class FakeSupabase:
+    def __init__(self):
+        self.tables = {}
+        self.calls = []
+        self.fail = None
+
+    def table(self, name):
+        return Query(self, name)
+
+
+def api_error(code, message="refused"):
+    from postgrest.exceptions import APIError
+    return APIError({"code": code, "message": message})
+
+
+@pytest.fixture
+def db(monkeypatch):
+    fake = FakeSupabase()
+    monkeypatch.setattr(extensions, "supabase", fake)
+    return fake
+
+
+@pytest.fixture
+def postgrest(monkeypatch):
+    import httpx
+    from supabase import ClientOptions, create_client
+    from loadtest.fake_postgrest import FakePostgrest
+
+    fake = FakePostgrest()
+    client = create_client("http://postgrest.test", "service-key-for-the-test-suite-0000000000",
+                           options=ClientOptions(httpx_client=httpx.Client(transport=httpx.WSGITransport(app=fake))))
+    monkeypatch.setattr(extensions, "supabase", client)
+    return fake.store
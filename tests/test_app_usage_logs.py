@@ -0,0 +1,29 @@
+import pytest
+
+from app.routes import agent
+from app.services import app_catalogue, spool
+
+
+@pytest.fixture
+def writes(monkeypatch):
+    monkeypatch.setitem(app_catalogue.settings, "log_ids", True)
+    monkeypatch.setattr(app_catalogue, "catalogue", app_catalogue.AppCatalogue())
+    calls = []
+    monkeypatch.setattr(spool, "write", lambda table, op, rows, **kw: calls.append((table, op, rows, kw)))
+    return calls
+
+
+def test_names_sharing_an_app_id_become_one_row(postgrest, writes):
+    agent.process_app_logs_batch_background("7", {
+        "2026-10-18": {"Chrome.exe": 60, "chrome.exe": 30, " chrome.exe ": "10.0", "code.exe": 5},
+        "2026-10-19": {"chrome.exe": 20, "CHROME.EXE": 20},
+    })
+
+    [(table, op, rows, kw)] = writes
+    assert (table, op, kw) == ("app_usage_logs", "upsert", {"on_conflict": "device_id,date,app_id"})
+    ids = {row["id"]: row["name"] for row in postgrest.rows("apps").values()}
+    assert sorted((r["date"], ids[r["app_id"]], r["seconds_added"]) for r in rows) == [
+        ("2026-10-18", "chrome.exe", 100),
+        ("2026-10-18", "code.exe", 5),
+        ("2026-10-19", "chrome.exe", 40),
+    ]
@@ -0,0 +1,57 @@
+import httpx
+import pytest
+
+from app.services import device_state, spool
+
+
+@pytest.fixture(autouse=True)
+def clean(monkeypatch):
+    monkeypatch.setattr(device_state, "_touches", {})
+    monkeypatch.setattr(device_state, "_cache", device_state.TTLCache("device_state_test", 600, 1000))
+    monkeypatch.setitem(spool._state, "degraded_until", 0.0)
+
+
+def _row(sid, last_seen, status="online"):
+    return {"system_id": sid, "last_seen": last_seen, "status": status, "city": "LAHORE", "lab_name": "LAB 1"}
+
+
+def test_flush_writes_each_devices_own_second(db):
+    db.tables["devices"] = [_row("1", "2026-10-19T10:00:00Z"), _row("2", "2026-10-19T10:00:00Z")]
+    device_state.touch("1", "2026-10-19T10:00:05.250000Z")
+    device_state.touch("2", "2026-10-19T10:00:09.900000Z")
+
+    assert device_state.flush_touches() == 2
+    seen = {r["system_id"]: r["last_seen"] for r in db.tables["devices"]}
+    assert seen == {"1": "2026-10-19T10:00:05Z", "2": "2026-10-19T10:00:09Z"}
+
+
+def test_flush_brings_back_a_device_the_sweep_flipped(db):
+    db.tables["devices"] = [_row("1", "2026-10-19T10:00:00Z", status="offline")]
+    device_state.touch("1", "2026-10-19T10:01:30Z")
+    device_state.flush_touches()
+    assert db.tables["devices"][0]["status"] == "online"
+
+
+def test_requeued_touch_keeps_the_newest_time(db):
+    db.tables["devices"] = [_row("1", "2026-10-19T10:00:00Z")]
+    device_state.touch("1", "2026-10-19T10:00:05Z")
+    db.fail = lambda q: httpx.ReadTimeout("slow")
+    device_state.flush_touches()
+    device_state.touch("1", "2026-10-19T10:00:15Z")
+    spool._state["degraded_until"] = 0.0
+    db.fail = None
+
+    device_state.flush_touches()
+    assert db.tables["devices"][0]["last_seen"] == "2026-10-19T10:00:15Z"
+
+
+def test_swept_device_gets_a_full_write(db):
+    device_state.loaded(_row("1", "2026-10-19T10:00:00Z"))
+    update = {"status": "online", "app_usage": {}}
+    device_state.written("1", {**_row("1", "2026-10-19T10:00:00Z"), **update})
+    assert not device_state.needs_full_write("1", device_state.get("1"), update, "online")
+
+    device_state.swept([_row("1", "2026-10-19T10:00:00Z", status="offline")])
+    previous = device_state.get("1")
+    assert previous["status"] == "offline"
+    assert device_state.needs_full_write("1", previous, update, previous["status"])
@@ -0,0 +1,44 @@
+import time
+
+import jwt
+import pytest
+
+from app.services import device_tokens
+
+DEVICE = {"system_id": 7, "hardware_id": "HW-7", "city": "Lahore", "tehsil": "Model Town", "lab_name": "Lab 1"}
+
+
+@pytest.fixture(autouse=True)
+def tokens(monkeypatch):
+    monkeypatch.setattr(device_tokens, "settings", dict(device_tokens.settings))
+    monkeypatch.setattr(device_tokens, "_watermarks", {})
+    device_tokens.configure_tokens({"DEVICE_TOKEN_SECRET": "device-token-secret-for-the-test-suite", "DEVICE_TOKEN_TTL": 900})
+
+
+def test_supabase_jwt_secret_does_not_enable_tokens():
+    device_tokens.configure_tokens({"SUPABASE_JWT_SECRET": "supabase-jwt-secret-for-the-test-suite"})
+    assert not device_tokens.enabled()
+    assert device_tokens.issue(DEVICE) is None
+
+
+def test_verify_round_trip():
+    claims = device_tokens.verify(device_tokens.issue(DEVICE), "HW-7")
+    assert claims["sid"] == "7" and claims["lab"] == "Lab 1"
+    assert device_tokens.verify(device_tokens.issue(DEVICE), "HW-8") is None
+
+
+def test_token_signed_with_another_key_is_rejected():
+    forged = jwt.encode({"sub": "HW-7", "sid": "7", "ep": 0, "iat": time.time(), "exp": int(time.time()) + 60},
+                        "supabase-jwt-secret-for-the-test-suite", algorithm="HS256")
+    assert device_tokens.verify(forged, "HW-7") is None
+
+
+@pytest.mark.parametrize("scope", [
+    {"system_id": 7}, {"hardware_id": "HW-7"}, {"city": "LAHORE "}, {"city": "lahore", "lab": "lab 1"},
+])
+def test_revoke_covers_tokens_issued_before_it(scope):
+    token = device_tokens.issue(DEVICE)
+    device_tokens.revoke(**scope)
+    assert device_tokens.verify(token, "HW-7") is None
+    assert device_tokens.verify(device_tokens.issue(DEVICE), "HW-7") is not None
+
@@ -0,0 +1,22 @@
+from app.services.events import EventBus, settings
+
+
+def _bus(buffer_frames, frames):
+    bus = EventBus()
+    bus.configure({"STREAM_BUFFER_FRAMES": buffer_frames, "STREAM_COALESCE_SECONDS": settings["coalesce_seconds"]})
+    for i in range(frames):
+        bus.publish_device(str(i), {"city": "Lahore"}, {"status": "online"})
+        bus.flush()
+    return bus
+
+
+def test_wait_returns_the_frames_after_the_cursor():
+    bus = _bus(buffer_frames=10, frames=5)
+    assert [f.seq for f in bus.wait(3, 0.01)] == [4, 5]
+    assert bus.wait(5, 0.01) == []
+
+
+def test_reader_behind_the_ring_buffer_gets_none():
+    bus = _bus(buffer_frames=2, frames=5)
+    assert bus.wait(1, 0.01) is None
+    assert [f.seq for f in bus.wait(3, 0.01)] == [4, 5]
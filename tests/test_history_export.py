@@ -0,0 +1,42 @@
+from datetime import date
+
+import pytest
+
+from app.services import history_export
+
+# Ids PostgREST would misparse unquoted inside or=(...)
+DEVICES = ["1", "10", "2", "lab,7", 'pc"9']
+DAYS = ["2026-01-01", "2026-01-02", "2026-01-03"]
+
+
+@pytest.fixture
+def history(postgrest, monkeypatch):
+    monkeypatch.setitem(history_export.settings, "page_size", 4)
+    rows = [{"device_id": d, "history_date": day, "city": "Lahore" if d != "2" else "Multan"}
+            for d in DEVICES for day in DAYS]
+    postgrest.seed("device_daily_history", rows)
+    return rows
+
+
+def _keys(pages):
+    return [(r["device_id"], r["history_date"]) for page in pages for r in page]
+
+
+def test_pages_cover_every_row_once_in_key_order(history):
+    pages = list(history_export.iter_pages(date(2026, 1, 1), date(2026, 1, 3), {}))
+    assert all(len(page) <= 4 for page in pages)
+    assert _keys(pages) == sorted((r["device_id"], r["history_date"]) for r in history)
+
+
+def test_last_page_exactly_full(history, monkeypatch):
+    # 15 rows in pages of 5: the fourth request comes back empty and yields nothing
+    monkeypatch.setitem(history_export.settings, "page_size", 5)
+    pages = list(history_export.iter_pages(date(2026, 1, 1), date(2026, 1, 3), {}))
+    assert [len(p) for p in pages] == [5, 5, 5]
+
+
+def test_range_and_scope_filters(history):
+    pages = history_export.iter_pages(date(2026, 1, 2), date(2026, 1, 3), history_export.parse_scope("lahore"))
+    keys = _keys(pages)
+    assert len(keys) == 8
+    assert all(day != "2026-01-01" and device != "2" for device, day in keys)
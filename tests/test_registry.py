@@ -0,0 +1,44 @@
+from app.services.registry import DeviceRegistry
+
+
+def _row(sid, city="Lahore", tehsil="Model Town", lab="Lab 1", hid=None):
+    return {"system_id": sid, "hardware_id": hid, "pc_name": f"PC-{sid}", "city": city, "tehsil": tehsil, "lab_name": lab}
+
+
+def _registry(rows):
+    reg = DeviceRegistry()
+    reg._fetch_all = lambda: [dict(r) for r in rows]
+    reg.refresh()
+    return reg
+
+
+def test_loose_scope_matches_the_device_list_filter():
+    reg = _registry([_row("1"), _row("2", lab="LAB-1"), _row("3", lab="Lab 2"), _row("4", city="Multan")])
+    for lab in ("Lab-1", "lab1", "LAB 1"):
+        assert reg.scope_ids(city="lahore", lab=lab, exact=False) == {"1", "2"}
+    assert reg.scope_ids(city="La-hore", exact=False) == {"1", "2", "3"}
+
+
+def test_exact_scope_matches_the_stats_grouping():
+    reg = _registry([_row("1"), _row("2", lab="LAB-1"), _row("3", lab=None)])
+    assert reg.scope_ids(city=" lahore ", lab="lab 1") == {"1"}
+    assert reg.scope_ids(city="Lahore", lab="Lab-1") == {"2"}
+    assert reg.scope_ids(city="Lahore", lab="Main Lab") == {"3"}
+    assert reg.scope_ids(city="Lahore", lab="lab1") == set()
+
+
+def test_refresh_keeps_changes_made_while_it_was_fetching():
+    reg = _registry([_row("1"), _row("2"), _row("3")])
+
+    def fetch_racing_writes():
+        snapshot = [_row("1"), _row("2"), _row("3")]  # read before the writes below
+        reg.apply([_row("1", lab="Lab 9")])
+        reg.discard(["2"])
+        return snapshot
+
+    reg._fetch_all = fetch_racing_writes
+    reg.refresh()
+    assert reg.by_system_id("1")["lab_name"] == "Lab 9"
+    assert reg.by_system_id("2") is None
+    assert reg.scope_ids(city="Lahore", lab="Lab 1") == {"3"}
+    assert reg._journal == []
@@ -0,0 +1,102 @@
+import os
+import queue
+from datetime import date
+
+import pytest
+
+from app.services import reports
+from app.services.shared_state import SharedTTLMap
+
+USED = {"runtime_minutes": 60, "app_usage": {"chrome.exe": 600}}
+IDLE = {"runtime_minutes": 60, "app_usage": {"explorer.exe": 600}}
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    """Fresh job records and queue, no worker threads: jobs stay queued."""
+    monkeypatch.setattr(reports, "_jobs", SharedTTLMap("report_jobs_test", 900, 500))
+    monkeypatch.setattr(reports, "_latest", SharedTTLMap("report_keys_test", 900, 500))
+    monkeypatch.setattr(reports, "_pending", queue.Queue())
+    monkeypatch.setattr(reports, "_ensure_workers", lambda: None)
+    monkeypatch.setattr(reports, "_today", lambda: date(2026, 10, 19))
+    return reports
+
+
+@pytest.fixture
+def fleet(postgrest):
+    postgrest.seed("devices", [
+        {"system_id": "1", "city": "Lahore", "tehsil": "Model Town", "lab_name": "Lab 1",
+         "last_seen": "2026-10-19T09:00:00+00:00", **USED},
+        {"system_id": "2", "city": "lahore ", "tehsil": "Model Town", "lab_name": "LAB 1",
+         "last_seen": "2026-10-01T09:00:00+00:00", **IDLE},
+        {"system_id": "3", "city": "Lahore", "tehsil": "Model Town", "lab_name": "Lab 2",
+         "last_seen": "2026-09-01T09:00:00+00:00", **IDLE},
+        {"system_id": "4", "city": "Multan", "tehsil": "Bosan", "lab_name": "Lab 9",
+         "last_seen": "2026-10-18T09:00:00+00:00", **IDLE},
+    ])
+    # History keeps the hierarchy of its day; attribution goes by the device's current row
+    postgrest.seed("device_daily_history", [
+        {"device_id": "2", "history_date": "2026-10-10", "city": "Old City", **USED},
+        {"device_id": "3", "history_date": "2026-08-01", **USED},
+        {"device_id": "4", "history_date": "2026-10-17", **IDLE},
+    ])
+    return postgrest
+
+
+def test_invalid_params_are_rejected(jobs):
+    with pytest.raises(KeyError):
+        reports.submit("nope", {})
+    for params in ({"days": 0}, {"days": "x"}, {"from": "2026-10-19", "to": "2026-10-01"},
+                   {"from": "19/10/2026"}, {"scope": "/Model Town"}):
+        with pytest.raises(ValueError):
+            reports.submit("unused_labs", params)
+
+
+def test_same_report_reuses_the_job(jobs):
+    job, reused = reports.submit("unused_labs", {"days": 30, "scope": "Lahore "})
+    assert not reused
+    # Same canonical parameters spelled differently
+    again, reused = reports.submit("unused_labs", {"from": "2026-09-20", "to": "2026-10-19", "scope": "Lahore"})
+    assert reused and again["id"] == job["id"]
+    fresh, reused = reports.submit("unused_labs", {"days": 30, "scope": "Lahore"}, refresh=True)
+    assert not reused and fresh["id"] != job["id"]
+
+
+def test_queue_full(jobs, monkeypatch):
+    monkeypatch.setitem(reports.settings, "max_pending", 2)
+    reports.submit("unused_labs", {"days": 1})
+    reports.submit("unused_labs", {"days": 2})
+    with pytest.raises(reports.QueueFull):
+        reports.submit("unused_labs", {"days": 3})
+    # A reused job doesn't need a queue slot
+    assert reports.submit("unused_labs", {"days": 1})[1]
+
+
+def test_job_lost_with_another_worker_is_not_reused(jobs, monkeypatch):
+    job, _ = reports.submit("lab_usage", {"days": 7})
+    reports._jobs.set(job["id"], {**job, "owner": os.getpid() + 1, "state": "running", "started_at": 1.0})
+
+    assert reports.get(job["id"])["state"] == "failed"
+    again, reused = reports.submit("lab_usage", {"days": 7})
+    assert not reused and again["id"] != job["id"]
+
+
+def test_lab_days_attribution(jobs, fleet):
+    labs = reports._lab_days(date(2026, 10, 1), date(2026, 10, 19), {"city": "Lahore"})
+
+    assert set(labs) == {("LAHORE", "MODEL TOWN", "LAB 1"), ("LAHORE", "MODEL TOWN", "LAB 2")}
+    lab1 = labs[("LAHORE", "MODEL TOWN", "LAB 1")]
+    assert lab1["pcs"] == 2
+    # Device 1's live row covers today, device 2's history row its old day
+    assert lab1["days_used"] == {"2026-10-19", "2026-10-10"}
+    assert lab1["runtime_minutes"] == 60
+    assert lab1["last_seen"] == "2026-10-19"
+    # Lab 2 was only used before the range
+    assert labs[("LAHORE", "MODEL TOWN", "LAB 2")]["days_used"] == set()
+
+
+def test_unused_labs_report(jobs, fleet):
+    result = reports.unused_labs(reports._range_params({"days": 30}, 30))
+    assert result["total_labs"] == 3
+    assert [(g["city"], [l["lab"] for l in g["unused_labs"]]) for g in result["tehsils"]] == \
+        [("LAHORE", ["LAB 2"]), ("MULTAN", ["LAB 9"])]
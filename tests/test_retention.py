@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.services import retention
+
+
+@pytest.fixture
+def quick(monkeypatch):
+    monkeypatch.setitem(retention.settings, "chunk", 3)
+    monkeypatch.setitem(retention.settings, "pause", 0)
+    monkeypatch.setattr(retention.heartbeat_latency, "value", lambda: 0.0)
+
+
+def _day(days_ago):
+    return (datetime.utcnow() - timedelta(days=days_ago)).date().isoformat()
+
+
+def test_app_usage_logs_pruned_by_day_without_an_id(postgrest, quick):
+    rows = [{"device_id": str(d), "date": _day(ago), "app_name": app, "seconds_added": 60}
+            for ago in (0, 1, 2, 3) for d in range(4) for app in ("chrome.exe", "code.exe")]
+    postgrest.seed("app_usage_logs", rows)
+
+    report = retention.run_retention()
+
+    left = sorted({r["date"] for r in postgrest.rows("app_usage_logs").values()})
+    assert left == [_day(1), _day(0)]
+    assert report["rows_pruned"]["app_usage_logs"] == 16
+    assert report["complete"]["app_usage_logs"]
@@ -0,0 +1,46 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from app.services import shared_state
+
+
+@pytest.fixture
+def shared(tmp_path, monkeypatch):
+    path = str(tmp_path / "shared_state.db")
+    monkeypatch.setitem(shared_state.settings, "backend", "sqlite")
+    monkeypatch.setitem(shared_state.settings, "path", path)
+    monkeypatch.setitem(shared_state.settings, "busy_timeout", 1.0)
+    monkeypatch.setattr(shared_state, "_db", {"conn": None, "pid": None, "cursor": 0, "pruned_at": 0.0})
+    yield path
+    if shared_state._db["conn"] is not None:
+        shared_state._db["conn"].close()
+
+
+def test_write_waits_out_another_workers_lock(shared):
+    cache = shared_state.SharedTTLMap("test", ttl=60, max_size=10)
+    cache.set("a", 1)
+    other = sqlite3.connect(shared, isolation_level=None, check_same_thread=False)
+    other.execute("begin immediate")
+    threading.Timer(0.2, other.execute, ("commit",)).start()
+
+    started = time.monotonic()
+    cache.set("b", 2)
+    assert 0.15 < time.monotonic() - started < 0.9
+    assert dict(cache.items()) == {"a": 1, "b": 2}
+    other.close()
+
+
+def test_gives_up_after_the_busy_timeout(shared):
+    cache = shared_state.SharedTTLMap("test", ttl=60, max_size=10)
+    cache.set("a", 1)
+    other = sqlite3.connect(shared, isolation_level=None)
+    other.execute("begin immediate")
+    with pytest.raises(sqlite3.OperationalError):
+        cache.set("b", 2)
+    other.execute("rollback")
+    # The connection is free again afterwards
+    assert cache.get("a") == 1
+    other.close()
@@ -0,0 +1,130 @@
+import json
+import os
+
+import httpx
+import pytest
+
+from app.services import spool
+from app.utils.db_client import is_transient
+from conftest import api_error
+
+
+@pytest.fixture
+def wal(tmp_path, monkeypatch, db):
+    """A fresh spool in tmp_path with no background worker."""
+    monkeypatch.setattr(spool, "_ensure_worker", lambda: None)
+    monkeypatch.setitem(spool._state, "degraded_until", 0.0)
+    monkeypatch.setitem(spool._state, "fh", None)
+    monkeypatch.setattr(spool, "stats", {k: 0 for k in spool.stats})
+    spool.init_spool({"SPOOL_DIR": str(tmp_path)})
+    yield spool
+    spool._rotate()
+    spool._slot["file"].close()
+    spool._slot.update(file=None, index=None)
+
+
+def test_is_transient():
+    assert is_transient(httpx.ReadTimeout("slow"))
+    assert is_transient(httpx.ConnectError("refused"))
+    assert is_transient(api_error("57014"))     # statement timeout
+    assert is_transient(api_error("PGRST001"))  # database unreachable
+    assert is_transient(api_error(502))         # gateway page, not JSON
+    assert not is_transient(api_error("23503"))  # unknown foreign key
+    assert not is_transient(api_error("22007"))  # bad date
+    assert not is_transient(api_error("PGRST204"))
+    assert not is_transient(ValueError("bug"))
+
+
+def test_refused_write_raises_and_does_not_degrade(wal, db):
+    db.fail = lambda q: api_error("23503")
+    with pytest.raises(spool.WriteRejected):
+        spool.write("device_daily_history", "upsert", {"device_id": "nope"}, on_conflict="device_id,history_date")
+    assert not spool.is_degraded()
+    assert spool._state["bytes"] == 0
+
+
+def test_timeout_spools_and_degrades(wal, db):
+    db.fail = lambda q: httpx.ReadTimeout("slow")
+    assert spool.write("devices", "update", {"status": "online"}, match={"system_id": "1"}) == "spooled"
+    assert spool.is_degraded()
+    assert spool._state["bytes"] > 0
+
+
+def test_poison_record_is_dead_lettered_and_the_rest_drains(wal, db):
+    db.tables["devices"] = [{"system_id": "1", "status": "offline"}]
+    spool.spool("device_daily_history", "upsert", {"device_id": "ghost", "history_date": "2026-01-01"},
+                on_conflict="device_id,history_date")
+    spool.spool("devices", "update", {"status": "online"}, match={"system_id": "1"})
+    db.fail = lambda q: api_error("23503") if q.table == "device_daily_history" else None
+
+    spool._replay_once()
+
+    assert db.tables["devices"][0]["status"] == "online"
+    assert spool._state["bytes"] == 0
+    assert not spool._replay_segments()
+    with open(os.path.join(spool._settings["dir"], "dead.wal")) as f:
+        dead = [json.loads(line) for line in f]
+    assert [d["record"]["t"] for d in dead] == ["device_daily_history"]
+    assert spool.stats["dead_lettered"] == 1
+
+
+def test_transient_replay_failure_keeps_the_segment(wal, db):
+    spool.spool("devices", "update", {"status": "online"}, match={"system_id": "1"})
+    db.fail = lambda q: httpx.ConnectError("down")
+    spool._replay_once()
+    assert spool._state["bytes"] > 0
+    assert len(spool._replay_segments()) == 1
+    assert not os.path.exists(os.path.join(spool._settings["dir"], "dead.wal"))
+
+
+def test_replayed_insert_skips_rows_already_committed(wal, db):
+    # A timed out insert that did commit: PostgREST hands timestamptz back as +00:00
+    db.tables["device_sessions"] = [{"device_id": "1", "start_time": "2026-10-19T08:00:00+00:00"}]
+    for start in ("2026-10-19T08:00:00Z", "2026-10-19T09:00:00Z"):
+        spool.spool("device_sessions", "insert", {"device_id": "1", "start_time": start},
+                    dedupe_on="device_id,start_time")
+
+    spool._replay_once()
+
+    starts = sorted(r["start_time"] for r in db.tables["device_sessions"])
+    assert starts == ["2026-10-19T08:00:00+00:00", "2026-10-19T09:00:00Z"]
+
+
+def test_updates_by_hardware_and_system_id_replay_in_order(wal, db):
+    db.tables["devices"] = [{"system_id": "1", "hardware_id": "HW-1", "last_seen": None, "status": "offline"}]
+    spool.spool("devices", "update", {"last_seen": "2026-10-19T10:00:00Z", "status": "online"},
+                match={"hardware_id": "HW-1"})
+    spool.spool("devices", "update", {"last_seen": "2026-10-19T10:00:30Z", "status": "online"},
+                match={"system_id": "1"})
+    spool.spool("devices", "update", {"last_seen": "2026-10-19T10:01:00Z", "status": "online"},
+                match={"hardware_id": "HW-1"})
+    spool.spool("devices", "update", {"status": "offline"}, match={"system_id": "1"})
+
+    spool._replay_once()
+
+    assert db.tables["devices"][0]["last_seen"] == "2026-10-19T10:01:00Z"
+    assert db.tables["devices"][0]["status"] == "offline"
+
+
+def test_repeated_updates_still_coalesce(wal, db):
+    db.tables["devices"] = [{"system_id": str(i), "status": "offline"} for i in range(3)]
+    for _ in range(5):
+        for i in range(3):
+            spool.spool("devices", "update", {"status": "online"}, match={"system_id": str(i)})
+
+    spool._replay_once()
+
+    assert len(db.calls) == 3
+    assert {r["status"] for r in db.tables["devices"]} == {"online"}
+
+
+def test_append_after_a_torn_line_starts_a_new_one(wal, db):
+    with open(os.path.join(spool._settings["dir"], "active.wal"), "w") as f:
+        f.write('{"t":"devices","op":"upd')  # crash mid-append
+    spool.spool("devices", "update", {"status": "online"}, match={"system_id": "1"})
+    db.tables["devices"] = [{"system_id": "1", "status": "offline"}]
+
+    spool._replay_once()
+
+    assert db.tables["devices"][0]["status"] == "online"
+    assert spool.stats["corrupt"] == 1
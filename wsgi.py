@@ -8,4 +8,6 @@ from app.extensions import socketio
 app = create_app()
 
 if __name__ == "__main__":
+    from app.services.lifecycle import start_background_services
+    start_background_services(app)
     socketio.run(app, debug=False, host="0.0.0.0", port=5050)